@@ -0,0 +1,308 @@
+# backup_journal.py
+#
+# Append-only write-ahead log of state changes, so the state can be recovered
+# if the server crashes. Each change is appended to a journal as a JSON patch;
+# every so often the full state is written out as a checkpoint and the journal
+# is started over.
+#
+# Copyright (c) 2021, University of Minnesota
+# Author: Bridger Herman <herma582@umn.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import time
+import atexit
+import logging
+from collections import deque
+from threading import Condition, Lock, Thread
+
+from . import json_codec
+from .json_patch import apply_patch
+
+logger = logging.getLogger('django.server')
+
+# When to fsync the journal after appending to it
+FSYNC_ALWAYS = 'always'
+FSYNC_INTERVAL = 'interval'
+FSYNC_NEVER = 'never'
+
+class BackupJournal:
+    def __init__(self, checkpoint_path, fsync_policy=FSYNC_INTERVAL, fsync_interval=1.0, checkpoint_interval=200):
+        '''
+            `checkpoint_path` holds the most recent full copy of the state;
+            the journal of changes since then lives next to it.
+        '''
+        if fsync_policy not in (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER):
+            raise ValueError('Unknown backup fsync policy `{}`'.format(fsync_policy))
+
+        self.checkpoint_path = checkpoint_path
+        self.journal_path = checkpoint_path.with_suffix('.journal')
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self.checkpoint_interval = checkpoint_interval
+
+        if not self.checkpoint_path.parent.exists():
+            os.makedirs(self.checkpoint_path.parent)
+
+        self._lock = Lock()
+        self._journal_file = None
+        self._entries_since_checkpoint = 0
+        self._last_fsync = 0.0
+
+    def append(self, revision, patch, state):
+        '''
+            Record the patch that brought the state to `revision`. `state` is
+            the state at `revision`, used if it's time for a new checkpoint.
+        '''
+        self.append_many([(revision, time.time(), patch)], state)
+
+    def append_many(self, entries, state):
+        '''
+            Record several (revision, time, patch) entries with a single write.
+            `state` is the state at the last entry's revision.
+        '''
+        lines = b''.join(json_codec.dumps({
+            'revision': revision,
+            'time': t,
+            'patch': patch,
+        }) + b'\n' for (revision, t, patch) in entries)
+        with self._lock:
+            if self._journal_file is None:
+                self._journal_file = open(self.journal_path, 'ab')
+            self._journal_file.write(lines)
+            self._journal_file.flush()
+            self._entries_since_checkpoint += len(entries)
+
+            if self._entries_since_checkpoint >= self.checkpoint_interval:
+                self._checkpoint(entries[-1][0], state)
+            elif self.fsync_policy == FSYNC_ALWAYS or \
+                    (self.fsync_policy == FSYNC_INTERVAL and time.time() - self._last_fsync > self.fsync_interval):
+                self._fsync(self._journal_file)
+
+    def checkpoint(self, revision, state):
+        '''
+            Write out the full state and start a fresh journal
+        '''
+        with self._lock:
+            self._checkpoint(revision, state)
+
+    def _checkpoint(self, revision, state):
+        # Write to a temporary file first so a crash never leaves a
+        # half-written checkpoint behind
+        tmp_path = self.checkpoint_path.with_suffix('.tmp')
+        with open(tmp_path, 'wb') as checkpoint_file:
+            checkpoint_file.write(json_codec.dumps({
+                'revision': revision,
+                'time': time.time(),
+                'state': state,
+            }))
+            checkpoint_file.flush()
+            if self.fsync_policy != FSYNC_NEVER:
+                self._fsync(checkpoint_file)
+        os.replace(tmp_path, self.checkpoint_path)
+
+        # Everything in the journal is now in the checkpoint
+        if self._journal_file is not None:
+            self._journal_file.close()
+        self._journal_file = open(self.journal_path, 'wb')
+        self._entries_since_checkpoint = 0
+
+    def _fsync(self, f):
+        os.fsync(f.fileno())
+        self._last_fsync = time.time()
+
+    def exists(self):
+        '''
+            Whether there's anything backed up to lose
+        '''
+        return self.checkpoint_path.exists() or \
+            (self.journal_path.exists() and self.journal_path.stat().st_size > 0)
+
+    def set_aside(self):
+        '''
+            Rename the checkpoint and journal (to <name>.bak.<timestamp>) so
+            they're kept, but a fresh backup can be started in their place.
+            Returns the new names.
+        '''
+        suffix = '.bak.' + time.strftime('%Y%m%d-%H%M%S')
+        moved = []
+        with self._lock:
+            if self._journal_file is not None:
+                self._journal_file.close()
+                self._journal_file = None
+            for path in (self.checkpoint_path, self.journal_path):
+                # Nothing worth keeping in an empty file
+                if path.exists() and path.stat().st_size > 0:
+                    new_path = path.with_name(path.name + suffix)
+                    os.replace(path, new_path)
+                    moved.append(new_path)
+            self._entries_since_checkpoint = 0
+        return moved
+
+    def restore(self):
+        '''
+            Load the latest checkpoint and replay the journal on top of it.
+            Returns a tuple of (revision, state), or None if there's no usable
+            backup.
+        '''
+        try:
+            with open(self.checkpoint_path, 'rb') as checkpoint_file:
+                checkpoint = json_codec.loads(checkpoint_file.read())
+            revision = checkpoint['revision']
+            state = checkpoint['state']
+        except (FileNotFoundError, json_codec.DecodeError, KeyError, TypeError):
+            logger.info('No usable backup checkpoint found at {}'.format(self.checkpoint_path))
+            return None
+
+        replayed = 0
+        try:
+            with open(self.journal_path, 'rb') as journal_file:
+                for line in journal_file:
+                    try:
+                        entry = json_codec.loads(line)
+                    except json_codec.DecodeError:
+                        # Most likely the last entry was only partially
+                        # written when the server went down
+                        logger.warning('Stopping backup replay at a corrupt journal entry')
+                        break
+                    # Skip anything that already made it into the checkpoint
+                    if entry['revision'] <= revision:
+                        continue
+                    state = apply_patch(state, entry['patch'])
+                    revision = entry['revision']
+                    replayed += 1
+        except FileNotFoundError:
+            pass
+
+        logger.info('Restored backup at revision {} ({} journal entries replayed)'.format(revision, replayed))
+        return (revision, state)
+
+    def close(self):
+        with self._lock:
+            if self._journal_file is not None:
+                self._journal_file.flush()
+                if self.fsync_policy != FSYNC_NEVER:
+                    self._fsync(self._journal_file)
+                self._journal_file.close()
+                self._journal_file = None
+
+
+class BackupWriter:
+    '''
+        Writes backups from a background thread so disk latency stays off the
+        request path. Changes submitted in a burst are coalesced into at most
+        one journal write per `write_interval` seconds.
+    '''
+    def __init__(self, journal, write_interval=0.5):
+        self.journal = journal
+        self.write_interval = write_interval
+
+        self._pending = deque()
+        self._pending_state = None
+        self._condition = Condition()
+        self._running = True
+        self._last_write = 0.0
+
+        # Metrics
+        self._submitted = 0
+        self._unwritten = 0
+        self._writes = 0
+        self._last_written_revision = None
+        self._last_submitted_revision = None
+        self._max_lag = 0.0
+
+        self._thread = Thread(target=self._run, name='abr-backup-writer', daemon=True)
+        self._thread.start()
+
+        # Don't lose anything still in the queue when the server shuts down
+        atexit.register(self.close)
+
+    def submit(self, revision, patch, state):
+        '''
+            Queue up the patch that brought the state to `revision`. `state` is
+            a (read-only) snapshot of the state at `revision`.
+        '''
+        with self._condition:
+            self._pending.append((revision, time.time(), patch))
+            self._pending_state = state
+            self._submitted += 1
+            self._unwritten += 1
+            self._last_submitted_revision = revision
+            self._condition.notify()
+
+    def flush(self):
+        '''
+            Block until everything submitted so far has been written
+        '''
+        with self._condition:
+            while self._unwritten > 0 and self._running:
+                self._condition.wait()
+
+    def close(self):
+        with self._condition:
+            if not self._running:
+                return
+            self._running = False
+            self._condition.notify_all()
+        self._thread.join()
+        self.journal.close()
+        atexit.unregister(self.close)
+
+    def metrics(self):
+        with self._condition:
+            oldest_pending = self._pending[0][1] if len(self._pending) > 0 else None
+            return {
+                'submitted': self._submitted,
+                'writes': self._writes,
+                # Changes that rode along with another change's write
+                'coalesced': self._submitted - self._unwritten - self._writes,
+                'pending': self._unwritten,
+                'lagSeconds': time.time() - oldest_pending if oldest_pending is not None else 0.0,
+                'maxLagSeconds': self._max_lag,
+                'lastSubmittedRevision': self._last_submitted_revision,
+                'lastWrittenRevision': self._last_written_revision,
+            }
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while len(self._pending) == 0 and self._running:
+                    self._condition.wait()
+                if len(self._pending) == 0:
+                    return
+
+                # Let a burst of changes pile up, unless we're shutting down
+                wait = self._last_write + self.write_interval - time.time()
+                while wait > 0 and self._running:
+                    self._condition.wait(wait)
+                    wait = self._last_write + self.write_interval - time.time()
+
+                entries = list(self._pending)
+                state = self._pending_state
+                self._pending.clear()
+                self._pending_state = None
+
+            try:
+                self.journal.append_many(entries, state)
+            except OSError as e:
+                logger.error('Unable to back up state: {}'.format(e))
+
+            with self._condition:
+                self._last_write = time.time()
+                self._writes += 1
+                self._unwritten -= len(entries)
+                self._last_written_revision = entries[-1][0]
+                self._max_lag = max(self._max_lag, self._last_write - entries[0][1])
+                self._condition.notify_all()
@@ -0,0 +1,67 @@
+# binary_frames.py
+#
+# Binary WebSocket messages, for payloads that are too big to be worth putting
+# in JSON (e.g. thumbnails from the engine). Each frame is a small header
+# followed by the raw payload:
+#
+#   bytes 0-3   b'ABRB'
+#   byte  4     format version (1)
+#   byte  5     length of the target, n
+#   bytes 6-    the target (ASCII, e.g. 'thumbnail'), then the payload
+#
+# Copyright (c) 2021, University of Minnesota
+# Author: Bridger Herman <herma582@umn.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import struct
+
+MAGIC = b'ABRB'
+VERSION = 1
+HEADER = struct.Struct('!4sBB')
+
+def encode_frame(target, payload):
+    '''
+        Binary frame sending `payload` (bytes) to `target`
+    '''
+    target_bytes = target.encode('ascii')
+    if len(target_bytes) > 255:
+        raise ValueError('Target `{}` is too long'.format(target))
+    return HEADER.pack(MAGIC, VERSION, len(target_bytes)) + target_bytes + payload
+
+def decode_frame(data):
+    '''
+        Returns a message like the JSON ones, {'target': ..., 'content': ...},
+        where the content is a memoryview of the payload (so it isn't copied).
+        Raises a ValueError if the frame isn't valid.
+    '''
+    if len(data) < HEADER.size:
+        raise ValueError('Frame is too short')
+    magic, version, target_length = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError('Frame does not start with {}'.format(MAGIC))
+    if version != VERSION:
+        raise ValueError('Unsupported frame version {}'.format(version))
+
+    payload_start = HEADER.size + target_length
+    if len(data) < payload_start:
+        raise ValueError('Frame is too short')
+    try:
+        target = bytes(data[HEADER.size:payload_start]).decode('ascii')
+    except UnicodeDecodeError:
+        raise ValueError('Frame target is not ASCII')
+    return {
+        'target': target,
+        'content': memoryview(data)[payload_start:],
+    }
@@ -14,22 +14,145 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import io
+import os
+import time
+import hashlib
 import logging
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
 from django.conf import settings
 import base64
-from pathlib import Path
+from PIL import Image, features
 
-from .notifier import notifier
+from .notifier import MessageTarget, NotifierMessage, notifier
 
 logger = logging.getLogger('django.server')
 
+# Name of the variant that's exactly what the engine sent
+FULL_SIZE = 'full'
+
+class Thumbnail:
+    '''
+        One thumbnail from an engine, in several sizes. `variants` is a
+        dictionary of {name: (content type, bytes, etag)}, with FULL_SIZE and
+        one variant for each width (e.g. '256').
+    '''
+    def __init__(self, version, sender_id, variants):
+        self.version = version
+        self.sender_id = sender_id
+        self.variants = variants
+        self.time = time.time()
+
+    def variant(self, width=None):
+        '''
+            The smallest variant at least `width` pixels wide (or the full size
+            one, if none is or `width` isn't given)
+        '''
+        if width is not None:
+            widths = sorted(int(name) for name in self.variants if name != FULL_SIZE)
+            for w in widths:
+                if w >= width:
+                    return self.variants[str(w)]
+        return self.variants[FULL_SIZE]
+
+    def to_json(self):
+        return {
+            'version': self.version,
+            'sender': str(self.sender_id),
+            'time': self.time,
+            'variants': {name: {'contentType': v[0], 'bytes': len(v[1])} for name, v in self.variants.items()},
+        }
+
+def _etag(content):
+    return '"{}"'.format(hashlib.blake2b(content, digest_size=12).hexdigest())
+
 class ImageManager:
+    '''
+        Thumbnails sent by the engine. Each one is scaled down to a few smaller
+        sizes in a pool of worker threads, then kept in memory (the last
+        THUMBNAIL_HISTORY from each sender) and clients are sent a `thumbnail`
+        notification with its version. Every connection has a new sender ID,
+        so only the THUMBNAIL_MAX_SENDERS most recent senders are remembered.
+    '''
     def __init__(self):
+        self.widths = settings.THUMBNAIL_WIDTHS
+        self.format = settings.THUMBNAIL_FORMAT
+        if self.format == 'WEBP' and not features.check('webp'):
+            logger.warning('Pillow was built without WebP support, saving thumbnails as PNG')
+            self.format = 'PNG'
+        self.quality = settings.THUMBNAIL_QUALITY
+
+        self._lock = threading.Lock()
+        self._versions = count(1)
+        # Recent thumbnails from each sender, oldest first, and least recently
+        # heard from sender first
+        self.max_senders = settings.THUMBNAIL_MAX_SENDERS
+        self._history = OrderedDict()
+        self.latest = None
+
+        self._pool = ThreadPoolExecutor(max_workers=settings.THUMBNAIL_WORKERS, thread_name_prefix='abr-thumbnail')
         notifier.add_action('thumbnail', self.save_thumbnail)
 
     def save_thumbnail(self, msg, sender_id):
+        # Runs in a worker thread (see StateNotifier.add_action), but the
+        # resizing is handed off to the pool so the sender isn't held up.
+        # Binary frames carry the PNG as-is, JSON messages have it
+        # base64-encoded.
         content = msg['content']
-        content_binary = base64.b64decode(content)
+        if isinstance(content, (bytes, memoryview)):
+            content_binary = bytes(content)
+        else:
+            content_binary = base64.b64decode(content)
+
+        with self._lock:
+            version = next(self._versions)
+        future = self._pool.submit(self._process, version, sender_id, content_binary)
+        future.add_done_callback(self._log_error)
+
+    @staticmethod
+    def _log_error(future):
+        if future.exception() is not None:
+            logger.error('Unable to process thumbnail: {}'.format(future.exception()))
+
+    def _process(self, version, sender_id, content_binary):
+        variants = {FULL_SIZE: ('image/png', content_binary, _etag(content_binary))}
+        with Image.open(io.BytesIO(content_binary)) as image:
+            image.load()
+            for width in self.widths:
+                if width >= image.width:
+                    continue
+                height = max(1, round(image.height * width / image.width))
+                resized = image.resize((width, height), Image.LANCZOS)
+                buf = io.BytesIO()
+                resized.save(buf, self.format, quality=self.quality)
+                data = buf.getvalue()
+                variants[str(width)] = ('image/' + self.format.lower(), data, _etag(data))
+
+        thumbnail = Thumbnail(version, sender_id, variants)
+        with self._lock:
+            history = self._history.get(sender_id)
+            if history is None:
+                history = self._history[sender_id] = deque(maxlen=settings.THUMBNAIL_HISTORY)
+            history.append(thumbnail)
+            self._history.move_to_end(sender_id)
+            while len(self._history) > self.max_senders:
+                self._history.popitem(last=False)
+            # Thumbnails may finish out of order, only the newest counts
+            is_latest = self.latest is None or version > self.latest.version
+            if is_latest:
+                self.latest = thumbnail
+
+        if is_latest:
+            self._write_latest(content_binary)
+            notifier.notify(NotifierMessage(MessageTarget.Thumbnail, revision=version))
+
+    def _write_latest(self, content_binary):
+        # Still saved to media/thumbnails for anything that fetches it from
+        # there. Write to a temporary file first so nobody fetches a
+        # half-written thumbnail.
         thumbnail_path = settings.THUMBNAILS_PATH
         if not thumbnail_path.exists():
             thumbnail_path.mkdir(parents=True)
@@ -43,7 +166,34 @@ class ImageManager:
         #     fout.write(content_binary)
 
         # Write the thumbnail for most-recent
-        with open(thumbnail_path.joinpath('latest-thumbnail.png'), 'wb') as fout:
+        latest_path = thumbnail_path.joinpath('latest-thumbnail.png')
+        tmp_path = latest_path.with_name('latest-thumbnail-{}.tmp'.format(threading.get_ident()))
+        with open(tmp_path, 'wb') as fout:
             fout.write(content_binary)
+        os.replace(tmp_path, latest_path)
+
+    def get(self, version=None):
+        '''
+            Thumbnail with the given version (if it's still around), or the
+            latest one
+        '''
+        with self._lock:
+            if version is None:
+                return self.latest
+            for history in self._history.values():
+                for thumbnail in history:
+                    if thumbnail.version == version:
+                        return thumbnail
+        return None
+
+    def to_json(self):
+        with self._lock:
+            return {
+                'latest': None if self.latest is None else self.latest.version,
+                'senders': {
+                    str(sender_id): [t.to_json() for t in history]
+                    for sender_id, history in self._history.items()
+                },
+            }
 
-image_manager = ImageManager()
\ No newline at end of file
+image_manager = ImageManager()
@@ -0,0 +1,115 @@
+# json_codec.py
+#
+# JSON encoding/decoding used throughout the server. Uses orjson when it's
+# installed (much faster for large states and dataset listings), and falls back
+# to the standard library `json` module otherwise.
+#
+# Copyright (c) 2021, University of Minnesota
+# Author: Bridger Herman <herma582@umn.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import logging
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger('django.server')
+
+# Raised by loads() for invalid JSON, whichever codec is in use (orjson's
+# decode error is a subclass of this one)
+DecodeError = json.JSONDecodeError
+
+class StdlibCodec:
+    name = 'json'
+
+    def dumps(self, obj):
+        '''
+            Encode `obj` as UTF-8 JSON bytes
+        '''
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    def dumps_str(self, obj):
+        return json.dumps(obj, separators=(',', ':'))
+
+    def loads(self, data):
+        '''
+            Decode JSON from bytes or a string
+        '''
+        return json.loads(data)
+
+class OrjsonCodec:
+    name = 'orjson'
+
+    # Match what the standard library accepts: non-string keys (e.g. ints) and
+    # numpy arrays/scalars, which come up in the histogram endpoints
+    OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY if orjson is not None else 0
+
+    def dumps(self, obj):
+        return orjson.dumps(obj, option=self.OPTIONS)
+
+    def dumps_str(self, obj):
+        return orjson.dumps(obj, option=self.OPTIONS).decode('utf-8')
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+def get_codec(name='auto'):
+    '''
+        Get a codec by name: `orjson`, `json` (the standard library), or `auto`
+        to use orjson if it's installed
+    '''
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'json'
+    if name == 'orjson':
+        if orjson is None:
+            logger.warning('JSON codec `orjson` is not installed, using the standard library instead')
+            return StdlibCodec()
+        return OrjsonCodec()
+    elif name == 'json':
+        return StdlibCodec()
+    else:
+        raise ValueError('Unknown JSON codec `{}`'.format(name))
+
+def _configured_codec():
+    # Settings may not be configured, e.g. in standalone scripts
+    try:
+        from django.conf import settings
+        name = settings.JSON_CODEC
+    except Exception:
+        name = 'auto'
+    return get_codec(name)
+
+codec = _configured_codec()
+
+def dumps(obj):
+    '''
+        Encode `obj` as compact UTF-8 JSON bytes
+    '''
+    return codec.dumps(obj)
+
+def dumps_str(obj):
+    '''
+        Encode `obj` as a compact JSON string
+    '''
+    return codec.dumps_str(obj)
+
+def loads(data):
+    '''
+        Decode JSON from bytes or a string. Raises DecodeError if it's invalid.
+    '''
+    return codec.loads(data)
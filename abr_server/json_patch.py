@@ -0,0 +1,136 @@
+# json_patch.py
+#
+# Minimal JSON Patch (RFC 6902) support for describing changes to the state, so
+# connected clients can be sent just what changed instead of the whole state.
+#
+# Copyright (c) 2021, University of Minnesota
+# Author: Bridger Herman <herma582@umn.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+def pointer_from_parts(path_parts):
+    '''
+        Build a JSON Pointer (RFC 6901) from a list of path parts, e.g.
+        ['impressions', 'a/b'] -> '/impressions/a~1b'
+    '''
+    return ''.join('/' + str(p).replace('~', '~0').replace('/', '~1') for p in path_parts)
+
+def parts_from_pointer(pointer):
+    '''
+        Split a JSON Pointer (RFC 6901) back into its list of path parts
+    '''
+    if len(pointer) == 0:
+        return []
+    return [p.replace('~1', '/').replace('~0', '~') for p in pointer.split('/')[1:]]
+
+def make_patch(src, dst, path_parts=()):
+    '''
+        Compute a list of JSON Patch operations that turns `src` into `dst`.
+        Objects are compared key-by-key; anything else (including lists) is
+        replaced wholesale when it differs.
+    '''
+    # Unchanged subtrees are often the very same object, skip them quickly
+    if src is dst:
+        return []
+
+    if not isinstance(src, dict) or not isinstance(dst, dict):
+        if src == dst:
+            return []
+        return [{
+            'op': 'replace',
+            'path': pointer_from_parts(path_parts),
+            'value': dst,
+        }]
+
+    ops = []
+    for key in src:
+        if key not in dst:
+            ops.append({
+                'op': 'remove',
+                'path': pointer_from_parts(path_parts + (key,)),
+            })
+    for key, value in dst.items():
+        if key not in src:
+            ops.append({
+                'op': 'add',
+                'path': pointer_from_parts(path_parts + (key,)),
+                'value': value,
+            })
+        else:
+            ops.extend(make_patch(src[key], value, path_parts + (key,)))
+    return ops
+
+# Persistent (structurally shared) updates. Committed states are never modified
+# in place; an update copies only the objects along the path to the change and
+# shares everything else with the previous state.
+
+def get_in(doc, path_parts):
+    '''
+        Get whatever is at `path_parts` in `doc`, or None if there's nothing
+    '''
+    for part in path_parts:
+        if not isinstance(doc, dict) or part not in doc:
+            return None
+        doc = doc[part]
+    return doc
+
+def set_in(doc, path_parts, value):
+    '''
+        Return a copy of `doc` with `value` at `path_parts`, creating empty
+        objects for any missing parents
+    '''
+    if len(path_parts) == 0:
+        return value
+    new_doc = dict(doc)
+    key = path_parts[0]
+    if len(path_parts) == 1:
+        new_doc[key] = value
+    else:
+        new_doc[key] = set_in(doc.get(key, {}), path_parts[1:], value)
+    return new_doc
+
+def remove_in(doc, path_parts):
+    '''
+        Return a copy of `doc` without whatever is at `path_parts`. Returns
+        `doc` itself if there's nothing there to remove.
+    '''
+    key = path_parts[0]
+    if not isinstance(doc, dict) or key not in doc:
+        return doc
+    if len(path_parts) == 1:
+        new_doc = dict(doc)
+        del new_doc[key]
+        return new_doc
+
+    new_child = remove_in(doc[key], path_parts[1:])
+    if new_child is doc[key]:
+        return doc
+    new_doc = dict(doc)
+    new_doc[key] = new_child
+    return new_doc
+
+def apply_patch(doc, patch):
+    '''
+        Apply a list of JSON Patch operations (as produced by make_patch) to
+        `doc`, returning the new document. `doc` itself is left untouched.
+    '''
+    for op in patch:
+        path_parts = parts_from_pointer(op['path'])
+        if op['op'] == 'remove':
+            doc = remove_in(doc, path_parts) if len(path_parts) > 0 else {}
+        elif op['op'] in ('add', 'replace'):
+            doc = set_in(doc, path_parts, op['value'])
+        else:
+            raise ValueError('Unsupported JSON Patch operation `{}`'.format(op['op']))
+    return doc
@@ -0,0 +1,397 @@
+# keydata.py
+#
+# Reading KeyData (the .json metadata and .bin data in media/datasets) for the
+# server's own use, e.g. histograms for the colormap editor. The .bin files are
+# memory-mapped, so repeated reads share the same pages instead of each
+# reading the file into a new array, and computed results are cached.
+#
+# Histograms and summary statistics for every variable can also be computed
+# ahead of time into a sidecar file next to the KeyData (<name>.hist.npz, see
+# build_sidecar() and `manage.py precompute_keydata`), which is used as long
+# as the KeyData hasn't changed since.
+#
+# Copyright (c) 2021, University of Minnesota
+# Author: Bridger Herman <herma582@umn.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import logging
+import multiprocessing
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
+from django.conf import settings
+
+from . import json_codec
+
+logger = logging.getLogger('django.server')
+
+# Percentiles kept in the sidecar for each variable
+SIDECAR_PERCENTILES = (1, 5, 25, 50, 75, 95, 99)
+
+def file_stamp(json_path, bin_path):
+    '''
+        Changes whenever either file of a KeyData does
+    '''
+    json_stat = os.stat(json_path)
+    bin_stat = os.stat(bin_path)
+    return (json_stat.st_mtime_ns, bin_stat.st_mtime_ns, bin_stat.st_size)
+
+def sidecar_path(json_path):
+    return os.path.splitext(json_path)[0] + '.hist.npz'
+
+def find_keydata(dataset_path):
+    '''
+        (json path, bin path) for every KeyData under `dataset_path`, which is
+        laid out like <org>/<dataset>/KeyData/<name>.json
+    '''
+    for org in sorted(os.listdir(dataset_path)):
+        org_path = os.path.join(dataset_path, org)
+        if not os.path.isdir(org_path):
+            continue
+        for dataset in sorted(os.listdir(org_path)):
+            keydata_dir = os.path.join(org_path, dataset, 'KeyData')
+            if not os.path.isdir(keydata_dir):
+                continue
+            for name in sorted(os.listdir(keydata_dir)):
+                if not name.endswith('.json'):
+                    continue
+                json_path = os.path.join(keydata_dir, name)
+                bin_path = os.path.splitext(json_path)[0] + '.bin'
+                if os.path.exists(bin_path):
+                    yield (json_path, bin_path)
+
+def load_sidecar(json_path, stamp):
+    '''
+        The precomputed histograms and statistics for a KeyData, or None if
+        there aren't any or they're out of date
+    '''
+    try:
+        with np.load(sidecar_path(json_path)) as npz:
+            if tuple(npz['stamp'].tolist()) != stamp:
+                return None
+            return {name: npz[name] for name in npz.files}
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.error('Unable to read KeyData sidecar for {}: {}'.format(json_path, e))
+        return None
+
+def build_sidecar(json_path, bin_path, bins_levels):
+    '''
+        Compute histograms (at each number of bins in `bins_levels`) and
+        summary statistics for every variable of a KeyData, and save them next
+        to it. Only uses its arguments (not the Django settings), so it can be
+        run in a separate process. Returns the sidecar's path.
+    '''
+    stamp = file_stamp(json_path, bin_path)
+    keydata = KeyData(json_path, bin_path, stamp, use_sidecar=False)
+    names = keydata.metadata['scalarArrayNames']
+    n = len(names)
+
+    arrays = {
+        'stamp': np.array(stamp, dtype='i8'),
+        'variables': np.array(names, dtype=str),
+        'bins': np.array(bins_levels, dtype='i8'),
+        'count': np.zeros(n, dtype='i8'),
+        'min': np.full(n, np.nan),
+        'max': np.full(n, np.nan),
+        'mean': np.full(n, np.nan),
+        'std': np.full(n, np.nan),
+        'percentile_levels': np.array(SIDECAR_PERCENTILES, dtype='f8'),
+        'percentiles': np.full((n, len(SIDECAR_PERCENTILES)), np.nan),
+    }
+    for bins in bins_levels:
+        arrays['hist_{}'.format(bins)] = np.zeros((n, bins), dtype='i8')
+        arrays['edges_{}'.format(bins)] = np.full((n, bins + 1), np.nan, dtype='f4')
+
+    for i, name in enumerate(names):
+        data = keydata.variable(name)
+        finite = np.isfinite(data)
+        if not finite.all():
+            data = data[finite]
+        arrays['count'][i] = len(data)
+        if len(data) == 0:
+            continue
+        arrays['min'][i] = data.min()
+        arrays['max'][i] = data.max()
+        arrays['mean'][i] = data.mean(dtype='f8')
+        arrays['std'][i] = data.std(dtype='f8')
+        arrays['percentiles'][i] = np.percentile(data, SIDECAR_PERCENTILES)
+        for bins in bins_levels:
+            hist, edges = np.histogram(data, bins=bins)
+            arrays['hist_{}'.format(bins)][i] = hist
+            arrays['edges_{}'.format(bins)][i] = edges
+
+    # Write to a temporary file first so there's never a half-written sidecar
+    path = sidecar_path(json_path)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fout:
+        np.savez_compressed(fout, **arrays)
+    os.replace(tmp_path, path)
+    return path
+
+class UnknownVariableError(Exception):
+    '''
+        Raised when a KeyData doesn't have the variable that was asked for
+    '''
+    def __init__(self, variable_label):
+        super().__init__('No variable named {}'.format(variable_label))
+        self.variable_label = variable_label
+
+class ByteBudgetCache:
+    '''
+        Least-recently-used cache that holds at most `max_bytes` worth of
+        values (as measured by whoever puts them in)
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size):
+        with self._lock:
+            if size > self.max_bytes:
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._entries[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _key, (_value, evicted_size) = self._entries.popitem(last=False)
+                self.bytes -= evicted_size
+
+    def to_json(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'maxBytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+class KeyData:
+    '''
+        One KeyData file: its metadata, and its data memory-mapped read-only.
+        `stamp` changes whenever either file does.
+    '''
+    def __init__(self, json_path, bin_path, stamp, use_sidecar=True):
+        self.json_path = json_path
+        self.bin_path = bin_path
+        self.stamp = stamp
+        with open(json_path, 'rb') as fin:
+            self.metadata = json_codec.loads(fin.read())
+        self._data = np.memmap(bin_path, dtype='u1', mode='r')
+        self.sidecar = load_sidecar(json_path, stamp) if use_sidecar else None
+
+    def variable_index(self, variable_label):
+        '''
+            Raises an UnknownVariableError if there's no variable called
+            `variable_label`
+        '''
+        try:
+            return self.metadata['scalarArrayNames'].index(variable_label)
+        except ValueError:
+            raise UnknownVariableError(variable_label)
+
+    def variable(self, variable_label):
+        '''
+            The values of a scalar variable (a read-only view of the file, not a
+            copy)
+        '''
+        variable_index = self.variable_index(variable_label)
+        num_points = self.metadata['num_points']
+        # Points (x, y, z), then cell indices, then each scalar variable
+        offset = num_points*(3+variable_index)*4 + self.metadata['num_cell_indices']*4
+        return self._data[offset:offset + num_points*4].view('f4')
+
+    def has_precomputed(self, bins):
+        '''
+            Whether the sidecar has histograms with `bins` bins
+        '''
+        return self.sidecar is not None and 'hist_{}'.format(bins) in self.sidecar
+
+    def histogram(self, variable_label, bins, value_range=None):
+        '''
+            Returns (counts, bin edges) like np.histogram, from the sidecar if
+            it has them
+        '''
+        if value_range is None and self.has_precomputed(bins):
+            i = self.variable_index(variable_label)
+            return (self.sidecar['hist_{}'.format(bins)][i], self.sidecar['edges_{}'.format(bins)][i])
+        return np.histogram(self.variable(variable_label), bins=bins, range=value_range)
+
+    def stats(self, variable_label):
+        '''
+            Summary statistics for a variable from the sidecar, or None if
+            there isn't one
+        '''
+        if self.sidecar is None:
+            return None
+        i = self.variable_index(variable_label)
+        return {
+            'count': int(self.sidecar['count'][i]),
+            'min': float(self.sidecar['min'][i]),
+            'max': float(self.sidecar['max'][i]),
+            'mean': float(self.sidecar['mean'][i]),
+            'std': float(self.sidecar['std'][i]),
+            'percentiles': dict(zip(
+                (str(int(p)) for p in self.sidecar['percentile_levels']),
+                self.sidecar['percentiles'][i].tolist(),
+            )),
+        }
+
+
+def compute_histogram(json_path, bin_path, stamp, variable_label, bins):
+    '''
+        Histogram of one variable straight from the data, for running in a
+        worker process (see KeyDataManager.histogram())
+    '''
+    return KeyData(json_path, bin_path, stamp, use_sidecar=False).histogram(variable_label, bins)
+
+
+class KeyDataManager:
+    def __init__(self):
+        # Recently used KeyData, so they don't need to be mapped again
+        self.max_open = settings.KEYDATA_MAX_OPEN
+        self._lock = Lock()
+        self._open = OrderedDict()
+
+        # Finished histograms (or anything else computed from KeyData that's
+        # worth keeping), keyed by something including KeyData.stamp so that
+        # changed files are never served from the cache
+        self.results = ByteBudgetCache(settings.KEYDATA_CACHE_BYTES)
+
+        # Sidecars that are missing or out of date are rebuilt in the
+        # background, one at a time
+        self.build_sidecars = settings.KEYDATA_BUILD_SIDECARS
+        self._builder = ThreadPoolExecutor(max_workers=1, thread_name_prefix='abr-keydata-sidecar')
+        self._building = set()
+        # (json path, stamp) of builds that failed, so they aren't retried
+        # until the KeyData changes
+        self._failed = set()
+
+        # Threads for computing from several KeyData (or variables) at once
+        self.pool = ThreadPoolExecutor(max_workers=settings.KEYDATA_WORKERS, thread_name_prefix='abr-keydata')
+
+        # Histograms that aren't in a sidecar are computed in worker processes
+        # (np.histogram works through the data a block at a time from Python,
+        # so threads mostly take turns). Started the first time one is needed.
+        self._processes = None
+
+    def paths(self, org_name, dataset_name, key_data_name):
+        base = os.path.join(settings.DATASET_PATH, org_name, dataset_name, 'KeyData', key_data_name)
+        return (base + '.json', base + '.bin')
+
+    def open(self, org_name, dataset_name, key_data_name):
+        '''
+            KeyData for a dataset in the media folder. Raises a
+            FileNotFoundError if it doesn't exist.
+        '''
+        json_path, bin_path = self.paths(org_name, dataset_name, key_data_name)
+        stamp = file_stamp(json_path, bin_path)
+        with self._lock:
+            keydata = self._open.get(json_path)
+            if keydata is not None and keydata.stamp == stamp:
+                self._open.move_to_end(json_path)
+                return keydata
+
+        keydata = KeyData(json_path, bin_path, stamp)
+        with self._lock:
+            self._open[json_path] = keydata
+            self._open.move_to_end(json_path)
+            while len(self._open) > self.max_open:
+                self._open.popitem(last=False)
+            rebuild = self.build_sidecars and keydata.sidecar is None and \
+                json_path not in self._building and (json_path, stamp) not in self._failed
+            if rebuild:
+                self._building.add(json_path)
+        if rebuild:
+            self._builder.submit(self._rebuild_sidecar, json_path, bin_path, stamp)
+        return keydata
+
+    def histogram(self, keydata, variable_label, bins):
+        '''
+            Like KeyData.histogram(), but anything that isn't in the sidecar is
+            computed in a worker process
+        '''
+        if keydata.has_precomputed(bins):
+            return keydata.histogram(variable_label, bins)
+        # Fail fast on a bad variable, rather than in the worker
+        keydata.variable_index(variable_label)
+
+        with self._lock:
+            if self._processes is None:
+                # Spawned rather than forked: this process has other threads
+                # running, and a forked child would inherit any locks they hold
+                self._processes = ProcessPoolExecutor(
+                    max_workers=settings.KEYDATA_WORKERS,
+                    mp_context=multiprocessing.get_context('spawn'),
+                )
+            processes = self._processes
+        try:
+            return processes.submit(compute_histogram, keydata.json_path, keydata.bin_path, keydata.stamp, variable_label, bins).result()
+        except BrokenProcessPool:
+            # A worker died; start over with new ones next time
+            with self._lock:
+                if self._processes is processes:
+                    self._processes = None
+            raise
+
+    def _rebuild_sidecar(self, json_path, bin_path, stamp):
+        try:
+            build_sidecar(json_path, bin_path, settings.KEYDATA_HISTOGRAM_BINS)
+            logger.info('Rebuilt KeyData sidecar for {}'.format(json_path))
+            failed = False
+        except Exception as e:
+            logger.error('Unable to build KeyData sidecar for {}: {}'.format(json_path, e))
+            failed = True
+        with self._lock:
+            self._building.discard(json_path)
+            self._failed = {f for f in self._failed if f[0] != json_path}
+            if failed:
+                # Keep using the KeyData without a sidecar
+                self._failed.add((json_path, stamp))
+            else:
+                # Open it again (with the new sidecar) next time it's used
+                self._open.pop(json_path, None)
+
+    def to_json(self):
+        with self._lock:
+            open_count = len(self._open)
+        return {
+            'open': open_count,
+            'results': self.results.to_json(),
+        }
+
+keydata_manager = KeyDataManager()
@@ -14,64 +14,84 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from channels.generic.websocket import WebsocketConsumer
+from channels.generic.websocket import AsyncWebsocketConsumer
 import logging
-import json
 import uuid
 import jsonschema
-import requests
+from urllib.parse import parse_qs
 from django.conf import settings
 
-from .notifier import notifier
+from .notifier import ClientQueue, notifier
+from .session_manager import DEFAULT_SESSION, is_valid_session_name
+from .schema_registry import SCHEMA_WS_RECEIVE, schema_registry
+from .binary_frames import decode_frame
+from . import json_codec
 
 logger = logging.getLogger('django.server')
 
-class ClientMessenger(WebsocketConsumer):
+# Runs entirely on the event loop, so idle clients don't each tie up a thread.
+# Anything slow (e.g. saving thumbnails) happens in actions registered with
+# notifier.add_action, which run in worker threads unless they're coroutines.
+class ClientMessenger(AsyncWebsocketConsumer):
     def __init__(self, *args, **kwargs):
-        resp = requests.get(settings.WS_SEND_SCHEMA)
-        if resp.status_code != 200:
-            logger.error('Unable to load schema from url {0}'.format(settings.WS_SEND_SCHEMA))
-            return
-        self.outgoing_schema = resp.json()
-
-        resp = requests.get(settings.WS_RECEIVE_SCHEMA)
-        if resp.status_code != 200:
-            logger.error('Unable to load schema from url {0}'.format(settings.WS_RECEIVE_SCHEMA))
-            return
-        self.incoming_schema = resp.json()
-
         self.id = None
+        self.session = None
+        self.queue = None
+        self.subscription = None
         super().__init__(*args, **kwargs)
 
-    def connect(self):
-        self.accept()
+    async def connect(self):
+        # Only hear about the state session this client is connected to
+        session = self.scope['url_route']['kwargs'].get('session', DEFAULT_SESSION)
+        if not is_valid_session_name(session):
+            logger.error('WebSocket client tried to connect to invalid session `{}`'.format(session))
+            await self.close()
+            return
+        await self.accept()
         logger.debug('WebSocket client connected')
-        self.id = notifier.subscribe_ws(self)
+        self.session = session
 
-    def disconnect(self, status):
-        logger.debug('WebSocket client disconnected: {}'.format(status))
-        notifier.unsubscribe_ws(self.id)
+        # Notifications wait in a bounded queue and go out at most
+        # NOTIFIER_MAX_CLIENT_RATE times per second
+        self.queue = ClientQueue(
+            settings.NOTIFIER_QUEUE_SIZE,
+            settings.NOTIFIER_OVERFLOW_POLICY,
+            settings.NOTIFIER_MAX_CLIENT_RATE,
+            notifier.encoder.encode,
+            self.send,
+            self.close,
+        )
 
-    def receive(self, text_data=None, bytes_data=None):
-        default_ret = super().receive(text_data=text_data, bytes_data=bytes_data)
+        # Clients can ask for only some targets and parts of the state, e.g.
+        # ?target=state&path=/impressions/<uuid>
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        self.id = await notifier.subscribe_ws(self, session, query.get('target'), query.get('path'))
 
-        if len(text_data) > 0:
+    async def disconnect(self, status):
+        logger.debug('WebSocket client disconnected: {}'.format(status))
+        if self.id is not None:
+            await notifier.unsubscribe_ws(self, self.session)
+            self.queue.cancel()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        # Binary frames skip JSON decoding and validation altogether, the
+        # header is all there is to check (see binary_frames.py)
+        if bytes_data:
+            try:
+                incoming = decode_frame(bytes_data)
+            except ValueError as e:
+                logger.error('Incoming binary WebSocket message is invalid: {}'.format(e))
+            else:
+                await notifier.receive(incoming, self.id)
+        elif text_data:
             try:
-                incoming_json = json.loads(text_data)
-                jsonschema.validate(incoming_json, self.incoming_schema)
-            except json.decoder.JSONDecodeError:
+                incoming_json = json_codec.loads(text_data)
+                validator = schema_registry.validator(SCHEMA_WS_RECEIVE)
+                if validator is not None:
+                    validator.validate(incoming_json)
+            except json_codec.DecodeError:
                 logger.error('Incoming WebSocket message is not JSON')
             except jsonschema.ValidationError as e:
                 logger.error('Incoming WebSocket JSON failed to validate: ' + str(e))
             else:
-                notifier.receive(incoming_json, self.id)
-
-        return default_ret
-
-    def send_json(self, msg_json):
-        try:
-            jsonschema.validate(msg_json, self.outgoing_schema)
-        except jsonschema.ValidationError as e:
-            logger.error('Outgoing WebSocket JSON failed to validate: ' + str(e))
-        else:
-            self.send(json.dumps(msg_json))
\ No newline at end of file
+                await notifier.receive(incoming_json, self.id)
@@ -18,77 +18,552 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import json
+import time
 import uuid
-from threading import Lock
+import random
+import asyncio
+import jsonschema
+from collections import deque
+from threading import Lock, Timer
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
 from django.conf import settings
 import logging
 from enum import Enum
 
+from . import json_codec
+from .subscriptions import Subscription, SubscriptionRouter
+
 logger = logging.getLogger('django.server')
 
 class MessageTarget(str, Enum):
     State = "state"
     VisAssetsCache = "CacheUpdate-visassets"
+    Thumbnail = "thumbnail"
+
+# Stands in for the patch of a message that's only been received as text; the
+# patch is decoded if it's needed
+_ENCODED_PATCH = object()
 
 class NotifierMessage:
-    def __init__(self, target):
+    def __init__(self, target, patch=None, revision=None, base_revision=None, session=None, text=None):
+        '''
+            `patch` is an optional list of JSON Patch operations that brings a
+            client at `base_revision` up to `revision`. Clients that are not at
+            `base_revision` (or messages without a patch) should fall back to
+            fetching the whole state.
+
+            `session` is the state session the message is about; only clients
+            connected to that session receive it. Messages without a session
+            (e.g. cache updates) go to everyone.
+
+            `text` is the message already encoded for clients, if it has been
+            (see FrameEncoder).
+        '''
         self.target = target
+        self._patch = patch
+        self.revision = revision
+        self.base_revision = base_revision
+        self.session = session
+        self.text = text
+
+    @property
+    def patch(self):
+        if self._patch is _ENCODED_PATCH:
+            self._patch = json_codec.loads(self.text)['patch']
+        return self._patch
 
     def to_json(self):
-        return {
+        msg = {
             '$schema': settings.WS_SEND_SCHEMA,
             'target': self.target
         }
+        if self.revision is not None:
+            msg['revision'] = self.revision
+        if self.patch is not None:
+            msg['baseRevision'] = self.base_revision
+            msg['patch'] = self.patch
+        return msg
+
+    @staticmethod
+    def from_json(msg):
+        '''
+            Rebuild a message from to_json()
+        '''
+        return NotifierMessage(msg['target'], msg.get('patch'), msg.get('revision'), msg.get('baseRevision'))
+
+    def to_event(self):
+        '''
+            Channel layer event for this message (after it's been encoded).
+            Only the encoded text and what's needed to merge messages are
+            sent, so every client shares the same text.
+        '''
+        return {
+            'type': 'notifier.message',
+            'target': self.target,
+            'revision': self.revision,
+            'baseRevision': self.base_revision,
+            'hasPatch': self._patch is not None,
+            'session': self.session,
+            'text': self.text,
+        }
+
+    @staticmethod
+    def from_event(event):
+        '''
+            Rebuild a message from to_event(), after it's been through the
+            channel layer
+        '''
+        patch = _ENCODED_PATCH if event['hasPatch'] else None
+        return NotifierMessage(event['target'], patch, event['revision'], event['baseRevision'], event['session'], event['text'])
+
+    def filtered(self, ops, base_revision):
+        '''
+            This message with only some of the operations in its patch,
+            applying on top of `base_revision`
+        '''
+        if len(ops) == len(self.patch) and base_revision == self.base_revision:
+            return self
+        return NotifierMessage(self.target, ops, self.revision, base_revision, self.session)
+
+    def merge(self, later):
+        '''
+            Combine this message with a `later` one for the same target, so
+            only one needs to be sent. Consecutive patches are concatenated; if
+            there's a gap (or either has no patch) clients will need to fetch
+            the whole state.
+        '''
+        if self.patch is not None and later.patch is not None and self.revision == later.base_revision:
+            return NotifierMessage(self.target, self.patch + later.patch, later.revision, self.base_revision, self.session)
+        return NotifierMessage(later.target, revision=later.revision, session=later.session)
 
     def __str__(self):
-        return json.dumps(self.to_json())
+        return json_codec.dumps_str(self.to_json())
+
+# How outgoing messages are checked against the WebSocket send schema
+VALIDATE_STRICT = 'strict'
+VALIDATE_SAMPLED = 'sampled'
+VALIDATE_OFF = 'off'
+VALIDATION_MODES = (VALIDATE_STRICT, VALIDATE_SAMPLED, VALIDATE_OFF)
+
+class FrameEncoder:
+    '''
+        Validates and encodes messages for WebSocket clients. A broadcast is
+        encoded once, before it's handed to the channel layer, and the text is
+        shared by every client that receives it; only messages merged for a
+        particular client are encoded again.
+
+        `mode` is VALIDATE_STRICT (validate every message), VALIDATE_SAMPLED
+        (validate a random `sample_rate` fraction of them) or VALIDATE_OFF.
+        Messages that fail validation are not sent.
+    '''
+    def __init__(self, mode, sample_rate):
+        if mode not in VALIDATION_MODES:
+            raise ValueError('Unknown validation mode `{}`'.format(mode))
+        self.mode = mode
+        self.sample_rate = sample_rate
+
+        self._lock = Lock()
+        self.encoded = 0
+        self.validated = 0
+        self.invalid = 0
+
+    def _should_validate(self):
+        if self.mode == VALIDATE_STRICT:
+            return True
+        elif self.mode == VALIDATE_SAMPLED:
+            return random.random() < self.sample_rate
+        return False
+
+    def _validator(self):
+        # Imported here because this module is loaded (through
+        # abr_server/__init__.py) while the settings are still being loaded,
+        # before the schemas can be
+        from .schema_registry import SCHEMA_WS_SEND, schema_registry
+        return schema_registry.validator(SCHEMA_WS_SEND)
+
+    def encode(self, message):
+        '''
+            Text to send clients for `message`, or None if it isn't valid.
+            Text that's already been encoded is reused.
+        '''
+        if message.text is not None:
+            return message.text
+
+        msg_json = message.to_json()
+        validator = self._validator() if self._should_validate() else None
+        if validator is not None:
+            try:
+                validator.validate(msg_json)
+            except jsonschema.ValidationError as e:
+                logger.error('Outgoing WebSocket JSON failed to validate: ' + str(e))
+                with self._lock:
+                    self.validated += 1
+                    self.invalid += 1
+                return None
+
+        message.text = json_codec.dumps_str(msg_json)
+        with self._lock:
+            self.encoded += 1
+            if validator is not None:
+                self.validated += 1
+        return message.text
+
+    def metrics(self):
+        with self._lock:
+            return {
+                'validation': self.mode,
+                'encoded': self.encoded,
+                'validated': self.validated,
+                'invalid': self.invalid,
+            }
+
+def _log_send_error(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error('Unable to send notification: {}'.format(future.exception()))
+
+# What a ClientQueue does when it's full
+OVERFLOW_COALESCE = 'coalesce'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_DISCONNECT = 'disconnect'
+OVERFLOW_POLICIES = (OVERFLOW_COALESCE, OVERFLOW_DROP_OLDEST, OVERFLOW_DISCONNECT)
+
+def _merge_by_target(messages):
+    merged = {}
+    for message in messages:
+        pending = merged.get(message.target)
+        merged[message.target] = message if pending is None else pending.merge(message)
+    return list(merged.values())
+
+def _running_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+class ClientQueue:
+    '''
+        Bounded queue of messages waiting to go out to one WebSocket client.
+        The queue is drained by a task on the event loop, so whoever offers a
+        message never waits on the client.
+
+        Clients are sent at most `max_rate` batches of messages per second;
+        messages that pile up in between are merged by target. If more than
+        `max_size` messages pile up anyway (the client can't keep up),
+        `policy` decides what happens:
+
+        - OVERFLOW_COALESCE: merge everything waiting by target
+        - OVERFLOW_DROP_OLDEST: forget the oldest message
+        - OVERFLOW_DISCONNECT: give up on the client and call `close`
+
+        `encode` turns a message into the text to send (or None to skip it),
+        and `send` and `close` are coroutine functions that send that text and
+        disconnect the client. Must be created and offered messages on the
+        event loop.
+    '''
+    def __init__(self, max_size, policy, max_rate, encode, send, close):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy `{}`'.format(policy))
+        self.max_size = max(max_size, 1)
+        self.policy = policy
+        self.min_interval = 1.0 / max_rate if max_rate > 0 else 0.0
+        self._encode = encode
+        self._send = send
+        self._close = close
+        self._loop = asyncio.get_event_loop()
+
+        # Only used on the event loop, but metrics are read from other threads
+        self._lock = Lock()
+        self.messages = deque()
+        self.draining = False
+        self.closed = False
+        self.last_sent = 0.0
+
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+
+    def offer(self, message):
+        overflowed = False
+        with self._lock:
+            if self.closed:
+                return
+            if len(self.messages) >= self.max_size:
+                if self.policy == OVERFLOW_DISCONNECT:
+                    overflowed = True
+                    self.closed = True
+                    self.dropped += len(self.messages) + 1
+                    self.messages.clear()
+                elif self.policy == OVERFLOW_DROP_OLDEST:
+                    self.messages.popleft()
+                    self.dropped += 1
+                else:
+                    merged = _merge_by_target(self.messages)
+                    self.coalesced += len(self.messages) - len(merged)
+                    self.messages = deque(merged)
+                    # Can't fold any further, make room
+                    if len(self.messages) >= self.max_size:
+                        self.messages.popleft()
+                        self.dropped += 1
+            if not overflowed:
+                self.messages.append(message)
+                self.max_depth = max(self.max_depth, len(self.messages))
+            start = not self.closed and not self.draining
+            if start:
+                self.draining = True
+
+        if overflowed:
+            logger.warning('WebSocket client fell more than {} messages behind, disconnecting'.format(self.max_size))
+            self._loop.create_task(self._close()).add_done_callback(_log_send_error)
+        elif start:
+            self._loop.create_task(self._drain()).add_done_callback(_log_send_error)
+
+    async def _drain(self):
+        try:
+            while True:
+                # Sent something to this client too recently; let messages
+                # pile up (and get merged) until it's time again
+                wait = self.last_sent + self.min_interval - time.time()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+
+                with self._lock:
+                    if self.closed or len(self.messages) == 0:
+                        self.draining = False
+                        return
+                    messages = list(self.messages)
+                    self.messages.clear()
+                    self.last_sent = time.time()
+
+                # Counters are read by metrics() from other threads, so they're
+                # only changed with the lock held
+                if self.min_interval > 0:
+                    merged = _merge_by_target(messages)
+                    with self._lock:
+                        self.coalesced += len(messages) - len(merged)
+                    messages = merged
+                for message in messages:
+                    text = self._encode(message)
+                    if text is not None:
+                        await self._send(text)
+                        with self._lock:
+                            self.sent += 1
+        except BaseException:
+            with self._lock:
+                self.draining = False
+            raise
+
+    def cancel(self):
+        with self._lock:
+            self.closed = True
+            self.messages.clear()
+
+    def metrics(self):
+        with self._lock:
+            return {
+                'queued': len(self.messages),
+                'maxQueued': self.max_depth,
+                'maxSize': self.max_size,
+                'policy': self.policy,
+                'sent': self.sent,
+                'dropped': self.dropped,
+                'coalesced': self.coalesced,
+            }
+
+# Channels groups that notifications are sent to. Each worker is in the group
+# for everyone, and in the group for every state session it has clients for.
+ALL_CLIENTS_GROUP = 'abr-clients'
+
+def session_group(session):
+    return 'abr-session-' + session
+
+def _session_revision(session):
+    # Imported here because the state (and so the session manager) imports
+    # this module
+    from .session_manager import sessions
+    with sessions.use(session) as state:
+        return state.get_revision()
 
 class StateNotifier:
+    '''
+        Sends notifications to WebSocket clients through the Channels layer,
+        so clients connected to any worker hear about changes made on any
+        other (as long as the layer is shared between them, e.g. Redis)
+    '''
     def __init__(self):
-        self._connection_lock = Lock()
-        self.ws_connections = {}
-
         # Dictionary of routes for {target -> {uuid1: fn, uuid2: fn, uuid3: fn}}
         # For example: {'thumbnail': [<function that saves a png>]}
         self.targets = {}
 
+        # Messages for the same target (and session) that arrive within
+        # coalesce_window seconds of each other are merged. The first one goes
+        # out right away and whatever has piled up goes out when the window
+        # closes.
+        self.coalesce_window = settings.NOTIFIER_COALESCE_WINDOW
+        self._coalesce_lock = Lock()
+        self._open_windows = set()
+        self._pending = {}
+
+        # Each message is validated and encoded once for all clients
+        self.encoder = FrameEncoder(settings.NOTIFIER_VALIDATION, settings.NOTIFIER_VALIDATION_SAMPLE_RATE)
+
+        # Event loop the WebSocket consumers run on. The in-memory channel
+        # layer may only be used from that loop.
+        self._loop = None
 
-    def subscribe_ws(self, ws):
+        # Each worker has one channel in the groups above, and hands what
+        # comes in on it to the right clients (see subscriptions.py). Only
+        # used on the event loop.
+        self._channel = None
+        self._router = SubscriptionRouter()
+
+        # WebSocket consumers connected to this worker, {channel name ->
+        # (session, consumer)}
+        self._clients_lock = Lock()
+        self._clients = {}
+
+    async def subscribe_ws(self, ws, session=None, targets=None, paths=None):
+        '''
+            Start sending messages to a WebSocket consumer (through its
+            queue), for its state session. `targets` and `paths` (JSON
+            Pointers) limit which messages it gets; see subscriptions.py.
+        '''
         sub_id = uuid.uuid4()
-        with self._connection_lock:
-            self.ws_connections[str(sub_id)] = ws
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        if self._channel is None:
+            self._channel = await ws.channel_layer.new_channel('abr-notifier.')
+            await ws.channel_layer.group_add(ALL_CLIENTS_GROUP, self._channel)
+            self._loop.create_task(self._dispatch_loop(ws.channel_layer, self._channel)).add_done_callback(_log_send_error)
+
+        ws.subscription = Subscription(ws, session, targets, paths)
+        if paths is not None and session is not None:
+            # Path subscribers' first patch is based on whatever revision
+            # the session is at now, not None
+            ws.subscription.revision = await sync_to_async(_session_revision)(session)
+        self._router.add(ws.subscription)
+        if session is not None and self._router.session_count(session) == 1:
+            await ws.channel_layer.group_add(session_group(session), self._channel)
+        with self._clients_lock:
+            self._clients[ws.channel_name] = (session, ws)
         logger.debug('Subscribed notifier WebSocket')
         return sub_id
 
-    def unsubscribe_ws(self, sub_id):
-        with self._connection_lock:
-            if str(sub_id) in self.ws_connections:
-                del self.ws_connections[str(sub_id)]
+    async def unsubscribe_ws(self, ws, session=None):
+        with self._clients_lock:
+            self._clients.pop(ws.channel_name, None)
+        self._router.remove(ws.subscription)
+        if session is not None and self._router.session_count(session) == 0:
+            await ws.channel_layer.group_discard(session_group(session), self._channel)
         logger.debug('Unsubscribed notifier WebSocket')
 
+    async def _dispatch_loop(self, channel_layer, channel):
+        while True:
+            event = await channel_layer.receive(channel)
+            try:
+                message = NotifierMessage.from_event(event)
+                for sub, sub_message in self._router.route(message):
+                    sub.client.queue.offer(sub_message)
+            except Exception as e:
+                logger.error('Unable to deliver notification: {}'.format(e))
+
     def notify(self, message):
         '''
-            Send out a message to all connected parties on WebSocket
+            Send out a message to all connected parties on WebSocket. Never
+            waits for the message to go out, so it's safe to call from any
+            thread, including the event loop.
+        '''
+        if self.coalesce_window <= 0:
+            self._send(message)
+            return
+
+        key = (message.session, message.target)
+        with self._coalesce_lock:
+            # Inside a window, hold on to the message until the window closes
+            if key in self._open_windows:
+                pending = self._pending.get(key)
+                self._pending[key] = message if pending is None else pending.merge(message)
+                return
+            self._open_window(key)
+        self._send(message)
+
+    def _open_window(self, key):
+        # Must be called while holding the coalesce lock
+        self._open_windows.add(key)
+        timer = Timer(self.coalesce_window, self._close_window, args=(key,))
+        timer.daemon = True
+        timer.start()
+
+    def _close_window(self, key):
+        with self._coalesce_lock:
+            message = self._pending.pop(key, None)
+            if message is None:
+                self._open_windows.discard(key)
+                return
+            # Keep the window open while messages keep coming
+            self._open_window(key)
+        self._send(message)
+
+    def _send(self, message):
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return
+        if self.encoder.encode(message) is None:
+            return
+        group = ALL_CLIENTS_GROUP if message.session is None else session_group(message.session)
+        # Each worker hands this to its clients in _dispatch_loop()
+        event = message.to_event()
+        running_loop = _running_loop()
+        if running_loop is not None:
+            running_loop.create_task(channel_layer.group_send(group, event)).add_done_callback(_log_send_error)
+        elif self._loop is not None:
+            # Don't wait for it to go out, this may be called with the state
+            # locked
+            future = asyncio.run_coroutine_threadsafe(channel_layer.group_send(group, event), self._loop)
+            future.add_done_callback(_log_send_error)
+        else:
+            # No clients have connected to this worker, but there may be some
+            # connected to others
+            async_to_sync(channel_layer.group_send)(group, event)
+
+    def metrics(self, session=None):
+        '''
+            Outbound queue metrics for each client connected to this worker
+            (only those connected to `session`, if given)
         '''
-        for _id, ws in self.ws_connections.items():
-            ws.send_json(message.to_json())
+        with self._clients_lock:
+            clients = list(self._clients.values())
+        return [
+            dict(ws.queue.metrics(), id=str(ws.id), session=client_session, subscription=ws.subscription.to_json())
+            for client_session, ws in clients
+            if (session is None or client_session == session) and getattr(ws, 'queue', None) is not None
+        ]
 
-    def receive(self, incoming_json, ws_id):
+    async def receive(self, incoming_json, ws_id):
         '''Receive a message from a connected WebSocket'''
-        # Perform all actions assocated with this particular route
+        # Perform all actions assocated with this particular route. Copy them
+        # first, actions may be added or removed while we wait on one.
         route = incoming_json['target']
         if route in self.targets:
-            for (_action_id, action) in self.targets[route].items():
-                action(incoming_json, ws_id)
+            for action in list(self.targets[route].values()):
+                try:
+                    if asyncio.iscoroutinefunction(action):
+                        await action(incoming_json, ws_id)
+                    else:
+                        await sync_to_async(action)(incoming_json, ws_id)
+                except Exception as e:
+                    logger.error('WebSocket action for route `{}` failed: {}'.format(route, e))
         else:
             logger.error('Incoming WebSocket route `{}` does not exist'.format(route))
 
     def add_action(self, target_route, action_fn):
         '''Add an action to be performed when `target_route` receives a payload
         over the WebSocket. `action_fn` should take two arguments: the
-        received message and the sender's ID.  Returns a new UUID associated
-        with this action, can be used to remove from actions'''
+        received message and the sender's ID. It may be a coroutine function,
+        which is awaited on the event loop; plain functions are run in a
+        worker thread so they can't hold up other clients. Returns a new UUID
+        associated with this action, can be used to remove from actions'''
         action_id = uuid.uuid4()
         target_actions = self.targets.get(target_route, {})
         target_actions[action_id] = action_fn
@@ -0,0 +1,80 @@
+# response_cache.py
+#
+# Cache of serialized state responses, so that when many clients ask for the
+# state after the same change it's only serialized once.
+#
+# Copyright (c) 2021, University of Minnesota
+# Author: Bridger Herman <herma582@umn.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+from threading import Lock
+
+class ResponseCache:
+    def __init__(self, max_entries=64):
+        '''
+            Holds serialized responses for the latest revision of the state
+            only, keyed by path. The least recently used paths are dropped
+            once there are more than `max_entries`.
+        '''
+        self.max_entries = max_entries
+        self._lock = Lock()
+        self._revision = None
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, revision, key, build):
+        '''
+            Get the cached response for `key` at `revision`, calling `build()`
+            to make it if it's not there yet
+        '''
+        with self._lock:
+            # A newer revision makes everything in here out of date
+            if self._revision is None or revision > self._revision:
+                self._revision = revision
+                self._entries.clear()
+
+            # Readers that grabbed an older revision just before a change
+            # don't get cached
+            if revision < self._revision:
+                self.misses += 1
+                return build()
+
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data
+
+            # Build while holding the lock, so clients that all ask for the
+            # same thing at once wait for one copy instead of each making
+            # their own
+            self.misses += 1
+            data = build()
+            self._entries[key] = data
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return data
+
+    def to_json(self):
+        with self._lock:
+            return {
+                'revision': self._revision,
+                'entries': len(self._entries),
+                'bytes': sum(len(d) for d in self._entries.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
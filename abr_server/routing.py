@@ -7,6 +7,7 @@ application = ProtocolTypeRouter({
     'websocket': AuthMiddlewareStack(
         URLRouter([
             path('ws/', ClientMessenger),
+            path('ws/s/<str:session>/', ClientMessenger),
         ])
     )
 })
\ No newline at end of file
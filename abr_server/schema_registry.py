@@ -0,0 +1,188 @@
+# schema_registry.py
+#
+# The JSON schemas the server uses (the ABR state schema and the WebSocket
+# send/receive schemas), loaded once and shared. Cached copies in
+# static/schemas are used right away so nothing waits on the network; the
+# schemas are then refreshed from their URLs in the background.
+#
+# Copyright (c) 2021, University of Minnesota
+# Author: Bridger Herman <herma582@umn.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import time
+import logging
+import requests
+import jsonschema
+from pathlib import Path
+from threading import Lock, Thread
+from urllib.parse import urlparse
+from django.conf import settings
+
+from . import json_codec
+from .schema_validation import StateValidator
+
+logger = logging.getLogger('django.server')
+
+SCHEMA_STATE = 'abr'
+SCHEMA_WS_SEND = 'notifier_send'
+SCHEMA_WS_RECEIVE = 'notifier_receive'
+
+class SchemaRegistry:
+    def __init__(self, urls, cache_dir, refresh_interval=0, timeout=10):
+        '''
+            `urls` is a dictionary of {name: url} for each schema. Cached
+            copies are kept in `cache_dir`. If `refresh_interval` is more than
+            0, the schemas are checked for updates that often (in seconds);
+            otherwise only once at startup.
+        '''
+        self.urls = urls
+        self.cache_dir = Path(cache_dir)
+        self.refresh_interval = refresh_interval
+        self.timeout = timeout
+
+        self._lock = Lock()
+        self._schemas = {}
+        self._validators = {}
+
+        # Called with (name, schema, validator) whenever a schema changes
+        self._listeners = []
+
+        missing = []
+        for name in self.urls:
+            schema = self._load_cached(name)
+            if schema is not None:
+                self._set(name, schema)
+            else:
+                missing.append(name)
+
+        # Nothing to fall back on, these ones have to be fetched before
+        # anything can use them
+        for name in missing:
+            self.refresh(name)
+
+        self._thread = Thread(target=self._refresh_loop, args=(set(self.urls) - set(missing),), name='abr-schema-refresh', daemon=True)
+        self._thread.start()
+
+    def get(self, name):
+        '''
+            The schema called `name`, or None if it couldn't be loaded
+        '''
+        with self._lock:
+            return self._schemas.get(name)
+
+    def validator(self, name):
+        '''
+            Compiled (and shared) StateValidator for the schema called `name`,
+            or None if it couldn't be loaded
+        '''
+        with self._lock:
+            return self._validators.get(name)
+
+    def on_update(self, fn):
+        '''
+            Call `fn(name, schema, validator)` whenever a schema is updated
+            after startup
+        '''
+        self._listeners.append(fn)
+
+    def cache_path(self, name):
+        # Named after the file in the URL, e.g. ABRSchema_0-2-0.json
+        return self.cache_dir.joinpath(os.path.basename(urlparse(self.urls[name]).path))
+
+    def _load_cached(self, name):
+        path = self.cache_path(name)
+        if not path.exists() and name == SCHEMA_STATE and self.cache_dir.exists():
+            # Older servers saved timestamped copies of the state schema
+            backups = sorted(self.cache_dir.glob('[0-9]*.json'), reverse=True)
+            path = backups[0] if len(backups) > 0 else path
+        try:
+            with open(path, 'rb') as fin:
+                schema = json_codec.loads(fin.read())
+            logger.info('Using cached schema {}'.format(path))
+            return schema
+        except FileNotFoundError:
+            return None
+        except json_codec.DecodeError:
+            logger.error('Cached schema {} is not valid JSON'.format(path))
+            return None
+
+    def _set(self, name, schema):
+        try:
+            validator = StateValidator(schema)
+        except jsonschema.SchemaError as e:
+            logger.error('Schema `{}` is invalid: {}'.format(name, e.message))
+            return False
+        with self._lock:
+            self._schemas[name] = schema
+            self._validators[name] = validator
+        return True
+
+    def refresh(self, name):
+        '''
+            Fetch the latest copy of a schema, and save it to the cache if it
+            has changed. Returns whether the schema changed.
+        '''
+        url = self.urls[name]
+        try:
+            resp = requests.get(url, timeout=self.timeout)
+        except requests.RequestException as e:
+            logger.error('Unable to load schema from url {0}: {1}'.format(url, e))
+            return False
+        if resp.status_code != 200:
+            logger.error('Unable to load schema from url {0}'.format(url))
+            return False
+
+        try:
+            schema = json_codec.loads(resp.content)
+        except json_codec.DecodeError:
+            logger.error('Schema from url {0} is not valid JSON'.format(url))
+            return False
+        if schema == self.get(name) or not self._set(name, schema):
+            return False
+
+        # Write to a temporary file first so there's never a half-written
+        # schema in the cache
+        path = self.cache_path(name)
+        tmp_path = path.with_suffix('.tmp')
+        try:
+            if not self.cache_dir.exists():
+                os.makedirs(self.cache_dir)
+            with open(tmp_path, 'wb') as fout:
+                fout.write(resp.content)
+            os.replace(tmp_path, path)
+            logger.info('Saved backup schema to ' + str(path))
+        except OSError as e:
+            logger.error('Unable to save schema to {}: {}'.format(path, e))
+        return True
+
+    def _refresh_loop(self, names):
+        while True:
+            for name in names:
+                if self.refresh(name):
+                    logger.info('Updated schema `{}` from {}'.format(name, self.urls[name]))
+                    schema, validator = self.get(name), self.validator(name)
+                    for fn in self._listeners:
+                        fn(name, schema, validator)
+            if self.refresh_interval <= 0:
+                return
+            time.sleep(self.refresh_interval)
+            names = self.urls.keys()
+
+schema_registry = SchemaRegistry({
+    SCHEMA_STATE: settings.SCHEMA_URL,
+    SCHEMA_WS_SEND: settings.WS_SEND_SCHEMA,
+    SCHEMA_WS_RECEIVE: settings.WS_RECEIVE_SCHEMA,
+}, os.path.join(settings.STATIC_ROOT, 'schemas'), settings.SCHEMA_REFRESH_INTERVAL)
@@ -0,0 +1,165 @@
+# schema_validation.py
+#
+# Compiled, subtree-scoped validation of the ABR state against the ABR schema.
+# Rather than re-validating the entire state on every edit, each changed path
+# is matched up with the part of the schema that governs it and only that
+# subtree is validated.
+#
+# Copyright (c) 2021, University of Minnesota
+# Author: Bridger Herman <herma582@umn.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import re
+import jsonschema
+from threading import Lock
+
+from .json_patch import parts_from_pointer
+
+# Schema keywords that make the schema of a child depend on more than just its
+# key, so we can't descend past them and validate the whole object instead
+OPAQUE_KEYWORDS = ('allOf', 'anyOf', 'oneOf', 'not', 'if', 'then', 'else', 'const', 'enum')
+
+# Keywords that constrain which keys an object has. Adding or removing a key
+# can break these, so the object itself needs to be validated.
+ADD_KEY_KEYWORDS = ('propertyNames', 'maxProperties', 'dependencies')
+REMOVE_KEY_KEYWORDS = ('minProperties', 'dependencies')
+
+# Schema for children that can be anything
+ANY_SCHEMA = {}
+
+class StateValidator:
+    def __init__(self, schema):
+        validator_cls = jsonschema.validators.validator_for(schema)
+        validator_cls.check_schema(schema)
+
+        self.schema = schema
+        self._validator_cls = validator_cls
+        self._root_validator = validator_cls(schema)
+
+        # Compiled validators for sub-schemas, keyed by the id() of the
+        # sub-schema dict (the schema is never modified so ids are stable)
+        self._sub_validators = {}
+
+        # The $ref resolver keeps a scope stack while validating, so it can't
+        # be used from more than one thread at once
+        self._lock = Lock()
+
+    def validate(self, instance, path_parts=(), schema=None):
+        '''
+            Validate `instance` against `schema` (or the whole ABR schema).
+            `path_parts` is where `instance` lives in the state, used to make
+            error paths absolute. Raises a jsonschema.ValidationError.
+        '''
+        with self._lock:
+            validator = self._root_validator if schema is None else self._get_validator(schema)
+            error = jsonschema.exceptions.best_match(validator.iter_errors(instance))
+        if error is not None:
+            error.relative_path.extendleft(reversed(path_parts))
+            raise error
+
+    def validate_patch(self, new_state, patch):
+        '''
+            Validate the parts of `new_state` touched by `patch` (a list of
+            JSON Patch operations that produced `new_state`)
+        '''
+        validated = set()
+        for op in patch:
+            path_parts = parts_from_pointer(op['path'])
+            depth, schema = self.locate(path_parts, op['op'])
+
+            # A removed leaf with no constraints on its parent has nothing left
+            # to validate
+            if depth == len(path_parts) and op['op'] == 'remove':
+                continue
+
+            # Don't validate the same subtree twice for a patch with lots of
+            # operations under a common ancestor
+            subtree_path = tuple(path_parts[:depth])
+            if subtree_path in validated:
+                continue
+            validated.add(subtree_path)
+
+            instance = new_state
+            for part in subtree_path:
+                instance = instance[part]
+            self.validate(instance, subtree_path, None if depth == 0 else schema)
+
+    def locate(self, path_parts, op='replace'):
+        '''
+            Find the deepest ancestor of `path_parts` whose schema can be
+            determined from keys alone. Returns the depth of that ancestor in
+            `path_parts` and its sub-schema.
+        '''
+        depth = 0
+        schema = self.schema
+        last = len(path_parts) - 1
+        for i, key in enumerate(path_parts):
+            schema_obj = self._resolve(schema)
+            if schema_obj is None or any(k in schema_obj for k in OPAQUE_KEYWORDS):
+                break
+
+            # Changing the set of keys on the parent might break its constraints
+            if i == last and op == 'add' and any(k in schema_obj for k in ADD_KEY_KEYWORDS):
+                break
+            if i == last and op == 'remove' and (any(k in schema_obj for k in REMOVE_KEY_KEYWORDS) or \
+                    key in schema_obj.get('required', [])):
+                break
+
+            child_schema = self._child_schema(schema_obj, key)
+            if child_schema is None:
+                break
+            depth = i + 1
+            schema = child_schema
+        return (depth, schema)
+
+    def _resolve(self, schema):
+        # Follow local $refs so we can see what's inside
+        if schema is True:
+            return ANY_SCHEMA
+        if not isinstance(schema, dict):
+            return None
+        while '$ref' in schema:
+            ref = schema['$ref']
+            if not ref.startswith('#') or len(schema) > 1:
+                return None
+            _url, schema = self._root_validator.resolver.resolve(ref)
+        return schema
+
+    def _child_schema(self, schema_obj, key):
+        applicable = []
+        if key in schema_obj.get('properties', {}):
+            applicable.append(schema_obj['properties'][key])
+        for pattern, pattern_schema in schema_obj.get('patternProperties', {}).items():
+            if re.search(pattern, key):
+                applicable.append(pattern_schema)
+
+        if len(applicable) == 0:
+            additional = schema_obj.get('additionalProperties', True)
+            # Key isn't allowed here; validate the parent so the error says so
+            if additional is False:
+                return None
+            return ANY_SCHEMA if additional is True else additional
+        elif len(applicable) == 1:
+            return applicable[0]
+        else:
+            return None
+
+    def _get_validator(self, schema):
+        schema_id = id(schema)
+        validator = self._sub_validators.get(schema_id)
+        if validator is None:
+            validator = self._validator_cls(schema, resolver=self._root_validator.resolver)
+            self._sub_validators[schema_id] = validator
+        return validator
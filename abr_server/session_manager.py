@@ -0,0 +1,208 @@
+# session_manager.py
+#
+# Named state sessions, so one server can host several compositions at once.
+# Each session has its own State (and so its own lock, undo history, store,
+# and group of WebSocket clients). Sessions that haven't been used in a while
+# are written out to disk and dropped from memory, then reloaded the next time
+# they're asked for.
+#
+# Copyright (c) 2021, University of Minnesota
+# Author: Bridger Herman <herma582@umn.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import re
+import time
+import logging
+from contextlib import contextmanager
+from threading import Lock, Thread
+from django.conf import settings
+
+from .schema_registry import SCHEMA_STATE, schema_registry
+from .state import State
+from .state_store import open_store, stored_sessions
+
+logger = logging.getLogger('django.server')
+
+# The session served at /api/state etc. (without /s/<session>/)
+DEFAULT_SESSION = 'default'
+
+# Session names end up in URLs and backup file names
+SESSION_NAME = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+def is_valid_session_name(name):
+    return SESSION_NAME.match(name) is not None
+
+class SessionManager:
+    def __init__(self):
+        # All sessions share one schema, compiled once (see _start())
+        self.state_schema = None
+        self.validator = None
+
+        self.idle_timeout = settings.SESSION_IDLE_TIMEOUT
+        self.max_loaded = settings.SESSION_MAX_LOADED
+
+        # Lock around loading/evicting sessions
+        self._lock = Lock()
+        self._sessions = {}
+        self._last_used = {}
+        # Number of requests currently using each session; sessions in use are
+        # never evicted
+        self._in_use = {}
+
+        # Nothing is loaded until a session is first used, so importing this
+        # (e.g. the views, for a management command) doesn't touch the backups
+        self._started = False
+
+    def _start(self):
+        # Must be called while holding the lock
+        if self._started:
+            return
+        schema_registry.on_update(self._schema_updated)
+        self.state_schema = schema_registry.get(SCHEMA_STATE)
+        self.validator = schema_registry.validator(SCHEMA_STATE)
+        if self.state_schema is None:
+            raise RuntimeError('No ABR schema available from {} or the cache'.format(settings.SCHEMA_URL))
+        logger.info('Using ABR Schema, version {}'.format(self.state_schema['properties']['version']['default']))
+
+        # The default session is always loaded
+        self._load(DEFAULT_SESSION)
+
+        if self.idle_timeout > 0:
+            self._thread = Thread(target=self._evict_idle_loop, name='abr-session-eviction', daemon=True)
+            self._thread.start()
+        self._started = True
+
+    def _schema_updated(self, name, schema, validator):
+        # The state schema was refreshed in the background
+        if name != SCHEMA_STATE:
+            return
+        with self._lock:
+            self.state_schema = schema
+            self.validator = validator
+            for state in self._sessions.values():
+                state.set_schema(schema, validator)
+        logger.info('Using ABR Schema, version {}'.format(schema['properties']['version']['default']))
+
+    def backup_path(self, name):
+        if name == DEFAULT_SESSION:
+            return settings.BACKUP_PATH.resolve()
+        return settings.SESSION_BACKUP_PATH.joinpath(name + '.json').resolve()
+
+    @contextmanager
+    def use(self, name):
+        '''
+            Use the State for session `name`, loading it from disk (or creating
+            it) if it isn't already in memory. The State won't be evicted until
+            the `with` block is done:
+
+                with sessions.use('wall') as state:
+                    state.set_path(...)
+        '''
+        if not is_valid_session_name(name):
+            raise ValueError('Invalid session name `{}`'.format(name))
+
+        with self._lock:
+            self._start()
+            state = self._sessions.get(name)
+            if state is None:
+                state = self._load(name)
+            self._in_use[name] = self._in_use.get(name, 0) + 1
+            self._last_used[name] = time.time()
+            self._evict_over_limit()
+        try:
+            yield state
+        finally:
+            with self._lock:
+                self._in_use[name] -= 1
+                self._last_used[name] = time.time()
+
+    def _load(self, name):
+        # Must be called while holding the lock
+        start = time.time()
+        state = State(
+            name,
+            self.state_schema,
+            self.validator,
+            open_store(name, self.backup_path(name)),
+            restore=settings.BACKUP_RESTORE or name != DEFAULT_SESSION,
+        )
+        self._sessions[name] = state
+        self._in_use[name] = 0
+        self._last_used[name] = time.time()
+        logger.info('Loaded state session `{}` at revision {} ({:.3f}s)'.format(name, state.revision, time.time() - start))
+        return state
+
+    def _evict(self, name):
+        # Must be called while holding the lock
+        state = self._sessions.pop(name)
+        del self._in_use[name]
+        del self._last_used[name]
+        state.close()
+        logger.info('Evicted idle state session `{}` at revision {}'.format(name, state.revision))
+
+    def _evictable(self):
+        # Sessions that could be evicted, least recently used first
+        return sorted(
+            (name for name in self._sessions if name != DEFAULT_SESSION and self._in_use[name] == 0),
+            key=lambda name: self._last_used[name],
+        )
+
+    def _evict_over_limit(self):
+        # Must be called while holding the lock
+        if self.max_loaded <= 0:
+            return
+        for name in self._evictable():
+            if len(self._sessions) <= self.max_loaded:
+                break
+            self._evict(name)
+
+    def evict_idle(self):
+        '''
+            Evict every session that hasn't been used in idle_timeout seconds
+        '''
+        with self._lock:
+            now = time.time()
+            for name in self._evictable():
+                if now - self._last_used[name] > self.idle_timeout:
+                    self._evict(name)
+
+    def _evict_idle_loop(self):
+        while True:
+            time.sleep(min(self.idle_timeout / 4, 60))
+            try:
+                self.evict_idle()
+            except Exception as e:
+                logger.error('Unable to evict idle sessions: {}'.format(e))
+
+    def to_json(self):
+        '''
+            All sessions, both in memory and on disk
+        '''
+        with self._lock:
+            self._start()
+            sessions = {
+                name: {
+                    'loaded': True,
+                    'revision': state.revision,
+                    'idleSeconds': time.time() - self._last_used[name],
+                }
+                for name, state in self._sessions.items()
+            }
+        for name in stored_sessions():
+            if name not in sessions and is_valid_session_name(name):
+                sessions[name] = {'loaded': False}
+        return sessions
+
+sessions = SessionManager()
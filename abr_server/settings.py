@@ -36,6 +36,7 @@ ALLOWED_HOSTS = ['*']
 # Application definition
 
 INSTALLED_APPS = [
+    'api',
     'channels',
     'django.contrib.admin',
     'django.contrib.auth',
@@ -180,6 +181,37 @@ if not VISASSET_PATH.exists():
 if not THUMBNAILS_PATH.exists():
     THUMBNAILS_PATH.mkdir()
 
+# Histograms etc. computed from KeyData are cached, up to this many bytes. The
+# KEYDATA_MAX_OPEN most recently used KeyData files are kept memory-mapped.
+KEYDATA_CACHE_BYTES = config.getint('KeyData', 'cache_bytes', fallback=32*1024*1024)
+KEYDATA_MAX_OPEN = config.getint('KeyData', 'max_open', fallback=32)
+
+# Histograms at each of these numbers of bins (and summary statistics) are
+# precomputed for every KeyData variable, by `manage.py precompute_keydata` or
+# in the background the first time a KeyData without them is used
+KEYDATA_HISTOGRAM_BINS = [int(b) for b in config.get('KeyData', 'histogram_bins', fallback='64, 540, 2048').split(',') if b.strip()]
+KEYDATA_BUILD_SIDECARS = config.getboolean('KeyData', 'build_sidecars', fallback=True)
+
+# Number of bins in a histogram if a request doesn't say, and the most a
+# request may ask for
+KEYDATA_DEFAULT_HISTOGRAM_BINS = config.getint('KeyData', 'default_histogram_bins', fallback=540)
+KEYDATA_MAX_HISTOGRAM_BINS = config.getint('KeyData', 'max_histogram_bins', fallback=65536)
+
+# Worker processes computing histograms that aren't in a sidecar (and the
+# threads handing batch requests, /api/histograms, out to them)
+KEYDATA_WORKERS = config.getint('KeyData', 'workers', fallback=os.cpu_count())
+
+# Thumbnails from the engine are scaled down to each of these widths (and
+# saved as THUMBNAIL_FORMAT), by THUMBNAIL_WORKERS threads. The last
+# THUMBNAIL_HISTORY thumbnails from each of the THUMBNAIL_MAX_SENDERS engines
+# that sent one most recently are kept.
+THUMBNAIL_WIDTHS = [int(w) for w in config.get('Thumbnails', 'widths', fallback='256, 512').split(',') if w.strip()]
+THUMBNAIL_FORMAT = config.get('Thumbnails', 'format', fallback='webp').upper()
+THUMBNAIL_QUALITY = config.getint('Thumbnails', 'quality', fallback=80)
+THUMBNAIL_WORKERS = config.getint('Thumbnails', 'workers', fallback=2)
+THUMBNAIL_HISTORY = config.getint('Thumbnails', 'history', fallback=8)
+THUMBNAIL_MAX_SENDERS = config.getint('Thumbnails', 'max_senders', fallback=4)
+
 VISASSET_JSON = 'artifact.json'
 VISASSET_LIBRARY = config['VisAssets']['download_missing_from']
 
@@ -188,6 +220,48 @@ WS_RECEIVE_SCHEMA = config['Schemas']['notifier_receive']
 
 SCHEMA_URL = config['Schemas']['abr']
 
+# Schemas are loaded from the copies cached in static/schemas at startup, then
+# checked for updates in the background. Check again every this many seconds
+# (0 to only check at startup).
+SCHEMA_REFRESH_INTERVAL = config.getfloat('Schemas', 'refresh_interval', fallback=0)
+
+# JSON library to use: 'orjson', 'json' (the standard library), or 'auto' (orjson
+# if it's installed)
+JSON_CODEC = config.get('Server', 'json_codec', fallback='auto')
+
+# Notifications for the same target sent within this many seconds of each
+# other are merged into one
+NOTIFIER_COALESCE_WINDOW = config.getfloat('Notifier', 'coalesce_window', fallback=0.05)
+
+# Maximum notifications per second sent to each WebSocket client (0 for no
+# limit)
+NOTIFIER_MAX_CLIENT_RATE = config.getfloat('Notifier', 'max_client_rate', fallback=30)
+
+# Maximum notifications waiting to go out to each WebSocket client, and what to
+# do when a client falls that far behind: 'coalesce' (merge what's waiting by
+# target), 'drop_oldest', or 'disconnect'
+NOTIFIER_QUEUE_SIZE = config.getint('Notifier', 'queue_size', fallback=64)
+NOTIFIER_OVERFLOW_POLICY = config.get('Notifier', 'overflow_policy', fallback='coalesce')
+
+# Check outgoing notifications against the WebSocket send schema: 'strict'
+# (every one), 'sampled' (a random NOTIFIER_VALIDATION_SAMPLE_RATE fraction of
+# them), or 'off'
+NOTIFIER_VALIDATION = config.get('Notifier', 'validation', fallback='strict')
+NOTIFIER_VALIDATION_SAMPLE_RATE = config.getfloat('Notifier', 'validation_sample_rate', fallback=0.01)
+
+# Channel layer that notifications are sent through. The in-memory layer only
+# reaches clients connected to this worker; to run several workers, use one
+# they all share (e.g. channels_redis.core.RedisChannelLayer)
+CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': config.get('Notifier', 'channel_layer', fallback='channels.layers.InMemoryChannelLayer'),
+    }
+}
+if config.has_option('Notifier', 'channel_layer_hosts'):
+    CHANNEL_LAYERS['default']['CONFIG'] = {
+        'hosts': [h.strip() for h in config.get('Notifier', 'channel_layer_hosts').split(',')],
+    }
+
 BACKUP_LOCATIONS = {
     'linux': Path('~/.config/abr/'),
     'darwin': Path('~/Library/Application Support/abr'),
@@ -198,8 +272,44 @@ BACKUP_PATH = BACKUP_LOCATIONS[sys.platform] \
     .joinpath('abr_backup.json') \
     .expanduser()
 
-# Delete backup entries after a certain amount of time
-BACKUP_DELETE_INTERVAL = 3600
+# Where states are kept: 'local' (in this process, backed up to BACKUP_PATH)
+# or 'sqlite' (in a database at STATE_STORE_PATH that several workers can
+# share)
+STATE_STORE = config.get('Store', 'backend', fallback='local')
+STATE_STORE_PATH = Path(config.get('Store', 'path', fallback=str(BACKUP_PATH.parent.joinpath('abr_state.sqlite3')))).expanduser()
+
+# Backups for named state sessions (other than the default one)
+SESSION_BACKUP_PATH = BACKUP_PATH.parent.joinpath('sessions')
+
+# Named sessions that haven't been used for this many seconds are written to
+# disk and unloaded (0 to keep them loaded)
+SESSION_IDLE_TIMEOUT = config.getfloat('Sessions', 'idle_timeout', fallback=600)
+
+# Maximum number of sessions kept in memory at once; the least recently used
+# are unloaded first (0 for no limit)
+SESSION_MAX_LOADED = config.getint('Sessions', 'max_loaded', fallback=32)
+
+# When to fsync the backup journal: 'always' (every change), 'interval' (at
+# most every BACKUP_FSYNC_INTERVAL seconds), or 'never' (leave it to the OS)
+BACKUP_FSYNC = config.get('Backup', 'fsync', fallback='interval')
+BACKUP_FSYNC_INTERVAL = config.getfloat('Backup', 'fsync_interval', fallback=1.0)
+
+# Backups are written in the background, at most once every
+# BACKUP_WRITE_INTERVAL seconds
+BACKUP_WRITE_INTERVAL = config.getfloat('Backup', 'write_interval', fallback=0.5)
+
+# Number of changes between full checkpoints of the state
+BACKUP_CHECKPOINT_INTERVAL = config.getint('Backup', 'checkpoint_interval', fallback=200)
+
+# Restore the most recent backup when the server starts
+BACKUP_RESTORE = config.getboolean('Backup', 'restore_on_startup', fallback=True)
+
+# Limits on the undo history; the oldest changes are forgotten first
+UNDO_MAX_ENTRIES = config.getint('Undo', 'max_entries', fallback=1000)
+UNDO_MAX_BYTES = config.getint('Undo', 'max_bytes', fallback=64 * 1024 * 1024)
+
+# Number of undo entries between full snapshots of the state
+UNDO_CHECKPOINT_INTERVAL = config.getint('Undo', 'checkpoint_interval', fallback=25)
 
 # Issue for windows loading .js files
 if DEBUG:
@@ -19,135 +19,275 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import os
-import datetime
 import sys
 import jsonschema
-import requests
-import json
-import time
-import jsondiff
 import logging
 from copy import deepcopy
+from contextlib import contextmanager
 from django.conf import settings
-from pathlib import Path
-from threading import Lock
+from threading import RLock
 
+from . import json_codec
+from .json_patch import make_patch, apply_patch, get_in, set_in, remove_in
+from .response_cache import ResponseCache
+from .state_index import StateIndex
+from .undo_history import UndoHistory
 from .notifier import MessageTarget, NotifierMessage, notifier
-from .visasset_manager import download_visasset
+from .visasset_manager import visasset_resolver
 
 logger = logging.getLogger('django.server')
 
+# Index predicate for inputs that are VisAssets
+VISASSET_INPUT = 'visassetInput'
+
+def is_visasset_input(v):
+    return 'inputValue' in v and 'inputGenre' in v and v['inputGenre'] == 'VisAsset'
+
+class StaleRevisionError(Exception):
+    '''
+        Raised when a conditional change was made against a revision of the
+        state that is no longer current
+    '''
+    def __init__(self, expected_revision, revision):
+        super().__init__('State is at revision {}, not {}'.format(revision, expected_revision))
+        self.expected_revision = expected_revision
+        self.revision = revision
+
 class State():
-    def __init__(self):
-        # Make sure the backup location exists
-        if not settings.BACKUP_PATH.parent.exists():
-            os.makedirs(settings.BACKUP_PATH.parent)
-        settings.BACKUP_PATH.touch()
-        self.backup_path = settings.BACKUP_PATH.resolve()
+    def __init__(self, name, state_schema, validator, store, restore=True):
+        '''
+            One composition. `state_schema` and its compiled `validator` are
+            shared between all states; `store` is where this one is kept (see
+            state_store.py). If `restore` is set, start from whatever is in the
+            store.
+        '''
+        # Name of the session this state belongs to
+        self.name = name
 
-        resp = requests.get(settings.SCHEMA_URL)
+        # Where the state is kept (and backed up), possibly shared with other
+        # workers
+        self.store = store
 
-        # Get most recent backed up schema
-        try:
-            backup_schema_dir = os.path.join(settings.STATIC_ROOT, 'schemas')
-            backup_schema = list(sorted(os.listdir(backup_schema_dir), reverse=True))[0]
-        except:
-            logger.error('Unable to find backup schema in {0}'.format(backup_schema_dir))
-            backup_schema = None
-
-        if backup_schema is not None:
-            backup_schema = os.path.join(backup_schema_dir, backup_schema)
-
-        if resp.status_code != 200:
-            logger.error('Unable to load schema from url {0}, using backup schema {1}'.format(settings.SCHEMA_URL, backup_schema))
-            with open(backup_schema) as fin:
-                self.state_schema = json.load(fin)
-        else:
-            self.state_schema = resp.json()
-            # And save a backup copy to the folder if necessary
-            need_backup = True
-            if backup_schema is not None:
-                with open(backup_schema) as fin:
-                    if fin.read() == resp.text:
-                        need_backup = False
-            if need_backup:
-                schema_name = datetime.datetime.now().isoformat().replace(':', '_') + '.json'
-                if not os.path.isdir(backup_schema_dir):
-                    os.makedirs(backup_schema_dir)
-                schema_bak_path = Path(backup_schema_dir).joinpath(schema_name)
-                with open(schema_bak_path, 'w') as fout:
-                    fout.write(resp.text)
-                logger.info('Saved backup schema to ' + str(schema_bak_path))
+        self.state_schema = state_schema
 
         # Lock around state modifications
-        self._state_lock = Lock()
+        self._state_lock = RLock()
+
+        # Compiled once, rather than on every validation
+        self.validator = validator
 
         self._default_state = {
             'version': self.state_schema['properties']['version']['default']
         }
 
-        logger.info('Using ABR Schema, version {}'.format(self._default_state['version']))
-
-        # Initialize a blank starting state
+        # Initialize a blank starting state. The state is persistent: it is
+        # never modified in place, every edit builds a new state that shares
+        # all of its unchanged objects with the old one. Anything handed out by
+        # get_path() must be treated as read-only.
         self._state = deepcopy(self._default_state)
 
         with self._state_lock:
-            jsonschema.validate(self._state, self.state_schema)
-
-        # Make the temporary state for pending modifications
-        self._pending_state = deepcopy(self._state)
-
-        # JSON diffs for undoing/redoing
-        self.undo_stack = []
-        self.redo_stack = []
+            self.validator.validate(self._state)
+
+        # Where keys and VisAsset inputs are in the state, for remove_all()
+        # and finding VisAssets to download
+        self.index = StateIndex({VISASSET_INPUT: is_visasset_input})
+        self.index.rebuild(self._state)
+
+        # Bounded history of changes for undoing/redoing
+        self.history = UndoHistory(
+            self._state,
+            max_entries=settings.UNDO_MAX_ENTRIES,
+            max_bytes=settings.UNDO_MAX_BYTES,
+            checkpoint_interval=settings.UNDO_CHECKPOINT_INTERVAL,
+        )
+
+        # Incremented every time the state actually changes, so clients can
+        # tell whether a patch applies to the copy of the state they have
+        self.revision = 0
+
+        # Distinguishes revisions from different runs of the server (e.g. for
+        # ETags), in case the state isn't restored from a backup. Workers
+        # sharing a store share its epoch.
+        self.epoch = self.store.epoch
+
+        # (revision, state) as of the last change. Replaced in one go whenever
+        # the state changes, so readers can use it without taking the lock.
+        self._snapshot = (self.revision, self._state)
+
+        # Serialized GET responses for the current revision
+        self.response_cache = ResponseCache()
+
+        # Pick up where we left off if the server went down (or from wherever
+        # other workers are), then start the backup over from the current
+        # state. A backup that wasn't restored (it failed to validate, or
+        # restoring is turned off) is kept rather than overwritten.
+        restored = False
+        if restore or self.store.shared:
+            restored = len(self.restore_backup()) == 0
+        if not restored and self.store.has_backup():
+            self.store.set_aside()
+        self.store.checkpoint(self.revision, self._state)
+
+    def set_schema(self, state_schema, validator):
+        '''
+            Switch to a new version of the schema. Only affects changes made
+            from here on.
+        '''
+        with self._state_lock:
+            self.state_schema = state_schema
+            self.validator = validator
+            self._default_state = {
+                'version': self.state_schema['properties']['version']['default']
+            }
 
-    # Validate the pending state, back it up, populate the undo stack, etc.
+    # Validate a new state, back it up, populate the undo stack, etc.
     # Returns a string of any validation errors
-    def validate_and_backup(self):
+    def validate_and_backup(self, new_state):
+        with self._writing():
+            result, message = self._validate_and_commit(new_state)
+        self._notify(message)
+        return result
+
+    def _validate_and_commit(self, new_state):
+        '''
+            Returns a string of any validation errors, and the notifier message
+            for the change (None if nothing changed). Must be called while
+            writing (see _writing()); the message should be sent once that's
+            done.
+        '''
+        # Only validate the parts of the state that actually changed
+        patch = make_patch(self._state, new_state)
         try:
-            # Sometimes validation fails (collection changed during iteration??)
-            tries = 10
-            for i in range(tries):
-                try:
-                    jsonschema.validate(self._pending_state, self.state_schema)
-                    break
-                except RuntimeError:
-                    pass
-
-            # If we've successfully validated the state, make a backup. Keep
-            # up to a certain amount of backups if something crashes
-            self.make_backup()
-
-            # Save the new state
-            # Also store a stack of undos, based on json diff
-            # Clear the redo stack, because if we made a change to the state all
-            # the previous redos are invalid
-            with self._state_lock:
-                state_diff = jsondiff.diff(self._pending_state, self._state, syntax='symmetric', marshal=True)
-                if len(state_diff) > 0: # Only record the change if there's actually a diff
-                    self.undo_stack.append(state_diff)
-                    self.redo_stack.clear()
-                    self._state = deepcopy(self._pending_state)
+            self.validator.validate_patch(new_state, patch)
+        except jsonschema.ValidationError as e:
+            # Discard the new state if it was invalid
+            path = '/'.join(map(str, e.path))
+            return ('Schema validation failed - {}: {}'.format(path, e.message), None)
+
+        # Save the new state
+        # Also record it in the undo history, which clears any redos
+        # because if we made a change to the state all the previous redos
+        # are invalid
+        if len(patch) == 0: # Only record the change if there's actually a diff
+            return ('', None)
+        self.history.record(self._state, new_state, patch)
+        return ('', self._commit(new_state, patch))
+
+    def _notify(self, message):
+        # Tell any connected clients that we've updated the state. Only called
+        # once the locks are released, so other writers aren't held up by it.
+        if message is not None:
+            notifier.notify(message)
+
+    def _commit(self, new_state, patch=None, history_step=None):
+        '''
+            Replace the current state with `new_state` and bump the revision.
+            `history_step` is how far through the undo history this moved, if
+            it was an undo or redo. Returns a notifier message carrying the
+            JSON patch between the two. Must be called while holding the state
+            lock.
+        '''
+        if patch is None:
+            patch = make_patch(self._state, new_state)
+        self.index.update(self._state, new_state, patch)
+        base_revision = self.revision
+        self.revision += 1
+        self._state = new_state
+        self._snapshot = (self.revision, new_state)
 
-            # Tell any connected clients that we've updated the state
-            notifier.notify(NotifierMessage(MessageTarget.State))
+        # Keep a backup of every change in case something crashes
+        self.make_backup(patch, history_step)
 
-            return ''
-        except jsonschema.ValidationError as e:
-            # Discard the pending state and reset if it was invalid
-            self._pending_state = deepcopy(self._state)
+        return NotifierMessage(MessageTarget.State, patch, self.revision, base_revision, session=self.name)
 
-            path = '/'.join(e.path)
-            return 'Schema validation failed - {}: {}'.format(path, e.message)
+    @contextmanager
+    def _writing(self):
+        '''
+            Hold the state lock (and the store's lock, if other workers share
+            the store) and catch up with any changes made elsewhere, for the
+            duration of a `with` block that changes the state
+        '''
+        with self._state_lock, self.store.lock():
+            self._sync()
+            yield
+
+    def _sync(self):
+        # Catch up with changes other workers made to a shared store. Must be
+        # called while holding the state lock.
+        if not self.store.shared or self.store.head() == self.revision:
+            return
+
+        changes = self.store.changes_since(self.revision)
+        if changes is None:
+            # Too far behind to replay the changes one by one
+            loaded = self.store.load()
+            revision, new_state = loaded if loaded is not None else (0, deepcopy(self._default_state))
+            self.index.rebuild(new_state)
+            self.history.reset(new_state)
+            self.revision = revision
+            self._state = new_state
+        else:
+            for revision, patch, history_step in changes:
+                new_state = apply_patch(self._state, patch)
+                self.index.update(self._state, new_state, patch)
+                # Follow other workers' undos and redos through the same
+                # history, instead of recording them as new changes
+                if history_step is None:
+                    self.history.record(self._state, new_state, patch)
+                elif 0 <= self.history.position + history_step <= len(self.history):
+                    self.history.position += history_step
+                else:
+                    # Undid past the start of this worker's history
+                    self.history.reset(new_state)
+                self.revision = revision
+                self._state = new_state
+        self._snapshot = (self.revision, self._state)
+
+    def refresh(self):
+        '''
+            Catch up with changes other workers have made to the state, if
+            it's shared with them
+        '''
+        if self.store.shared and self.store.head() != self._snapshot[0]:
+            with self._state_lock:
+                self._sync()
+
+    def get_revision(self):
+        self.refresh()
+        return self._snapshot[0]
 
     # CRUD operations
     def get_path(self, item_path):
-        with self._state_lock:
+        return self.get_path_versioned(item_path)[1]
+
+    def get_path_versioned(self, item_path):
+        '''
+            Get the value at a path in the state, along with the revision of
+            the state it was taken from
+        '''
+        self.refresh()
+        revision, current_state = self._snapshot
+        try:
+            return (revision, self._get_path(current_state, item_path))
+        except KeyError:
+            return (revision, None)
+
+    def get_path_serialized(self, item_path):
+        '''
+            Get the serialized JSON response ({"state": ..., "revision": ...})
+            for a path in the state, along with its revision. Each path is
+            serialized at most once per revision.
+        '''
+        self.refresh()
+        revision, current_state = self._snapshot
+        def build():
             try:
-                return self._get_path(self._state, item_path)
+                value = self._get_path(current_state, item_path)
             except KeyError:
-                return None
+                value = None
+            return json_codec.dumps({'state': value, 'revision': revision})
+        return (revision, self.response_cache.get(revision, tuple(item_path), build))
         
     def _get_path(self, sub_state, sub_path_parts):
         if len(sub_path_parts) == 0:
@@ -159,175 +299,230 @@ class State():
             rest = sub_path_parts[1:]
             return self._get_path(sub_state[root], rest)
 
-    def set_path(self, item_path, new_value):
-        if len(item_path) == 0:
-            self._pending_state = new_value
-        else:
-            self._set_path(self._pending_state, item_path, new_value)
+    def _check_revision(self, expected_revision):
+        # For optimistic concurrency: only make a change if the client saw the
+        # latest state. Must be called while holding the state lock.
+        if expected_revision is not None and expected_revision != self.revision:
+            raise StaleRevisionError(expected_revision, self.revision)
 
-        final_result = self.validate_and_backup()
+    def set_path(self, item_path, new_value, expected_revision=None):
+        with self._writing():
+            self._check_revision(expected_revision)
+            final_result, message = self._validate_and_commit(set_in(self._state, item_path, new_value))
+        self._notify(message)
 
         # If there aren't any errors and DOWNLOAD_VISASSETS is set, download the
-        # visassets
+        # visassets (in the background)
         if len(final_result) == 0 and settings.DOWNLOAD_VISASSETS:
-            all_visassets = self._find_all(
-                # Has inputValue, it's a VisAsset, and it's not a localVisAsset defined in this state
-                lambda v: 'inputValue' in v and \
-                    'inputGenre' in v and \
-                    v['inputGenre'] == 'VisAsset' and \
-                    'localVisAssets' in self._state and \
-                    v['inputValue'] not in self._state['localVisAssets'],
-                self._state,
-                []
-            )
-            vis_asset_fails = ''
-            for input_value_object in all_visassets:
-                failed = download_visasset(input_value_object['inputValue'], None) # we don't know where it might've come from
-                vis_asset_fails += '\n' + str(failed) if len(failed) > 0 else ''
-            if len(vis_asset_fails) > 0:
-                vis_asset_fails = '\nFailed to download VisAssets: ' + vis_asset_fails
-            logger.warning(vis_asset_fails)
-            notifier.notify(NotifierMessage(MessageTarget.VisAssetsCache))
+            self.download_visassets()
 
         return final_result
 
-    def _set_path(self, sub_state, sub_path_parts, new_value):
-        if len(sub_path_parts) == 1:
-            # Relies on dicts being mutable
-            sub_state[sub_path_parts[0]] = new_value
-        else:
-            root = sub_path_parts[0]
-            rest = sub_path_parts[1:]
-
-            # Assuming everything we're assigning will be an object
-            if root not in sub_state:
-                sub_state[root] = {}
-
-            self._set_path(sub_state[root], rest, new_value)
-
-    def remove_path(self, item_path):
+    def download_visassets(self):
+        '''
+            Queue up any newly referenced VisAssets to be downloaded in the
+            background
+        '''
+        with self._state_lock:
+            current_state = self._state
+            local_visassets = current_state.get('localVisAssets', {})
+            all_visassets = [
+                get_in(current_state, path) for path in self.index.find(VISASSET_INPUT)
+            ]
+        # Not a localVisAsset defined in this state
+        visasset_resolver.resolve([
+            v['inputValue'] for v in all_visassets
+            if 'localVisAssets' in current_state and v['inputValue'] not in local_visassets
+        ])
+
+    def remove_path(self, item_path, expected_revision=None):
+        with self._writing():
+            self._check_revision(expected_revision)
+            result, message = self._validate_and_commit(self._remove_path(self._state, item_path))
+        self._notify(message)
+        return result
+
+    def _remove_path(self, sub_state, item_path):
         if len(item_path) == 0:
-            self._pending_state = deepcopy(self._default_state)
+            return deepcopy(self._default_state)
         else:
-            self._remove_path(self._pending_state, item_path)
-        return self.validate_and_backup()
+            return remove_in(sub_state, item_path)
 
-    def _remove_path(self, sub_state, sub_path_parts):
-        if len(sub_path_parts) == 1:
-            # Relies on dicts being mutable
-            del sub_state[sub_path_parts[0]]
-        else:
-            root = sub_path_parts[0]
-            rest = sub_path_parts[1:]
-            if root in sub_state:
-                self._remove_path(sub_state[root], rest)
-
-    def remove_all(self, value):
-        self._pending_state = self._remove_all(value, deepcopy(self._state))
-        self.validate_and_backup()
-
-    def _remove_all(self, value, sub_state):
-        if len(sub_state) == 0:
-            return sub_state
-        else:
-            if value in sub_state:
-                del sub_state[value]
-            for sub_value in sub_state:
-                if isinstance(sub_state[sub_value], dict):
-                    sub_state[sub_value] = self._remove_all(value, sub_state[sub_value])
-            return sub_state
+    def remove_all(self, value, expected_revision=None):
+        with self._writing():
+            self._check_revision(expected_revision)
+            _result, message = self._validate_and_commit(self._remove_all(value, self._state))
+        self._notify(message)
 
-    def _find_all(self, condition, sub_state, out_items):
-        if len(sub_state) == 0:
-            return sub_state
-        else:
-            if condition(sub_state):
-                out_items.append(sub_state)
-            for sub_value in sub_state:
-                if isinstance(sub_state[sub_value], dict):
-                    self._find_all(condition, sub_state[sub_value], out_items)
-            return out_items
+    def apply_batch(self, operations, expected_revision=None):
+        '''
+            Apply a list of operations to the state all at once. Each operation
+            is one of:
 
+                {'op': 'set', 'path': [...], 'value': ...}
+                {'op': 'remove', 'path': [...]}
+                {'op': 'remove-all', 'value': ...}
 
-    def make_backup(self):
+            The result is validated once at the end, and either all of the
+            operations are applied or none of them are (with one undo entry,
+            backup, and notification). Returns a string of any errors
         '''
-            Save a backup of the state to the backup file. Discard backups more
-            than a certain amount.
-        '''
-        try:
-            with open(self.backup_path, 'r') as backup_file:
-                backup_json = json.load(backup_file)
-        except FileNotFoundError:
-            backup_json = {}
-        except json.decoder.JSONDecodeError:
-            backup_json = {}
-
-        to_delete = set()
-        for time_key in backup_json:
-            t = float(time_key)
-            if time.time() - t > settings.BACKUP_DELETE_INTERVAL:
-                to_delete.add(time_key)
-        for time_key in to_delete:
-            del backup_json[time_key]
-
-        with self._state_lock:
-            backup_json[time.time()] = json.dumps(self._state)
+        with self._writing():
+            self._check_revision(expected_revision)
+            new_state = self._state
+            for i, operation in enumerate(operations):
+                try:
+                    op = operation['op']
+                    if op == 'set':
+                        new_state = set_in(new_state, operation['path'], operation['value'])
+                    elif op == 'remove':
+                        new_state = self._remove_path(new_state, operation['path'])
+                    elif op == 'remove-all':
+                        new_state = self._remove_all(operation['value'], new_state)
+                    else:
+                        return 'Batch operation {}: unknown op `{}`'.format(i, op)
+                except (KeyError, TypeError, AttributeError) as e:
+                    return 'Batch operation {} is malformed: {}'.format(i, e)
+
+            final_result, message = self._validate_and_commit(new_state)
+        self._notify(message)
+
+        if len(final_result) == 0 and settings.DOWNLOAD_VISASSETS and \
+                any(operation['op'] == 'set' for operation in operations):
+            self.download_visassets()
 
-        with open(self.backup_path, 'w') as backup_file:
-            json.dump(backup_json, backup_file)
+        return final_result
 
-    def restore_backup(self):
+    def _remove_all(self, value, sub_state):
+        # Use the index when removing from the current state, otherwise (e.g.
+        # partway through a batch) walk the whole thing
+        if sub_state is not self._state:
+            return self._remove_all_walk(value, sub_state)
+
+        # Shortest paths first, so anything nested inside something already
+        # removed can be skipped
+        removed = set()
+        for path in sorted(self.index.find_key(value), key=len):
+            if any(path[:i] in removed for i in range(1, len(path))):
+                continue
+            sub_state = remove_in(sub_state, list(path))
+            removed.add(path)
+        return sub_state
+
+    def _remove_all_walk(self, value, sub_state):
+        # Only copy the objects that actually had something removed
+        new_sub_state = sub_state
+        if value in sub_state:
+            new_sub_state = dict(sub_state)
+            del new_sub_state[value]
+        for key, sub_value in sub_state.items():
+            if key != value and isinstance(sub_value, dict):
+                new_sub_value = self._remove_all_walk(value, sub_value)
+                if new_sub_value is not sub_value:
+                    if new_sub_state is sub_state:
+                        new_sub_state = dict(sub_state)
+                    new_sub_state[key] = new_sub_value
+        return new_sub_state
+
+    def make_backup(self, patch, history_step=None):
         '''
-            Restore a backup from a file
+            Save the latest change to the store. Must be called while holding
+            the state lock.
         '''
-        # Sort the backup entries and obtain the first (newest) one
-        # backup_entries = list(sorted(map(lambda d: (float(d[0]), d[1]), backup_json.items()), key=lambda d: d[0]))
-        # key_time, most_recent_diff = backup_entries[-1]
-        raise NotImplementedError()
+        self.store.append(self.revision, patch, self._state, history_step)
 
-    def undo(self):
+    def restore_backup(self):
         '''
-            Obtain the previous state diff and apply it. Uses JSON diff to
-            minimize memory usage.
+            Restore the state from the store (e.g. the latest backup
+            checkpoint, plus any changes journaled since then). Returns a
+            string of any errors
         '''
+        restored = self.store.load()
+        if restored is None:
+            return 'No backup to restore'
+        revision, restored_state = restored
 
+        # The schema might have changed since the backup was made
         try:
-            diff_w_previous = self.undo_stack.pop()
-        except IndexError:
-            return 'Nothing to undo'
+            self.validator.validate(restored_state)
+        except jsonschema.ValidationError as e:
+            logger.error('Backup state failed to validate, not restoring: {}'.format(e.message))
+            return 'Backup state failed to validate: {}'.format(e.message)
 
         with self._state_lock:
-            undone_state = jsondiff.patch(self._state, diff_w_previous, syntax='symmetric', marshal=True)
-            self._state = undone_state
-            self._pending_state = undone_state
-        self.redo_stack.append(diff_w_previous)
+            self.revision = revision
+            self._state = restored_state
+            self._snapshot = (revision, restored_state)
+            self.index.rebuild(restored_state)
+            self.history.reset(restored_state)
 
-        # Tell any connected clients that we've updated the state
-        notifier.notify(NotifierMessage(MessageTarget.State))
+        # Clients can't patch their way to this, they need the whole state
+        self._notify(NotifierMessage(MessageTarget.State, revision=revision, session=self.name))
 
         return ''
 
-    def redo(self):
+    def undo(self):
         '''
-            "Undo the undo" by unpatching with the latest item in the redo
-            stack. jsondiff doesn't explicitly support unpatching so we go to
-            the internals here
+            Go back one step in the undo history
         '''
+        with self._writing():
+            if not self.history.can_undo():
+                return 'Nothing to undo'
+            result, message = self._jump_to_history(self.history.position - 1)
+        self._notify(message)
+        return result
 
-        try:
-            diff_w_next = self.redo_stack.pop()
-        except IndexError:
-            return 'Nothing to redo'
-
+    def redo(self):
+        '''
+            "Undo the undo" by going forward one step in the undo history
+        '''
+        with self._writing():
+            if not self.history.can_redo():
+                return 'Nothing to redo'
+            result, message = self._jump_to_history(self.history.position + 1)
+        self._notify(message)
+        return result
+
+    def get_history(self):
+        '''
+            Summary of the undo history: where we are in it, how long it is,
+            and roughly how much memory it's using
+        '''
+        self.refresh()
         with self._state_lock:
-            undone_state = jsondiff.JsonDiffer(syntax='symmetric', marshal=True).unpatch(self._state, diff_w_next)
-            self._state = undone_state
-            self._pending_state = undone_state
-        self.undo_stack.append(diff_w_next)
+            return self.history.to_json()
 
-        # Tell any connected clients that we've updated the state
-        notifier.notify(NotifierMessage(MessageTarget.State))
+    def jump_to_history(self, index):
+        '''
+            Go straight to the state after `index` changes in the undo history
+            (0 is the oldest state still in the history). Returns a string of
+            any errors
+        '''
+        with self._writing():
+            result, message = self._jump_to_history(index)
+        self._notify(message)
+        return result
+
+    def _jump_to_history(self, index):
+        # Returns a string of any errors, and the notifier message to send
+        # once done writing
+        if index == self.history.position:
+            # Already there; nothing changes, so nothing to tell anyone
+            return ('', None)
+        try:
+            new_state = self.history.state_at(index, self._state)
+        except IndexError as e:
+            return (str(e), None)
 
-        return ''
+        history_step = index - self.history.position
+        self.history.position = index
+        return ('', self._commit(new_state, history_step=history_step))
 
-state = State()
\ No newline at end of file
+    def close(self):
+        '''
+            Make sure everything is saved to the store, so the state can be
+            dropped from memory and restored later. The state must not be used
+            afterwards.
+        '''
+        with self._state_lock:
+            self.store.close(self.revision, self._state)
@@ -0,0 +1,119 @@
+# state_index.py
+#
+# Inverted index of the state, so that finding every place a key appears (or
+# every object matching a predicate) doesn't need to walk the whole state. The
+# index is kept up to date incrementally from the JSON patch of each change.
+#
+# Copyright (c) 2021, University of Minnesota
+# Author: Bridger Herman <herma582@umn.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from .json_patch import get_in, parts_from_pointer
+
+class StateIndex:
+    def __init__(self, predicates=None):
+        '''
+            `predicates` is a dictionary of {name: fn}, where fn takes an
+            object in the state and returns whether it should be indexed under
+            `name`. Predicates may only look at the object's own fields.
+
+            Like State.remove_all(), only objects nested directly in other
+            objects are indexed (lists are treated as values).
+        '''
+        self._predicate_fns = predicates if predicates is not None else {}
+
+        # {key: set of paths to that key}, e.g. {'uuid': {('impressions', 'a', 'uuid')}}
+        self._keys = {}
+        # {predicate name: set of paths to the objects matching it}
+        self._predicates = {name: set() for name in self._predicate_fns}
+
+    def rebuild(self, state):
+        self._keys.clear()
+        for paths in self._predicates.values():
+            paths.clear()
+        self._add(state, ())
+
+    def find_key(self, key):
+        '''
+            Paths to everywhere `key` appears in the state
+        '''
+        return set(self._keys.get(key, ()))
+
+    def find(self, predicate_name):
+        '''
+            Paths to all objects in the state matching a predicate
+        '''
+        return set(self._predicates[predicate_name])
+
+    def update(self, old_state, new_state, patch):
+        '''
+            Update the index for a change from `old_state` to `new_state`.
+            `patch` is the JSON patch between them, as produced by make_patch.
+        '''
+        for op in patch:
+            path = tuple(parts_from_pointer(op['path']))
+            if len(path) == 0:
+                self.rebuild(new_state)
+                continue
+
+            # Forget whatever used to be there, and index whatever is there now
+            old_parent = get_in(old_state, path[:-1])
+            if isinstance(old_parent, dict) and path[-1] in old_parent:
+                self._remove_key(path)
+                self._remove(old_parent[path[-1]], path)
+            new_parent = get_in(new_state, path[:-1])
+            if isinstance(new_parent, dict) and path[-1] in new_parent:
+                self._add_key(path)
+                self._add(new_parent[path[-1]], path)
+
+            # The change may affect whether the objects above it match
+            for depth in range(len(path)):
+                self._evaluate(get_in(new_state, path[:depth]), path[:depth])
+
+    def _add_key(self, path):
+        self._keys.setdefault(path[-1], set()).add(path)
+
+    def _remove_key(self, path):
+        paths = self._keys.get(path[-1])
+        if paths is not None:
+            paths.discard(path)
+            if len(paths) == 0:
+                del self._keys[path[-1]]
+
+    def _add(self, value, path):
+        if not isinstance(value, dict):
+            return
+        self._evaluate(value, path)
+        for key, sub_value in value.items():
+            sub_path = path + (key,)
+            self._add_key(sub_path)
+            self._add(sub_value, sub_path)
+
+    def _remove(self, value, path):
+        if not isinstance(value, dict):
+            return
+        for paths in self._predicates.values():
+            paths.discard(path)
+        for key, sub_value in value.items():
+            sub_path = path + (key,)
+            self._remove_key(sub_path)
+            self._remove(sub_value, sub_path)
+
+    def _evaluate(self, value, path):
+        for name, fn in self._predicate_fns.items():
+            if isinstance(value, dict) and fn(value):
+                self._predicates[name].add(path)
+            else:
+                self._predicates[name].discard(path)
@@ -0,0 +1,329 @@
+# state_store.py
+#
+# Where the authoritative copy of each state session lives.
+#
+# - LocalStateStore (the default) keeps the state in this process and backs it
+#   up to a local journal. Only one server worker can use it.
+# - SQLiteStateStore keeps every change in a SQLite database that any number of
+#   workers on the same machine can share. Each worker keeps its own copy of
+#   the state in memory and catches up from the database before reading or
+#   changing it.
+#
+# Copyright (c) 2021, University of Minnesota
+# Author: Bridger Herman <herma582@umn.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import uuid
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+from contextlib import contextmanager, nullcontext
+from django.conf import settings
+
+from . import json_codec
+from .backup_journal import BackupJournal, BackupWriter, FSYNC_ALWAYS, FSYNC_NEVER
+from .json_patch import apply_patch
+
+logger = logging.getLogger('django.server')
+
+STORE_LOCAL = 'local'
+STORE_SQLITE = 'sqlite'
+
+class LocalStateStore:
+    '''
+        State kept in this process only, backed up to a local journal in the
+        background
+    '''
+    # Whether other workers may change the state too
+    shared = False
+
+    def __init__(self, backup_path):
+        # Distinguishes revisions from different runs of the server (e.g. for
+        # ETags), in case the state isn't restored from a backup
+        self.epoch = uuid.uuid4().hex[:8]
+
+        self.journal = BackupJournal(
+            backup_path,
+            fsync_policy=settings.BACKUP_FSYNC,
+            fsync_interval=settings.BACKUP_FSYNC_INTERVAL,
+            checkpoint_interval=settings.BACKUP_CHECKPOINT_INTERVAL,
+        )
+
+        # Write backups in the background, off the request path
+        self.writer = BackupWriter(self.journal, settings.BACKUP_WRITE_INTERVAL)
+
+    def load(self):
+        '''
+            Returns a tuple of (revision, state), or None if nothing is stored
+        '''
+        return self.journal.restore()
+
+    def head(self):
+        '''
+            Latest revision in the store, if other workers may have changed it
+        '''
+        return None
+
+    def lock(self):
+        '''
+            Keep other workers from changing the state until the `with` block
+            is done
+        '''
+        return nullcontext()
+
+    def changes_since(self, revision):
+        '''
+            List of (revision, patch, history_step) for every change after
+            `revision`, or None if they're no longer available
+        '''
+        return []
+
+    def append(self, revision, patch, state, history_step=None):
+        '''
+            Store the patch that brought the state to `revision`. `state` is a
+            (read-only) snapshot of the state at `revision`. `history_step` is
+            how far the change moved through the undo history, if it was an
+            undo, redo or jump (None for a new change).
+        '''
+        self.writer.submit(revision, patch, state)
+
+    def checkpoint(self, revision, state):
+        self.journal.checkpoint(revision, state)
+
+    def has_backup(self):
+        return self.journal.exists()
+
+    def set_aside(self):
+        '''
+            Keep whatever is stored now out of the way, so starting over
+            doesn't overwrite it
+        '''
+        for path in self.journal.set_aside():
+            logger.warning('Kept the previous state backup as {}'.format(path))
+
+    def close(self, revision, state):
+        self.writer.close()
+        self.journal.checkpoint(revision, state)
+        self.journal.close()
+
+    def metrics(self):
+        return dict(self.writer.metrics(), store=STORE_LOCAL)
+
+
+class SQLiteStateStore:
+    '''
+        State shared between workers through a SQLite database. Every change is
+        stored, with a full checkpoint of the state every so often so workers
+        that have fallen far behind (or just started) don't need to replay
+        everything.
+    '''
+    shared = True
+
+    # Connections can't be shared between threads, so each thread gets its own
+    # (one per database), along with how deep it is in lock() so it can be
+    # nested
+    _connections = threading.local()
+
+    SYNCHRONOUS = {
+        FSYNC_ALWAYS: 'FULL',
+        FSYNC_NEVER: 'OFF',
+    }
+
+    def __init__(self, db_path, session):
+        self.db_path = str(db_path)
+        self.session = session
+        self.checkpoint_interval = settings.BACKUP_CHECKPOINT_INTERVAL
+
+        db = self._db()
+        db.execute(
+            'INSERT OR IGNORE INTO sessions (name, epoch, revision, checkpoint_revision) VALUES (?, ?, 0, 0)',
+            (session, uuid.uuid4().hex[:8]),
+        )
+        # Shared by all workers, so they all hand out the same ETags
+        self.epoch = db.execute('SELECT epoch FROM sessions WHERE name = ?', (session,)).fetchone()[0]
+
+    def _db(self):
+        connections = getattr(self._connections, 'by_path', None)
+        if connections is None:
+            connections = self._connections.by_path = {}
+            self._connections.lock_depth = {}
+        db = connections.get(self.db_path)
+        if db is None:
+            db = connections[self.db_path] = self.connect(self.db_path)
+        return db
+
+    @staticmethod
+    def connect(db_path):
+        if not Path(db_path).parent.exists():
+            os.makedirs(Path(db_path).parent)
+        # Transactions are managed by hand in lock()
+        db = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous={}'.format(SQLiteStateStore.SYNCHRONOUS.get(settings.BACKUP_FSYNC, 'NORMAL')))
+        db.execute('''CREATE TABLE IF NOT EXISTS sessions (
+            name TEXT PRIMARY KEY,
+            epoch TEXT NOT NULL,
+            revision INTEGER NOT NULL,
+            checkpoint_revision INTEGER NOT NULL,
+            checkpoint BLOB
+        )''')
+        db.execute('''CREATE TABLE IF NOT EXISTS changes (
+            session TEXT NOT NULL,
+            revision INTEGER NOT NULL,
+            patch BLOB NOT NULL,
+            history_step INTEGER,
+            PRIMARY KEY (session, revision)
+        )''')
+        # Databases from before undo/redo was shared between workers
+        columns = [row[1] for row in db.execute('PRAGMA table_info(changes)')]
+        if 'history_step' not in columns:
+            db.execute('ALTER TABLE changes ADD COLUMN history_step INTEGER')
+        return db
+
+    def load(self):
+        db = self._db()
+        checkpoint_revision, checkpoint = db.execute(
+            'SELECT checkpoint_revision, checkpoint FROM sessions WHERE name = ?', (self.session,)
+        ).fetchone()
+        if checkpoint is None:
+            return None
+        revision = checkpoint_revision
+        state = json_codec.loads(checkpoint)
+        for revision, patch in db.execute(
+                'SELECT revision, patch FROM changes WHERE session = ? AND revision > ? ORDER BY revision',
+                (self.session, checkpoint_revision)):
+            state = apply_patch(state, json_codec.loads(patch))
+        return (revision, state)
+
+    def head(self):
+        return self._db().execute('SELECT revision FROM sessions WHERE name = ?', (self.session,)).fetchone()[0]
+
+    @contextmanager
+    def lock(self):
+        db = self._db()
+        lock_depth = self._connections.lock_depth
+        depth = lock_depth.get(self.db_path, 0)
+        if depth == 0:
+            # Takes the database's write lock right away, so whatever is read
+            # inside the block is still current when it's written back
+            db.execute('BEGIN IMMEDIATE')
+        lock_depth[self.db_path] = depth + 1
+        try:
+            yield
+        except BaseException:
+            lock_depth[self.db_path] = depth
+            if depth == 0:
+                db.execute('ROLLBACK')
+            raise
+        else:
+            lock_depth[self.db_path] = depth
+            if depth == 0:
+                db.execute('COMMIT')
+
+    def changes_since(self, revision):
+        changes = [
+            (r, json_codec.loads(patch), history_step) for r, patch, history_step in self._db().execute(
+                'SELECT revision, patch, history_step FROM changes WHERE session = ? AND revision > ? ORDER BY revision',
+                (self.session, revision))
+        ]
+        # There's a gap (the changes were folded into a checkpoint and deleted),
+        # or the store was started over
+        if len(changes) > 0 and changes[0][0] != revision + 1:
+            return None
+        if len(changes) == 0 and self.head() != revision:
+            return None
+        return changes
+
+    def append(self, revision, patch, state, history_step=None):
+        db = self._db()
+        with self.lock():
+            db.execute('INSERT INTO changes (session, revision, patch, history_step) VALUES (?, ?, ?, ?)',
+                (self.session, revision, json_codec.dumps(patch), history_step))
+            db.execute('UPDATE sessions SET revision = ? WHERE name = ?', (revision, self.session))
+            checkpoint_revision = db.execute(
+                'SELECT checkpoint_revision FROM sessions WHERE name = ?', (self.session,)
+            ).fetchone()[0]
+            if revision - checkpoint_revision >= self.checkpoint_interval:
+                self.checkpoint(revision, state)
+
+    def checkpoint(self, revision, state):
+        db = self._db()
+        with self.lock():
+            previous_revision, previous = db.execute(
+                'SELECT checkpoint_revision, checkpoint FROM sessions WHERE name = ?', (self.session,)
+            ).fetchone()
+            if previous is not None and revision <= previous_revision:
+                return
+            db.execute('UPDATE sessions SET checkpoint_revision = ?, checkpoint = ? WHERE name = ?',
+                (revision, json_codec.dumps(state), self.session))
+            # Keep the changes since the previous checkpoint around, for any
+            # workers that are only a little behind
+            db.execute('DELETE FROM changes WHERE session = ? AND revision <= ?', (self.session, previous_revision))
+
+    def has_backup(self):
+        checkpoint = self._db().execute('SELECT checkpoint FROM sessions WHERE name = ?', (self.session,)).fetchone()[0]
+        return checkpoint is not None
+
+    def set_aside(self):
+        # Other workers use whatever is in the database, so it's left alone
+        # (and checkpoint() never goes back to an older revision)
+        pass
+
+    def close(self, revision, state):
+        # Everything is already in the database
+        pass
+
+    def metrics(self):
+        db = self._db()
+        revision, checkpoint_revision = db.execute(
+            'SELECT revision, checkpoint_revision FROM sessions WHERE name = ?', (self.session,)
+        ).fetchone()
+        changes = db.execute('SELECT COUNT(*) FROM changes WHERE session = ?', (self.session,)).fetchone()[0]
+        return {
+            'store': STORE_SQLITE,
+            'revision': revision,
+            'checkpointRevision': checkpoint_revision,
+            'changes': changes,
+        }
+
+
+def open_store(session, backup_path):
+    '''
+        Open the store for a state session, using whichever kind of store is
+        configured. `backup_path` is where a local store keeps its backups.
+    '''
+    if settings.STATE_STORE == STORE_LOCAL:
+        return LocalStateStore(backup_path)
+    elif settings.STATE_STORE == STORE_SQLITE:
+        return SQLiteStateStore(settings.STATE_STORE_PATH, session)
+    else:
+        raise ValueError('Unknown state store `{}`'.format(settings.STATE_STORE))
+
+def stored_sessions():
+    '''
+        Names of all the sessions that have been stored, loaded or not
+    '''
+    if settings.STATE_STORE == STORE_SQLITE:
+        db = SQLiteStateStore.connect(str(settings.STATE_STORE_PATH))
+        try:
+            return [name for (name,) in db.execute('SELECT name FROM sessions')]
+        finally:
+            db.close()
+    elif settings.SESSION_BACKUP_PATH.exists():
+        return [backup.stem for backup in settings.SESSION_BACKUP_PATH.glob('*.json')]
+    else:
+        return []
@@ -0,0 +1,211 @@
+# subscriptions.py
+#
+# What each WebSocket client wants to hear about. A client can ask for only
+# some targets (e.g. just `state`), and only changes to some parts of the state
+# (e.g. /impressions/<uuid>), when it connects:
+#
+#   ws://localhost:8000/ws/?target=state&path=/impressions/<uuid>
+#
+# Clients with path subscriptions get patches with only the operations that
+# touch those paths, so each one gets its own chain of revisions:
+# `baseRevision` is the last revision that client was sent.
+#
+# Copyright (c) 2021, University of Minnesota
+# Author: Bridger Herman <herma582@umn.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from .json_patch import parts_from_pointer, pointer_from_parts
+
+# Target of state messages, the only ones path subscriptions apply to
+STATE_TARGET = 'state'
+
+# Index key for subscriptions with paths that didn't limit their targets
+_ALL_BUT_STATE = object()
+
+class Subscription:
+    def __init__(self, client, session, targets=None, paths=None):
+        '''
+            `client` is the consumer to deliver messages to (through its
+            queue). `targets` and `paths` (lists of JSON Pointers) are None to
+            get everything.
+        '''
+        self.client = client
+        self.session = session
+        self.targets = None if targets is None else frozenset(targets)
+        self.paths = None if paths is None else [tuple(parts_from_pointer(p)) for p in paths]
+
+        # Last state revision this client was sent (or the revision when it
+        # subscribed), if it has path subscriptions
+        self.revision = None
+
+    def wants(self, target):
+        return self.targets is None or target in self.targets
+
+    def to_json(self):
+        return {
+            'targets': None if self.targets is None else sorted(self.targets),
+            'paths': None if self.paths is None else [pointer_from_parts(p) for p in self.paths],
+        }
+
+
+class _Node:
+    __slots__ = ('children', 'subscribers')
+
+    def __init__(self):
+        self.children = {}
+        self.subscribers = set()
+
+
+class PathTrie:
+    '''
+        Subscribers keyed by state path prefix. A change matches every
+        subscriber on the way to it (it changed something inside their path)
+        and every subscriber below it (it replaced a parent of their path).
+    '''
+    def __init__(self):
+        self.root = _Node()
+
+    def add(self, parts, subscriber):
+        node = self.root
+        for part in parts:
+            node = node.children.setdefault(part, _Node())
+        node.subscribers.add(subscriber)
+
+    def remove(self, parts, subscriber):
+        # Drop the nodes that are left empty on the way back up
+        nodes = [self.root]
+        for part in parts:
+            node = nodes[-1].children.get(part)
+            if node is None:
+                return
+            nodes.append(node)
+        nodes[-1].subscribers.discard(subscriber)
+        for i in range(len(parts), 0, -1):
+            node = nodes[i]
+            if len(node.subscribers) > 0 or len(node.children) > 0:
+                break
+            del nodes[i - 1].children[parts[i - 1]]
+
+    def match(self, parts):
+        matched = set()
+        node = self.root
+        for part in parts:
+            matched.update(node.subscribers)
+            node = node.children.get(part)
+            if node is None:
+                return matched
+        # Everything at or below the changed path
+        stack = [node]
+        while len(stack) > 0:
+            node = stack.pop()
+            matched.update(node.subscribers)
+            stack.extend(node.children.values())
+        return matched
+
+
+class SubscriptionRouter:
+    '''
+        Finds the subscribers for each message without looking at the ones
+        that don't want it
+    '''
+    def __init__(self):
+        # {(session, target) -> subscriptions to the whole state}, where a
+        # target of None means every target
+        self._index = {}
+        # {session -> PathTrie} of subscriptions to parts of the state
+        self._paths = {}
+        # Number of subscriptions in each session
+        self._sessions = {}
+
+    def _keys(self, sub):
+        # Where a subscription goes in the index. Subscriptions with paths get
+        # state messages through the trie instead.
+        if sub.paths is None:
+            targets = [None] if sub.targets is None else sub.targets
+        elif sub.targets is None:
+            targets = [_ALL_BUT_STATE]
+        else:
+            targets = [t for t in sub.targets if t != STATE_TARGET]
+        return [(sub.session, t) for t in targets]
+
+    def add(self, sub):
+        for key in self._keys(sub):
+            self._index.setdefault(key, set()).add(sub)
+        if sub.paths is not None and sub.wants(STATE_TARGET):
+            trie = self._paths.setdefault(sub.session, PathTrie())
+            for parts in sub.paths:
+                trie.add(parts, sub)
+        self._sessions[sub.session] = self._sessions.get(sub.session, 0) + 1
+
+    def remove(self, sub):
+        for key in self._keys(sub):
+            subs = self._index.get(key)
+            if subs is not None:
+                subs.discard(sub)
+                if len(subs) == 0:
+                    del self._index[key]
+        trie = self._paths.get(sub.session)
+        if trie is not None and sub.paths is not None:
+            for parts in sub.paths:
+                trie.remove(parts, sub)
+        self._sessions[sub.session] -= 1
+        if self._sessions[sub.session] == 0:
+            del self._sessions[sub.session]
+            self._paths.pop(sub.session, None)
+
+    def session_count(self, session):
+        return self._sessions.get(session, 0)
+
+    def _subscribers(self, session, target):
+        # Subscribers to the whole of `target`
+        subs = set()
+        sessions = self._sessions.keys() if session is None else [session]
+        for s in sessions:
+            subs.update(self._index.get((s, target), ()))
+            subs.update(self._index.get((s, None), ()))
+            if target != STATE_TARGET:
+                subs.update(self._index.get((s, _ALL_BUT_STATE), ()))
+        return subs
+
+    def route(self, message):
+        '''
+            Returns a list of (subscription, message) for everyone who should
+            get `message`. Path subscribers get a message with just the parts
+            of the patch they asked for.
+        '''
+        deliveries = [(sub, message) for sub in self._subscribers(message.session, message.target)]
+        if message.target != STATE_TARGET or message.session is None:
+            return deliveries
+
+        trie = self._paths.get(message.session)
+        if trie is None:
+            return deliveries
+        if message.patch is None:
+            # Need to fetch the whole state anyway
+            subs = trie.match(())
+            for sub in subs:
+                sub.revision = message.revision
+            return deliveries + [(sub, message) for sub in subs]
+
+        # Operations for each subscriber, in order
+        ops = {}
+        for op in message.patch:
+            for sub in trie.match(parts_from_pointer(op['path'])):
+                ops.setdefault(sub, []).append(op)
+        for sub, sub_ops in ops.items():
+            filtered = message.filtered(sub_ops, sub.revision)
+            sub.revision = message.revision
+            deliveries.append((sub, filtered))
+        return deliveries
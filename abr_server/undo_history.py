@@ -0,0 +1,143 @@
+# undo_history.py
+#
+# Bounded undo/redo history for the state. Each entry stores the JSON patches to
+# go forward and back one step, and every few entries also keeps a snapshot of
+# the state so that jumping far back in time doesn't replay the whole history.
+#
+# Copyright (c) 2021, University of Minnesota
+# Author: Bridger Herman <herma582@umn.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from . import json_codec
+from .json_patch import make_patch, apply_patch
+
+class HistoryEntry:
+    __slots__ = ('patch', 'inverse', 'size', 'checkpoint')
+
+    def __init__(self, patch, inverse, checkpoint=None):
+        self.patch = patch
+        self.inverse = inverse
+        self.checkpoint = checkpoint
+
+        # Approximate memory used by this entry. Checkpoints aren't counted:
+        # they share structure with the other states, and anything they keep
+        # alive on their own is already held by the inverse patches.
+        self.size = len(json_codec.dumps(patch)) + len(json_codec.dumps(inverse))
+
+class UndoHistory:
+    def __init__(self, initial_state, max_entries=1000, max_bytes=64 * 1024 * 1024, checkpoint_interval=25):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.checkpoint_interval = checkpoint_interval
+        self.reset(initial_state)
+
+    def reset(self, initial_state):
+        '''
+            Forget all history, starting over from `initial_state`
+        '''
+        # State before the first entry
+        self._base = initial_state
+        self._entries = []
+
+        # Number of entries that have been applied to get to the current state
+        self.position = 0
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def can_undo(self):
+        return self.position > 0
+
+    def can_redo(self):
+        return self.position < len(self._entries)
+
+    def record(self, old_state, new_state, patch):
+        '''
+            Record a new change that took the state from `old_state` to
+            `new_state`. Anything that could have been redone is discarded.
+        '''
+        for entry in self._entries[self.position:]:
+            self.bytes -= entry.size
+        del self._entries[self.position:]
+
+        inverse = make_patch(new_state, old_state)
+        checkpoint = new_state if self._since_checkpoint() + 1 >= self.checkpoint_interval else None
+        entry = HistoryEntry(patch, inverse, checkpoint)
+        self._entries.append(entry)
+        self.bytes += entry.size
+        self.position += 1
+
+        # Forget the oldest changes once we're over budget
+        while len(self._entries) > 1 and \
+                (len(self._entries) > self.max_entries or self.bytes > self.max_bytes):
+            oldest = self._entries.pop(0)
+            self.bytes -= oldest.size
+            self.position -= 1
+            if oldest.checkpoint is not None:
+                self._base = oldest.checkpoint
+            else:
+                self._base = apply_patch(self._base, oldest.patch)
+
+    def _since_checkpoint(self):
+        # Number of entries since the last checkpoint (or the base state). Not
+        # worked out from the position, which stops growing once the history
+        # is full and the oldest entries are being dropped.
+        count = 0
+        for entry in reversed(self._entries):
+            if entry.checkpoint is not None or count >= self.checkpoint_interval:
+                break
+            count += 1
+        return count
+
+    def state_at(self, index, current_state):
+        '''
+            Rebuild the state as it was after `index` entries, starting from
+            whichever snapshot is closest (the current state, the base state, or
+            a checkpoint) and applying patches from there
+        '''
+        if index < 0 or index > len(self._entries):
+            raise IndexError('History index {} out of range'.format(index))
+
+        anchor_index, anchor_state = self.position, current_state
+        if index < abs(anchor_index - index):
+            anchor_index, anchor_state = 0, self._base
+
+        # Checkpoints are spaced checkpoint_interval apart, so only look that
+        # far in each direction
+        lo = max(index - self.checkpoint_interval, 0)
+        hi = min(index + self.checkpoint_interval, len(self._entries))
+        for i in range(lo, hi):
+            checkpoint = self._entries[i].checkpoint
+            if checkpoint is not None and abs(i + 1 - index) < abs(anchor_index - index):
+                anchor_index, anchor_state = i + 1, checkpoint
+
+        state = anchor_state
+        if anchor_index < index:
+            for entry in self._entries[anchor_index:index]:
+                state = apply_patch(state, entry.patch)
+        else:
+            for entry in reversed(self._entries[index:anchor_index]):
+                state = apply_patch(state, entry.inverse)
+        return state
+
+    def to_json(self):
+        return {
+            'position': self.position,
+            'length': len(self._entries),
+            'bytes': self.bytes,
+            'maxEntries': self.max_entries,
+            'maxBytes': self.max_bytes,
+        }
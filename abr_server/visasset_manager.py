@@ -19,12 +19,18 @@
 import os
 import json
 import shutil
+import logging
 from django.conf import settings
 import urllib3
 import concurrent.futures
+from queue import Queue
+from threading import Lock, Thread
 from uuid import uuid4
 
 from abr_server.colormap_utilities import colormap_from_xml
+from abr_server.notifier import MessageTarget, NotifierMessage, notifier
+
+logger = logging.getLogger('django.server')
 
 POOL_MANAGER = urllib3.PoolManager()
 
@@ -35,9 +41,12 @@ def remove_visasset(uuid):
     va_path = settings.VISASSET_PATH.joinpath(uuid)
     if va_path.exists():
         shutil.rmtree(va_path)
+    # Download it again if it's referenced again
+    visasset_resolver.forget(uuid)
 
 def save_from_local(visasset_data):
-    artifact_json = visasset_data['artifactJson']
+    # Copy, the VisAsset data comes straight out of the (read-only) state
+    artifact_json = dict(visasset_data['artifactJson'])
     files_and_contents = visasset_data['artifactDataContents']
 
     new_uuid = str(uuid4())
@@ -134,4 +143,54 @@ def get_all_strings_from_json(json_object, string_list):
             get_all_strings_from_json(j, string_list)
     elif isinstance(json_object, dict):
         for j in json_object.values():
-            get_all_strings_from_json(j, string_list)
\ No newline at end of file
+            get_all_strings_from_json(j, string_list)
+
+class VisAssetResolver:
+    '''
+        Downloads VisAssets referenced in the state in the background. Each
+        UUID is only looked at once (unless it failed to download or was
+        removed since), and connected clients are told to refresh their
+        VisAsset cache as each new VisAsset lands.
+    '''
+    def __init__(self):
+        self._seen = set()
+        self._seen_lock = Lock()
+        self._queue = Queue()
+        self._thread = Thread(target=self._run, name='abr-visasset-resolver', daemon=True)
+        self._thread.start()
+
+    def resolve(self, uuids):
+        '''
+            Queue up any of `uuids` that haven't been seen before
+        '''
+        with self._seen_lock:
+            new_uuids = [u for u in uuids if u not in self._seen]
+            self._seen.update(new_uuids)
+        for uuid in new_uuids:
+            self._queue.put(uuid)
+        return new_uuids
+
+    def forget(self, uuid):
+        '''
+            Look at `uuid` again the next time it's resolved
+        '''
+        with self._seen_lock:
+            self._seen.discard(uuid)
+
+    def _run(self):
+        while True:
+            uuid = self._queue.get()
+            # Already in the local cache, nothing to do
+            if settings.VISASSET_PATH.joinpath(uuid).joinpath(settings.VISASSET_JSON).exists():
+                continue
+            try:
+                failed = download_visasset(uuid, None) # we don't know where it might've come from
+            except Exception as e:
+                failed = [str(e)]
+            if len(failed) > 0:
+                logger.warning('Failed to download VisAsset {}: {}'.format(uuid, failed))
+                self.forget(uuid)
+            else:
+                notifier.notify(NotifierMessage(MessageTarget.VisAssetsCache))
+
+visasset_resolver = VisAssetResolver()
@@ -0,0 +1,73 @@
+# precompute_keydata.py
+#
+# Precompute histograms and summary statistics for every variable of every
+# KeyData in the media folder, so the server doesn't have to read the data
+# when the colormap editor asks for them. Only KeyData that changed since
+# their sidecar was built are recomputed.
+#
+# Usage:
+#   python -m abr_server precompute_keydata [--workers N] [--force]
+#
+# Copyright (c) 2021, University of Minnesota
+# Author: Bridger Herman <herma582@umn.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from abr_server.keydata import build_sidecar, file_stamp, find_keydata, load_sidecar
+
+class Command(BaseCommand):
+    help = 'Precompute histograms and statistics for all KeyData'
+    # Only needs the settings, not the URLs (and so the views)
+    requires_system_checks = False
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of processes to use')
+        parser.add_argument('--force', action='store_true', help='Recompute even if the sidecar is up to date')
+
+    def handle(self, *args, **options):
+        if not os.path.isdir(settings.DATASET_PATH):
+            self.stdout.write('No datasets in {}'.format(settings.DATASET_PATH))
+            return
+
+        stale = []
+        fresh = 0
+        for json_path, bin_path in find_keydata(settings.DATASET_PATH):
+            if not options['force'] and load_sidecar(json_path, file_stamp(json_path, bin_path)) is not None:
+                fresh += 1
+            else:
+                stale.append((json_path, bin_path))
+        self.stdout.write('{} KeyData up to date, {} to compute'.format(fresh, len(stale)))
+
+        failed = 0
+        with ProcessPoolExecutor(max_workers=max(1, options['workers'])) as pool:
+            futures = {
+                pool.submit(build_sidecar, json_path, bin_path, settings.KEYDATA_HISTOGRAM_BINS): json_path
+                for json_path, bin_path in stale
+            }
+            for future in as_completed(futures):
+                json_path = os.path.relpath(futures[future], settings.DATASET_PATH)
+                try:
+                    future.result()
+                    self.stdout.write('Computed {}'.format(json_path))
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write('Unable to compute {}: {}'.format(json_path, e))
+
+        if failed > 0:
+            self.stderr.write('{} KeyData failed'.format(failed))
@@ -1,3 +1,772 @@
-from django.test import TestCase
+import os
+import json
+import uuid
+import random
+import asyncio
+import tempfile
+import threading
+import jsonschema
+import numpy as np
+from pathlib import Path
+from unittest import mock
+from django.test import SimpleTestCase, override_settings
 
-# Create your tests here.
+from abr_server.backup_journal import BackupJournal, BackupWriter, FSYNC_NEVER
+from abr_server.json_patch import make_patch, apply_patch, pointer_from_parts, parts_from_pointer, set_in, remove_in
+from abr_server.keydata import KeyData, UnknownVariableError, build_sidecar, file_stamp, keydata_manager, load_sidecar
+from abr_server.notifier import ClientQueue, MessageTarget, NotifierMessage, notifier, \
+    OVERFLOW_COALESCE, OVERFLOW_DROP_OLDEST, OVERFLOW_DISCONNECT
+from abr_server.schema_registry import schema_registry, SCHEMA_STATE
+from abr_server.schema_validation import StateValidator
+from abr_server.session_manager import sessions
+from abr_server.state import State, VISASSET_INPUT, is_visasset_input
+from abr_server.state_index import StateIndex
+from abr_server.state_store import LocalStateStore, SQLiteStateStore
+from abr_server.undo_history import UndoHistory
+
+def counter_patch(value):
+    return [{'op': 'replace', 'path': '/n', 'value': value}]
+
+
+class ClientQueueTests(SimpleTestCase):
+    def run_queue(self, policy, messages, max_size=3):
+        '''
+            Offer `messages` all at once (faster than they can be sent), and
+            return (what was sent, whether the client was closed, metrics)
+        '''
+        sent = []
+        closed = []
+
+        async def send(message):
+            sent.append(message)
+
+        async def close():
+            closed.append(True)
+
+        async def main():
+            queue = ClientQueue(max_size, policy, 0, lambda m: m, send, close)
+            for message in messages:
+                queue.offer(message)
+            # Let the queue drain
+            for _ in range(10):
+                await asyncio.sleep(0)
+            return queue.metrics()
+
+        metrics = asyncio.run(main())
+        return sent, len(closed) > 0, metrics
+
+    def state_messages(self, count):
+        return [
+            NotifierMessage(MessageTarget.State, counter_patch(i), i, i - 1, session='default')
+            for i in range(1, count + 1)
+        ]
+
+    def test_coalesce(self):
+        messages = self.state_messages(10)
+        messages.insert(5, NotifierMessage(MessageTarget.Thumbnail, revision=7))
+        sent, closed, metrics = self.run_queue(OVERFLOW_COALESCE, messages)
+        self.assertFalse(closed)
+        self.assertLessEqual(len(sent), 3)
+        self.assertGreater(metrics['coalesced'], 0)
+        self.assertEqual(metrics['dropped'], 0)
+
+        # Everything still gets there, as few consecutive patches
+        self.assertEqual([m.revision for m in sent if m.target == MessageTarget.Thumbnail], [7])
+        state = {'n': 0}
+        for message in sent:
+            if message.target == MessageTarget.State:
+                self.assertIsNotNone(message.patch)
+                state = apply_patch(state, message.patch)
+        self.assertEqual(state, {'n': 10})
+        self.assertEqual(sent[-1].revision, 10)
+
+    def test_coalesce_gap_needs_full_state(self):
+        messages = self.state_messages(5)
+        del messages[2]
+        sent, closed, metrics = self.run_queue(OVERFLOW_COALESCE, messages, max_size=2)
+        # Can't patch across the missing revision, so the client is told to
+        # fetch the whole state at revision 4, then gets the patch to 5
+        self.assertEqual([(m.revision, m.patch is None) for m in sent], [(4, True), (5, False)])
+
+    def test_drop_oldest(self):
+        sent, closed, metrics = self.run_queue(OVERFLOW_DROP_OLDEST, self.state_messages(10))
+        self.assertFalse(closed)
+        self.assertEqual([m.revision for m in sent], [8, 9, 10])
+        self.assertEqual(metrics['dropped'], 7)
+
+    def test_disconnect(self):
+        sent, closed, metrics = self.run_queue(OVERFLOW_DISCONNECT, self.state_messages(10))
+        self.assertTrue(closed)
+        self.assertEqual(sent, [])
+        self.assertEqual(metrics['queued'], 0)
+
+    def test_under_limit(self):
+        sent, closed, metrics = self.run_queue(OVERFLOW_DISCONNECT, self.state_messages(3))
+        self.assertFalse(closed)
+        self.assertEqual([m.revision for m in sent], [1, 2, 3])
+
+
+class JsonPatchTests(SimpleTestCase):
+    SRC = {
+        'version': '0.2.0',
+        'impressions': {
+            'a/b': {'name': 'one', 'inputValues': {'x': 1}},
+            'c~d': {'name': 'two', 'tags': [1, 2]},
+        },
+        'uiData': {'kept': {'deep': True}},
+    }
+    DST = {
+        'version': '0.2.0',
+        'impressions': {
+            'a/b': {'name': 'uno', 'inputValues': {'x': 1, 'y': None}},
+            'e': {'name': 'three'},
+        },
+        'uiData': {'kept': {'deep': True}},
+        'name': 'new',
+    }
+
+    def test_apply_and_inverse(self):
+        patch = make_patch(self.SRC, self.DST)
+        self.assertEqual(apply_patch(self.SRC, patch), self.DST)
+        inverse = make_patch(self.DST, self.SRC)
+        self.assertEqual(apply_patch(self.DST, inverse), self.SRC)
+
+    def test_leaves_original_alone(self):
+        before = repr(self.SRC)
+        new_state = apply_patch(self.SRC, make_patch(self.SRC, self.DST))
+        self.assertEqual(repr(self.SRC), before)
+        # Unchanged subtrees are shared, not copied
+        self.assertIs(new_state['uiData'], self.SRC['uiData'])
+
+    def test_only_changed_paths(self):
+        patch = make_patch(self.SRC, self.DST)
+        paths = {op['path'] for op in patch}
+        self.assertEqual(paths, {
+            '/impressions/a~1b/name',
+            '/impressions/a~1b/inputValues/y',
+            '/impressions/c~0d',
+            '/impressions/e',
+            '/name',
+        })
+        self.assertEqual(make_patch(self.SRC, self.SRC), [])
+
+    def test_pointer_round_trip(self):
+        for parts in ([], ['a/b', 'c~d'], ['~1', '/', '']):
+            self.assertEqual(parts_from_pointer(pointer_from_parts(parts)), parts)
+
+    def test_replace_root(self):
+        self.assertEqual(apply_patch({'a': 1}, make_patch({'a': 1}, [1, 2])), [1, 2])
+
+
+class SchemaValidationTests(SimpleTestCase):
+    '''
+        Validating only the subtree a patch touches should reach the same
+        verdict as validating the whole document
+    '''
+    SCHEMA = {
+        '$schema': 'http://json-schema.org/draft-07/schema#',
+        'definitions': {
+            'point': {
+                'type': 'object',
+                'properties': {'x': {'type': 'number'}, 'y': {'type': 'number'}},
+                'required': ['x', 'y'],
+                'additionalProperties': False,
+            },
+        },
+        'type': 'object',
+        'properties': {
+            'version': {'type': 'string'},
+            'closed': {
+                'type': 'object',
+                'properties': {'a': {'type': 'integer'}},
+                'additionalProperties': False,
+            },
+            'origin': {'$ref': '#/definitions/point'},
+            'tags': {
+                'type': 'object',
+                'patternProperties': {'^n_': {'type': 'number'}, '^s_': {'type': 'string'}},
+                'additionalProperties': {'type': 'boolean'},
+            },
+        },
+        'required': ['version', 'origin'],
+        'additionalProperties': False,
+    }
+    BASE = {
+        'version': '1',
+        'closed': {'a': 1},
+        'origin': {'x': 0, 'y': 0},
+        'tags': {'n_1': 1, 's_1': 'one', 'flag': True},
+    }
+
+    def setUp(self):
+        self.validator = StateValidator(self.SCHEMA)
+        self.full = jsonschema.Draft7Validator(self.SCHEMA)
+
+    def check(self, new_state, valid):
+        patch = make_patch(self.BASE, new_state)
+        self.assertNotEqual(patch, [])
+        try:
+            self.validator.validate_patch(new_state, patch)
+            subtree_valid = True
+        except jsonschema.ValidationError:
+            subtree_valid = False
+        self.assertEqual(self.full.is_valid(new_state), valid)
+        self.assertEqual(subtree_valid, valid, patch)
+
+    def edit(self, path, value=None, remove=False):
+        # Both leave BASE alone
+        return remove_in(self.BASE, path) if remove else set_in(self.BASE, path, value)
+
+    def test_remove_required(self):
+        self.check(self.edit(['version'], remove=True), False)
+        self.check(self.edit(['origin', 'y'], remove=True), False)
+        self.check(self.edit(['closed', 'a'], remove=True), True)
+        self.check(self.edit(['tags', 'flag'], remove=True), True)
+
+    def test_additional_properties_false(self):
+        self.check(self.edit(['bogus'], 1), False)
+        self.check(self.edit(['closed', 'b'], 1), False)
+        self.check(self.edit(['origin', 'z'], 1), False)
+        self.check(self.edit(['closed', 'a'], 'one'), False)
+        self.check(self.edit(['closed', 'a'], 2), True)
+
+    def test_local_ref(self):
+        self.check(self.edit(['origin', 'x'], 'one'), False)
+        self.check(self.edit(['origin', 'x'], 5), True)
+        self.check(self.edit(['origin'], {'x': 1}), False)
+        self.check(self.edit(['origin'], {'x': 1, 'y': 2}), True)
+        # Checked inside the $ref, not from the root
+        self.assertEqual(self.validator.locate(['origin', 'x'])[0], 2)
+
+    def test_pattern_properties(self):
+        self.check(self.edit(['tags', 'n_2'], 2), True)
+        self.check(self.edit(['tags', 'n_2'], 'two'), False)
+        self.check(self.edit(['tags', 's_2'], 2), False)
+        self.check(self.edit(['tags', 's_2'], 'two'), True)
+        self.check(self.edit(['tags', 'other'], 'two'), False)
+        self.check(self.edit(['tags', 'other'], False), True)
+        self.assertEqual(self.validator.locate(['tags', 'n_2'])[0], 2)
+
+    def test_root(self):
+        self.check(self.edit([], {'version': '2', 'origin': {'x': 1, 'y': 1}}), True)
+        self.check(self.edit([], {'version': '2'}), False)
+        self.check(self.edit([], [self.BASE]), False)
+        self.check(self.edit([], dict(self.BASE, bogus=1)), False)
+
+
+class BackupJournalTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name).joinpath('backup.json')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def journal(self, checkpoint_interval=100):
+        return BackupJournal(self.path, fsync_policy=FSYNC_NEVER, checkpoint_interval=checkpoint_interval)
+
+    def write(self, journal, start, stop):
+        for i in range(start, stop):
+            journal.append(i, counter_patch(i), {'n': i})
+
+    def test_restore_after_crash(self):
+        journal = self.journal()
+        journal.checkpoint(0, {'n': 0})
+        self.write(journal, 1, 6)
+        # No close(), as if the server went down
+        self.assertEqual(self.journal().restore(), (5, {'n': 5}))
+
+    def test_torn_last_entry(self):
+        journal = self.journal()
+        journal.checkpoint(0, {'n': 0})
+        self.write(journal, 1, 4)
+        with open(journal.journal_path, 'ab') as fout:
+            fout.write(b'{"revision": 4, "time": 0, "pat')
+        self.assertEqual(self.journal().restore(), (3, {'n': 3}))
+
+    def test_checkpoint_then_journal(self):
+        journal = self.journal(checkpoint_interval=4)
+        journal.checkpoint(0, {'n': 0})
+        self.write(journal, 1, 11)
+        self.assertEqual(self.journal().restore(), (10, {'n': 10}))
+        # Journal only holds what came after the last checkpoint
+        with open(journal.journal_path, 'rb') as fin:
+            self.assertEqual(len(fin.readlines()), 2)
+
+    def test_no_backup(self):
+        self.assertIsNone(self.journal().restore())
+
+    def test_set_aside(self):
+        journal = self.journal()
+        journal.checkpoint(0, {'n': 0})
+        self.write(journal, 1, 3)
+        self.assertTrue(journal.exists())
+        moved = journal.set_aside()
+        self.assertEqual(len(moved), 2)
+        self.assertFalse(journal.exists())
+        self.assertIsNone(self.journal().restore())
+        # What was set aside is still there
+        self.assertEqual(json.loads(moved[0].read_text())['state'], {'n': 0})
+
+
+class BackupWriterTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = Path(self.tmp.name).joinpath('backup.json')
+        journal = BackupJournal(self.path, fsync_policy=FSYNC_NEVER)
+        journal.checkpoint(0, {})
+        self.writer = BackupWriter(journal, write_interval=0.2)
+        self.addCleanup(self.writer.close)
+
+    def submit_burst(self, count):
+        '''
+            Submit `count` changes to a nested state as fast as possible.
+            Returns the last state submitted.
+        '''
+        state = {}
+        for revision in range(1, count + 1):
+            new_state = set_in(state, ['impressions', str(revision % 7), 'n'], revision)
+            if revision % 5 == 0:
+                new_state = remove_in(new_state, ['impressions', str((revision + 3) % 7)])
+            self.writer.submit(revision, make_patch(state, new_state), new_state)
+            state = new_state
+        return state
+
+    def test_coalesces(self):
+        self.submit_burst(50)
+        self.writer.flush()
+        metrics = self.writer.metrics()
+        self.assertEqual(metrics['submitted'], 50)
+        self.assertLess(metrics['writes'], metrics['submitted'])
+        self.assertGreater(metrics['coalesced'], 0)
+        self.assertEqual(metrics['writes'] + metrics['coalesced'], metrics['submitted'])
+
+    def test_flush(self):
+        self.submit_burst(20)
+        self.writer.flush()
+        metrics = self.writer.metrics()
+        self.assertEqual(metrics['pending'], 0)
+        self.assertEqual(metrics['lastWrittenRevision'], metrics['lastSubmittedRevision'])
+        self.assertEqual(metrics['lastWrittenRevision'], 20)
+
+    def test_restores_last_submitted(self):
+        state = self.submit_burst(30)
+        self.writer.flush()
+        self.assertEqual(BackupJournal(self.path).restore(), (30, state))
+
+    def test_close_writes_pending(self):
+        state = self.submit_burst(10)
+        self.writer.close()
+        self.assertEqual(BackupJournal(self.path).restore(), (10, state))
+
+
+class StateBackupTests(SimpleTestCase):
+    '''
+        Starting a state on top of an existing local backup
+    '''
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        # Cleanups run last-in first-out, so states are closed before this
+        self.addCleanup(self.tmp.cleanup)
+        self.path = Path(self.tmp.name).joinpath('backup.json')
+
+    def state(self, restore=True):
+        state = State('test', schema_registry.get(SCHEMA_STATE), schema_registry.validator(SCHEMA_STATE), LocalStateStore(self.path), restore=restore)
+        self.addCleanup(state.close)
+        return state
+
+    def backup(self, state):
+        journal = BackupJournal(self.path, fsync_policy=FSYNC_NEVER)
+        journal.checkpoint(3, state)
+        journal.close()
+
+    def set_aside(self):
+        return sorted(p for p in self.path.parent.iterdir() if p.name.startswith('backup.json.bak.'))
+
+    def test_restored(self):
+        self.backup({'version': '0.2.0', 'uiData': {'n': 1}})
+        state = self.state()
+        self.assertEqual(state.revision, 3)
+        self.assertEqual(state.get_path(['uiData', 'n']), 1)
+        self.assertEqual(self.set_aside(), [])
+
+    def test_invalid_backup_is_kept(self):
+        self.backup({'version': '0.2.0', 'bogus': 1})
+        state = self.state()
+        self.assertEqual(state.revision, 0)
+        self.assertEqual(len(self.set_aside()), 1)
+        self.assertEqual(json.loads(self.set_aside()[0].read_text())['state'], {'version': '0.2.0', 'bogus': 1})
+
+    def test_not_restoring_keeps_backup(self):
+        self.backup({'version': '0.2.0', 'uiData': {'n': 1}})
+        state = self.state(restore=False)
+        self.assertIsNone(state.get_path(['uiData']))
+        self.assertEqual(len(self.set_aside()), 1)
+
+    def test_no_backup(self):
+        self.state(restore=False)
+        self.assertEqual(self.set_aside(), [])
+        self.assertTrue(self.path.exists())
+
+
+class StateNotifyTests(SimpleTestCase):
+    '''
+        Notifications go out after the state is unlocked
+    '''
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.state = State('test', schema_registry.get(SCHEMA_STATE), schema_registry.validator(SCHEMA_STATE),
+            LocalStateStore(Path(self.tmp.name).joinpath('backup.json')), restore=False)
+        self.addCleanup(self.state.close)
+
+        self.messages = []
+        notify = mock.patch.object(notifier, 'notify', side_effect=self.notify)
+        notify.start()
+        self.addCleanup(notify.stop)
+
+    def notify(self, message):
+        # Another thread would be stuck waiting if the state were still locked
+        acquired = []
+        def try_lock():
+            acquired.append(self.state._state_lock.acquire(timeout=0))
+            if acquired[0]:
+                self.state._state_lock.release()
+        thread = threading.Thread(target=try_lock)
+        thread.start()
+        thread.join()
+        self.assertTrue(acquired[0], 'notified while the state was locked')
+        self.messages.append(message)
+
+    def test_unlocked(self):
+        self.assertEqual(self.state.set_path(['uiData', 'n'], 1), '')
+        self.assertEqual(self.state.apply_batch([{'op': 'set', 'path': ['uiData', 'm'], 'value': 2}]), '')
+        self.assertEqual(self.state.remove_path(['uiData', 'm']), '')
+        self.state.remove_all('n')
+        self.assertEqual(self.state.undo(), '')
+        self.assertEqual(self.state.redo(), '')
+        self.assertEqual(self.state.jump_to_history(0), '')
+        self.assertEqual([m.revision for m in self.messages], list(range(1, 8)))
+
+    def test_nothing_changed(self):
+        self.assertEqual(self.state.set_path(['version'], self.state.get_path(['version'])), '')
+        self.assertNotEqual(self.state.set_path(['bogus'], 1), '')
+        self.assertEqual(self.messages, [])
+
+    def test_jump_to_current_position(self):
+        self.state.set_path(['uiData', 'n'], 1)
+        self.state.set_path(['uiData', 'n'], 2)
+        self.state.undo()
+        revision = self.state.get_revision()
+        self.assertEqual(self.state.jump_to_history(self.state.history.position), '')
+        self.assertEqual(self.state.get_revision(), revision)
+        self.assertEqual(len(self.messages), 3)
+        self.assertTrue(self.state.history.can_redo())
+
+
+class StateETagTests(SimpleTestCase):
+    '''
+        Conditional GETs and PUTs, in a session of their own
+    '''
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.settings = override_settings(SESSION_BACKUP_PATH=Path(self.tmp.name))
+        self.settings.enable()
+        self.session = 'etag-{}'.format(uuid.uuid4().hex[:8])
+        self.url = '/api/s/{}/state'.format(self.session)
+
+    def tearDown(self):
+        # Save and unload the session before its backup folder goes away
+        with sessions._lock:
+            if self.session in sessions._sessions:
+                sessions._evict(self.session)
+        self.settings.disable()
+        self.tmp.cleanup()
+
+    def put(self, path, value, **headers):
+        return self.client.put(self.url + path, data=json.dumps(value), content_type='application/json', **headers)
+
+    def test_not_modified(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH='W/' + etag).status_code, 304)
+
+        self.put('/uiData/a', 1)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_conditional_write(self):
+        etag = self.client.get(self.url)['ETag']
+        self.assertEqual(self.put('/uiData/a', 1, HTTP_IF_MATCH=etag).status_code, 200)
+
+        # Someone else's change got there first
+        response = self.put('/uiData/a', 2, HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 412)
+        current = self.client.get(self.url)
+        self.assertEqual(response['ETag'], current['ETag'])
+        self.assertEqual(json.loads(current.content)['state']['uiData'], {'a': 1})
+
+        self.assertEqual(self.put('/uiData/a', 3, HTTP_IF_MATCH=response['ETag']).status_code, 200)
+        self.assertEqual(self.put('/uiData/a', 4, HTTP_IF_MATCH='*').status_code, 200)
+        # From another run of the server
+        self.assertEqual(self.put('/uiData/a', 5, HTTP_IF_MATCH='"0-0"').status_code, 412)
+
+
+class StateIndexTests(SimpleTestCase):
+    KEYS = ['a', 'b', 'uuid', 'inputValue', 'inputGenre']
+
+    def walk(self, value, path=()):
+        # Every (key, path) and every VisAsset input, the slow way
+        keys, visassets = set(), set()
+        if isinstance(value, dict):
+            if is_visasset_input(value):
+                visassets.add(path)
+            for key, sub_value in value.items():
+                keys.add((key, path + (key,)))
+                sub_keys, sub_visassets = self.walk(sub_value, path + (key,))
+                keys |= sub_keys
+                visassets |= sub_visassets
+        return keys, visassets
+
+    def random_value(self, rng, depth):
+        choice = rng.random()
+        if depth > 3 or choice < 0.3:
+            return rng.choice([1, 'x', None, [1, {'a': 2}]])
+        if choice < 0.45:
+            return {'inputValue': 'va', 'inputGenre': rng.choice(['VisAsset', 'Variable'])}
+        return {rng.choice(self.KEYS): self.random_value(rng, depth + 1) for _ in range(rng.randint(0, 3))}
+
+    def random_path(self, rng):
+        return [rng.choice(self.KEYS) for _ in range(rng.randint(1, 4))]
+
+    def test_matches_full_walk(self):
+        rng = random.Random(0)
+        index = StateIndex({VISASSET_INPUT: is_visasset_input})
+        state = {}
+        index.rebuild(state)
+        for _ in range(500):
+            try:
+                if rng.random() < 0.7:
+                    new_state = set_in(state, self.random_path(rng), self.random_value(rng, 0))
+                else:
+                    new_state = remove_in(state, self.random_path(rng))
+            except (ValueError, TypeError, AttributeError):
+                # Went through something that isn't an object
+                continue
+            index.update(state, new_state, make_patch(state, new_state))
+            state = new_state
+
+            keys, visassets = self.walk(state)
+            for key in self.KEYS:
+                self.assertEqual(index.find_key(key), {path for k, path in keys if k == key})
+            self.assertEqual(index.find(VISASSET_INPUT), visassets)
+
+    def test_replace_root(self):
+        index = StateIndex()
+        old_state = {'a': {'b': 1}}
+        index.rebuild(old_state)
+        index.update(old_state, {'b': 2}, [{'op': 'replace', 'path': '', 'value': {'b': 2}}])
+        self.assertEqual(index.find_key('a'), set())
+        self.assertEqual(index.find_key('b'), {('b',)})
+
+
+class KeyDataSidecarTests(SimpleTestCase):
+    BINS = [16, 540]
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.json_path = os.path.join(self.tmp.name, 'Test.json')
+        self.bin_path = os.path.join(self.tmp.name, 'Test.bin')
+
+        rng = np.random.default_rng(0)
+        num_points, num_cell_indices = 5000, 40
+        self.variables = {
+            'normal': rng.normal(size=num_points).astype('f4'),
+            'uniform': rng.random(num_points, dtype='f4'),
+            'constant': np.full(num_points, 3.0, dtype='f4'),
+        }
+        with open(self.bin_path, 'wb') as fout:
+            fout.write(rng.random(num_points * 3, dtype='f4').tobytes())
+            fout.write(np.arange(num_cell_indices, dtype='i4').tobytes())
+            for values in self.variables.values():
+                fout.write(values.tobytes())
+        with open(self.json_path, 'w') as fout:
+            json.dump({
+                'num_points': num_points,
+                'num_cell_indices': num_cell_indices,
+                'scalarArrayNames': list(self.variables),
+                'scalarMins': [float(v.min()) for v in self.variables.values()],
+                'scalarMaxes': [float(v.max()) for v in self.variables.values()],
+            }, fout)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def open(self, use_sidecar=True):
+        return KeyData(self.json_path, self.bin_path, file_stamp(self.json_path, self.bin_path), use_sidecar)
+
+    def test_matches_live_histograms(self):
+        build_sidecar(self.json_path, self.bin_path, self.BINS)
+        precomputed = self.open()
+        live = self.open(use_sidecar=False)
+        self.assertIsNotNone(precomputed.sidecar)
+
+        for name, values in self.variables.items():
+            np.testing.assert_array_equal(live.variable(name), values)
+            for bins in self.BINS:
+                hist, edges = precomputed.histogram(name, bins)
+                live_hist, live_edges = live.histogram(name, bins)
+                np.testing.assert_array_equal(hist, live_hist)
+                np.testing.assert_allclose(edges, live_edges, rtol=1e-6)
+
+            stats = precomputed.stats(name)
+            self.assertEqual(stats['count'], len(values))
+            self.assertAlmostEqual(stats['min'], float(values.min()))
+            self.assertAlmostEqual(stats['max'], float(values.max()))
+            self.assertAlmostEqual(stats['mean'], float(values.mean(dtype='f8')), places=5)
+            self.assertAlmostEqual(stats['percentiles']['50'], float(np.median(values)), places=5)
+
+    def test_other_bins_and_ranges_are_live(self):
+        build_sidecar(self.json_path, self.bin_path, self.BINS)
+        precomputed = self.open()
+        values = self.variables['uniform']
+        for bins, value_range in ((100, None), (16, (0.25, 0.5))):
+            hist, _edges = precomputed.histogram('uniform', bins, value_range)
+            np.testing.assert_array_equal(hist, np.histogram(values, bins=bins, range=value_range)[0])
+
+    def test_stale_sidecar_is_ignored(self):
+        build_sidecar(self.json_path, self.bin_path, self.BINS)
+        stat = os.stat(self.bin_path)
+        os.utime(self.bin_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+        self.assertIsNone(load_sidecar(self.json_path, file_stamp(self.json_path, self.bin_path)))
+        self.assertIsNone(self.open().stats('normal'))
+
+    def test_unknown_variable(self):
+        build_sidecar(self.json_path, self.bin_path, self.BINS)
+        with self.assertRaises(UnknownVariableError):
+            self.open().histogram('missing', 16)
+        with self.assertRaises(UnknownVariableError):
+            keydata_manager.histogram(self.open(), 'missing', 100)
+
+    def test_worker_process(self):
+        keydata = self.open()
+        for name, values in self.variables.items():
+            hist, edges = keydata_manager.histogram(keydata, name, 100)
+            live_hist, live_edges = np.histogram(values, bins=100)
+            np.testing.assert_array_equal(hist, live_hist)
+            np.testing.assert_array_equal(edges, live_edges)
+
+
+class BatchHistogramTests(SimpleTestCase):
+    def post(self, items):
+        return self.client.post('/api/histograms', data=json.dumps(items), content_type='application/json')
+
+    def test_rejects_paths_outside_datasets(self):
+        for path in ('../../KeyData/x', 'Org/../KeyData/x', '/Org/DS/KeyData/x', 'Org//KeyData/x',
+                'Org/DS/KeyData/', 'Org/./KeyData/x', 'Org/DS\\..\\../KeyData/x', 'Org/DS/x'):
+            response = self.post([{'keyData': path, 'variable': 'a'}])
+            self.assertEqual(response.status_code, 400, path)
+
+    def test_missing_keydata(self):
+        response = self.post([{'keyData': 'Org/DS/KeyData/missing-{}'.format(uuid.uuid4().hex), 'variable': 'a'}])
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('error', json.loads(response.content)['histograms'][0])
+
+
+class UndoHistoryTests(SimpleTestCase):
+    def fill(self, history, count):
+        # Record `count` changes of {'n': i}, returning the final state
+        state = {'n': 0}
+        for i in range(1, count + 1):
+            new_state = {'n': i}
+            history.record(state, new_state, counter_patch(i))
+            state = new_state
+        return state
+
+    def test_trims_to_max_entries(self):
+        history = UndoHistory({'n': 0}, max_entries=10, checkpoint_interval=3)
+        state = self.fill(history, 25)
+        self.assertEqual(len(history), 10)
+        self.assertEqual(history.position, 10)
+        # The oldest state left is from before the last 10 changes
+        self.assertEqual(history.state_at(0, state), {'n': 15})
+        self.assertEqual(history.state_at(10, state), {'n': 25})
+
+    def test_trims_to_max_bytes(self):
+        history = UndoHistory({'n': 0}, max_bytes=500)
+        self.fill(history, 100)
+        self.assertLessEqual(history.bytes, 500)
+        self.assertLess(len(history), 100)
+
+    def test_checkpoints_once_full(self):
+        history = UndoHistory({'n': 0}, max_entries=100, checkpoint_interval=10)
+        state = self.fill(history, 350)
+        checkpoints = [i for i, entry in enumerate(history._entries) if entry.checkpoint is not None]
+        self.assertGreaterEqual(len(checkpoints), 9)
+        # No stretch longer than the interval without one
+        gaps = [b - a for a, b in zip([-1] + checkpoints, checkpoints + [len(history)])]
+        self.assertLessEqual(max(gaps), 10)
+        for index in (0, 37, 50, 99, 100):
+            self.assertEqual(history.state_at(index, state), {'n': 250 + index})
+
+    def test_record_discards_redo(self):
+        history = UndoHistory({'n': 0}, checkpoint_interval=4)
+        state = self.fill(history, 10)
+        state = history.state_at(5, state)
+        history.position = 5
+        history.record(state, {'n': 'x'}, counter_patch('x'))
+        self.assertEqual(len(history), 6)
+        self.assertFalse(history.can_redo())
+        self.assertEqual(history.state_at(5, {'n': 'x'}), {'n': 5})
+
+
+class SharedUndoTests(SimpleTestCase):
+    '''
+        Two workers sharing a state through the same SQLite store
+    '''
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        db_path = os.path.join(self.tmp.name, 'state.sqlite3')
+        self.a, self.b = [
+            State('test', schema_registry.get(SCHEMA_STATE), schema_registry.validator(SCHEMA_STATE), SQLiteStateStore(db_path, 'test'))
+            for _ in range(2)
+        ]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def value(self, state):
+        return state.get_path(['uiData', 'n'])
+
+    def test_undo_redo_across_workers(self):
+        for i in range(1, 4):
+            self.assertEqual(self.a.set_path(['uiData', 'n'], i), '')
+
+        self.assertEqual(self.b.undo(), '')
+        self.assertEqual(self.value(self.b), 2)
+        self.assertEqual(self.a.undo(), '')
+        self.assertEqual(self.value(self.a), 1)
+        self.assertEqual(self.b.undo(), '')
+        self.assertEqual(self.value(self.b), None)
+
+        self.assertEqual(self.a.redo(), '')
+        self.assertEqual(self.value(self.a), 1)
+        self.assertEqual(self.b.redo(), '')
+        self.assertEqual(self.value(self.b), 2)
+        self.assertEqual(self.a.get_history()['position'], 2)
+
+    def test_new_change_after_undo_clears_redo_everywhere(self):
+        self.a.set_path(['uiData', 'n'], 1)
+        self.a.set_path(['uiData', 'n'], 2)
+        self.b.undo()
+        self.a.set_path(['uiData', 'n'], 'x')
+        self.assertEqual(self.b.redo(), 'Nothing to redo')
+        self.assertEqual(self.b.undo(), '')
+        self.assertEqual(self.value(self.a), 1)
@@ -14,22 +14,38 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from django.urls import path, re_path
+from django.urls import include, path, re_path
 
 from . import views
 
-urlpatterns = [
-    path('', views.index, name='index'),
-    path('schemas/<str:schema_name>/', views.schema),
+# Everything to do with one state session. The default session is at /api/...
+# and named sessions are at /api/s/<session>/...
+session_urlpatterns = [
     path('undo', views.undo),
     path('redo', views.redo),
-    re_path('^state/*', views.modify_state),
-    re_path('^remove-path/*', views.remove_path),
+    path('history', views.history),
+    path('history/<int:index>', views.history),
+    path('metrics', views.metrics),
+    path('state/batch', views.batch_state),
+    re_path(r'^state(?P<item_path>/.*)?$', views.modify_state),
+    re_path(r'^remove-path(?P<item_path>/.*)?$', views.remove_path),
     path('remove/<str:value>', views.remove),
+    path('save-local-visasset/<str:uuid>', views.save_visasset),
+]
+
+urlpatterns = [
+    path('', views.index, name='index'),
+    path('schemas/<str:schema_name>/', views.schema),
+    path('sessions', views.list_sessions),
+    path('thumbnails', views.list_thumbnails),
+    path('thumbnails/latest', views.thumbnail),
+    path('thumbnails/<int:version>', views.thumbnail),
+    path('s/<str:session>/', include(session_urlpatterns)),
+] + session_urlpatterns + [
     path('visassets', views.list_visassets),
     path('datasets', views.list_datasets),
     path('download-visasset/<str:uuid>', views.download_visasset),
     path('remove-visasset/<str:uuid>', views.remove_visasset),
-    path('save-local-visasset/<str:uuid>', views.save_visasset),
+    path('histograms', views.batch_histograms),
     path('histogram/<str:org_name>/<str:dataset_name>/KeyData/<str:key_data_name>/<str:variable_label>', views.get_histogram),
 ]
@@ -15,22 +15,28 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import os
-import json
 import fnmatch
-import numpy as np
+import functools
+from pathlib import Path
 from django.shortcuts import redirect
 from django.views.decorators.csrf import csrf_exempt
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse
 
 from django.conf import settings
 
-from abr_server.state import state
+from abr_server.state import StaleRevisionError
+from abr_server.session_manager import sessions, is_valid_session_name, DEFAULT_SESSION
 from abr_server.notifier import MessageTarget, NotifierMessage, notifier
-from abr_server import visasset_manager
+from abr_server import visasset_manager, json_codec
+from abr_server.image_manager import image_manager
+from abr_server.keydata import UnknownVariableError, keydata_manager
 
 VISASSET_CACHE = {}
 DATA_CACHE = {}
 
+def json_response(data, **kwargs):
+    return HttpResponse(json_codec.dumps(data), content_type='application/json', **kwargs)
+
 # Create your views here.
 def index(request):
     return HttpResponse('Nothing to see here; this URL is for computers')
@@ -38,40 +44,145 @@ def index(request):
 def schema(request, schema_name):
     return redirect(settings.STATIC_URL + 'schemas/{}'.format(schema_name))
 
+def with_session(view):
+    '''
+        Look up the state session named in the URL (/api/s/<session>/...), or
+        the default session, and pass it to the view as `state`
+    '''
+    @functools.wraps(view)
+    def wrapper(request, *args, session=DEFAULT_SESSION, **kwargs):
+        if not is_valid_session_name(session):
+            return HttpResponse('Invalid session name `{}`'.format(session), status=404)
+        with sessions.use(session) as state:
+            return view(request, state, *args, **kwargs)
+    return wrapper
+
+# ETags for the state are just its revision (and which run of the server it
+# came from)
+def state_etag(state, revision):
+    return '"{}-{}"'.format(state.epoch, revision)
+
+def request_etags(request, header):
+    tags = request.META.get(header)
+    if tags is None:
+        return None
+    # Weak and strong ETags compare the same here
+    return [t.strip()[2:] if t.strip().startswith('W/') else t.strip() for t in tags.split(',')]
+
+def expected_revision(request, state):
+    '''
+        The state revision a conditional write was made against (If-Match),
+        or None if the write is unconditional
+    '''
+    tags = request_etags(request, 'HTTP_IF_MATCH')
+    if tags is None or '*' in tags:
+        return None
+    epoch, _, revision = tags[0].strip('"').partition('-')
+    try:
+        if epoch == state.epoch:
+            return int(revision)
+    except ValueError:
+        pass
+    # Can't possibly match
+    return -1
+
+def stale_revision_response(state, e):
+    response = HttpResponse(str(e), status=412)
+    response['ETag'] = state_etag(state, e.revision)
+    return response
+
 # State access and modification methods
 @csrf_exempt
-def modify_state(request):
-    item_path_parts = clean_state_path('/api/state', request.path)
+@with_session
+def modify_state(request, state, item_path=None):
+    item_path_parts = clean_state_path('', item_path or '')
+    return state_path(request, state, item_path_parts)
+
+def state_path(request, state, item_path_parts):
     if request.method == 'GET':
-        resp = state.get_path(item_path_parts)
-        return JsonResponse({'state': resp})
+        # If nothing has changed since the client last asked, don't bother
+        # looking up or serializing anything
+        tags = request_etags(request, 'HTTP_IF_NONE_MATCH')
+        if tags is not None:
+            revision = state.get_revision()
+            if '*' in tags or state_etag(state, revision) in tags:
+                response = HttpResponse(status=304)
+                response['ETag'] = state_etag(state, revision)
+                return response
+
+        revision, body = state.get_path_serialized(item_path_parts)
+        response = HttpResponse(body, content_type='application/json')
+        response['ETag'] = state_etag(state, revision)
+        # Let browsers cache the state, but always check that it's current
+        response['Cache-Control'] = 'no-cache'
+        return response
     elif request.method == 'PUT':
-        err_message = state.set_path(item_path_parts, json.loads(request.body))
+        try:
+            err_message = state.set_path(item_path_parts, json_codec.loads(request.body), expected_revision(request, state))
+        except StaleRevisionError as e:
+            return stale_revision_response(state, e)
         if len(err_message) > 0:
             return HttpResponse(err_message, status=400)
         else:
             return HttpResponse()
 
 @csrf_exempt
-def remove_path(request):
-    item_path_parts = clean_state_path('/api/remove-path', request.path)
+@with_session
+def batch_state(request, state):
+    # Anything other than POST is a regular request for a state path that
+    # happens to be called "batch"
+    if request.method != 'POST':
+        return state_path(request, state, ['batch'])
+
+    try:
+        operations = json_codec.loads(request.body)
+        if not isinstance(operations, list):
+            raise ValueError('expected a list of operations')
+        # Paths can be given like in the URL (e.g. `impressions/"a/b"/name`)
+        for operation in operations:
+            if isinstance(operation.get('path'), str):
+                operation['path'] = clean_state_path('', operation['path'])
+    except (ValueError, AttributeError) as e:
+        return HttpResponse('Invalid batch: {}'.format(e), status=400)
+
+    try:
+        err_message = state.apply_batch(operations, expected_revision(request, state))
+    except StaleRevisionError as e:
+        return stale_revision_response(state, e)
+    if len(err_message) > 0:
+        return HttpResponse(err_message, status=400)
+    else:
+        return HttpResponse()
+
+@csrf_exempt
+@with_session
+def remove_path(request, state, item_path=None):
+    item_path_parts = clean_state_path('', item_path or '')
 
     if request.method == 'DELETE':
-        state.remove_path(item_path_parts)
+        try:
+            state.remove_path(item_path_parts, expected_revision(request, state))
+        except StaleRevisionError as e:
+            return stale_revision_response(state, e)
         return HttpResponse('OK')
     else:
         return HttpResponse('Method for remove must be DELETE', status=400)
 
 @csrf_exempt
-def remove(request, value):
+@with_session
+def remove(request, state, value):
     if request.method == 'DELETE':
-        state.remove_all(value)
+        try:
+            state.remove_all(value, expected_revision(request, state))
+        except StaleRevisionError as e:
+            return stale_revision_response(state, e)
         return HttpResponse('OK')
     else:
         return HttpResponse('Method for remove must be DELETE', status=400)
 
 @csrf_exempt
-def undo(request):
+@with_session
+def undo(request, state):
     if request.method == 'POST':
         err_message = state.undo()
         if len(err_message) > 0:
@@ -82,7 +193,8 @@ def undo(request):
         return HttpResponse('Method for undo must be POST', status=400)
 
 @csrf_exempt
-def redo(request):
+@with_session
+def redo(request, state):
     if request.method == 'POST':
         err_message = state.redo()
         if len(err_message) > 0:
@@ -92,6 +204,64 @@ def redo(request):
     else:
         return HttpResponse('Method for redo must be POST', status=400)
 
+@csrf_exempt
+@with_session
+def history(request, state, index=None):
+    if request.method == 'GET' and index is None:
+        return json_response(state.get_history())
+    elif request.method == 'POST' and index is not None:
+        err_message = state.jump_to_history(index)
+        if len(err_message) > 0:
+            return HttpResponse(err_message, status=400)
+        else:
+            return HttpResponse()
+    else:
+        return HttpResponse('Method for history must be GET, or POST with an index', status=400)
+
+
+# Performance metrics for the server
+@with_session
+def metrics(request, state):
+    return json_response({
+        'store': state.store.metrics(),
+        'undo': state.get_history(),
+        'responseCache': state.response_cache.to_json(),
+        'clients': notifier.metrics(state.name),
+        'notifierEncoding': notifier.encoder.metrics(),
+        'keyData': keydata_manager.to_json(),
+    })
+
+# Recent thumbnails from the engine(s)
+def list_thumbnails(request):
+    return json_response(image_manager.to_json())
+
+# A thumbnail from the engine, the latest one if no version is given. Use
+# ?width=256 to get a smaller copy.
+def thumbnail(request, version=None):
+    thumb = image_manager.get(version)
+    if thumb is None:
+        return HttpResponse('No thumbnail', status=404)
+    try:
+        width = int(request.GET['width']) if 'width' in request.GET else None
+    except ValueError:
+        return HttpResponse('Invalid width', status=400)
+    content_type, content, etag = thumb.variant(width)
+
+    tags = request_etags(request, 'HTTP_IF_NONE_MATCH')
+    if tags is not None and ('*' in tags or etag in tags):
+        response = HttpResponse(status=304)
+    else:
+        response = HttpResponse(content, content_type=content_type)
+    response['ETag'] = etag
+    response['X-Thumbnail-Version'] = str(thumb.version)
+    # The latest thumbnail changes, so always check; older versions don't
+    response['Cache-Control'] = 'no-cache' if version is None else 'max-age=3600'
+    return response
+
+# All state sessions this server knows about
+def list_sessions(request):
+    return json_response(sessions.to_json())
+
 
 # https://stackoverflow.com/a/4581997
 def get_client_ip(request):
@@ -107,16 +277,24 @@ def get_client_ip(request):
 def list_visassets(request):
     visasset_list = os.listdir(settings.VISASSET_PATH)
     visasset_list.sort()
+    # Forget any that were removed (possibly by another worker)
+    for va in set(VISASSET_CACHE.keys()) - set(visasset_list):
+        del VISASSET_CACHE[va]
     for va in visasset_list:
         if va not in VISASSET_CACHE:
             artifact_json_path = settings.VISASSET_PATH.joinpath(va).joinpath('artifact.json')
             if artifact_json_path.exists():
                 with open(artifact_json_path) as fin:
-                    VISASSET_CACHE[va] = json.load(fin)
-    return JsonResponse(VISASSET_CACHE)
+                    VISASSET_CACHE[va] = json_codec.loads(fin.read())
+    return json_response(VISASSET_CACHE)
 
 def list_datasets(request):
-    for org in os.listdir(settings.DATASET_PATH):
+    # Forget anything that was removed (possibly by another worker)
+    orgs = os.listdir(settings.DATASET_PATH)
+    for org in set(DATA_CACHE.keys()) - set(orgs):
+        del DATA_CACHE[org]
+
+    for org in orgs:
         if org in DATA_CACHE:
             org_data = DATA_CACHE[org]
         else:
@@ -125,7 +303,10 @@ def list_datasets(request):
         # Skip any "organization" that's not a directory
         if not org_disk_path.is_dir():
             continue
-        for dataset in os.listdir(org_disk_path):
+        datasets = os.listdir(org_disk_path)
+        for dataset in set(org_data.keys()) - set(datasets):
+            del org_data[dataset]
+        for dataset in datasets:
             dataset_disk_path = org_disk_path.joinpath(dataset)
             if dataset_disk_path.is_dir():
                 dataset_disk_path = dataset_disk_path.joinpath('KeyData')
@@ -136,7 +317,10 @@ def list_datasets(request):
                 keydata_dict = org_data[dataset]
             else:
                 keydata_dict = {}
-            for keydata_file in os.listdir(dataset_disk_path):
+            keydata_files = os.listdir(dataset_disk_path)
+            for keydata_name in set(keydata_dict.keys()) - set(Path(f).stem for f in keydata_files):
+                del keydata_dict[keydata_name]
+            for keydata_file in keydata_files:
                 keydata_path = dataset_disk_path.joinpath(keydata_file)
                 keydata_name = keydata_path.stem
                 # Only add keydata that aren't already there
@@ -144,11 +328,11 @@ def list_datasets(request):
                     continue
                 # Retrieve the metadata and put it in the DATA_CACHE
                 if fnmatch.fnmatch(keydata_file, '*.json'):
-                    with open(keydata_path) as json_header:
-                        keydata_dict[keydata_name] = json.load(json_header)
+                    with open(keydata_path, 'rb') as json_header:
+                        keydata_dict[keydata_name] = json_codec.loads(json_header.read())
             org_data[dataset] = keydata_dict
         DATA_CACHE[org] = org_data
-    return JsonResponse(DATA_CACHE)
+    return json_response(DATA_CACHE)
 
 
 
@@ -156,7 +340,7 @@ def list_datasets(request):
 def download_visasset(request, uuid):
     if request.method == 'POST':
         try:
-            host_path = json.loads(request.body)['hostPath']
+            host_path = json_codec.loads(request.body)['hostPath']
         except:
             host_path = settings.VISASSET_LIBRARY
         failed_downloads = visasset_manager.download_visasset(uuid, host_path)
@@ -169,7 +353,8 @@ def download_visasset(request, uuid):
         return HttpResponse('Method for download must be POST', status=400)
 
 @csrf_exempt
-def save_visasset(request, uuid):
+@with_session
+def save_visasset(request, state, uuid):
     if request.method == 'POST':
         visasset_data = state.get_path(['localVisAssets', uuid])
         save_success = visasset_manager.save_from_local(visasset_data)
@@ -185,7 +370,7 @@ def save_visasset(request, uuid):
 def remove_visasset(request, uuid):
     if request.method == 'DELETE':
         visasset_manager.remove_visasset(uuid)
-        del VISASSET_CACHE[uuid]
+        VISASSET_CACHE.pop(uuid, None)
         notifier.notify(NotifierMessage(MessageTarget.VisAssetsCache))
         return HttpResponse()
     else:
@@ -213,62 +398,135 @@ def clean_state_path(method_path, request_path):
     return item_path_parts
 
 
-# Get the histogram for any cached data living on this server
-def get_histogram(request, org_name, dataset_name, key_data_name, variable_label, bins=540):
-    keydata_path = os.path.join(settings.MEDIA_ROOT, 'datasets', org_name, dataset_name, 'KeyData', key_data_name + '.json')
-    binfile_path = os.path.join(settings.MEDIA_ROOT, 'datasets', org_name, dataset_name, 'KeyData', key_data_name + '.bin')
-
-    # Load in the key data
-    with open(keydata_path) as kd_file:
-        kd = json.load(kd_file)
+def histogram_body(kd, variable_label, bins, variable_min=None, variable_max=None):
+    '''
+        Encoded JSON for a histogram of one variable of a KeyData, padded out
+        to `variable_min` and `variable_max` (which default to the KeyData's
+        own range). Raises an UnknownVariableError if there's no variable
+        called `variable_label`, or a ValueError if the histogram can't be
+        made (e.g. too many bins).
+    '''
+    variable_index = kd.variable_index(variable_label)
+    variable_kd_min = kd.metadata['scalarMins'][variable_index]
+    variable_kd_max = kd.metadata['scalarMaxes'][variable_index]
+    variable_min = float(variable_kd_min if variable_min is None else variable_min)
+    variable_max = float(variable_kd_max if variable_max is None else variable_max)
+
+    # Asked for this exact histogram before, and the file hasn't changed
+    cache_key = ('histogram', kd.json_path, kd.stamp, kd.sidecar is not None, variable_label, bins, (variable_min, variable_max))
+    body = keydata_manager.results.get(cache_key)
+    if body is not None:
+        return body
+
+    hist, bins_bounds = keydata_manager.histogram(kd, variable_label, bins)
+    hist_list = hist.tolist()
+    bin_bound_list = bins_bounds.tolist()
+    bin_bound_list = bin_bound_list[1:]
+    assert len(hist_list) == len(bin_bound_list)
+    zipped = [{
+        'binMax': bin_bound_list[i],
+        'items': hist_list[i],
+    } for i in range(len(hist_list))]
+
+    # Put two more bins in to allow the variable to go to its *actual*
+    # bounds, not just the bounds of this key data
+    #
+    # Need all four of these so that the line chart accurately reflects that
+    # there are ZERO items between the full min and the key_data min
+    zipped.insert(0, {
+        'binMax': variable_kd_min,
+        'items': 0,
+    })
+    zipped.insert(0, {
+        'binMax': variable_min,
+        'items': 0,
+    })
+    zipped.append({
+        'binMax': variable_kd_max,
+        'items': 0,
+    })
+    zipped.append({
+        'binMax': variable_max,
+        'items': 0,
+    })
+
+    response = {'histogram': zipped, 'keyDataMin': variable_kd_min, 'keyDataMax': variable_kd_max}
+    # Summary statistics, if they've been precomputed
+    stats = kd.stats(variable_label)
+    if stats is not None:
+        response['stats'] = stats
+    body = json_codec.dumps(response)
+    keydata_manager.results.put(cache_key, body, len(body))
+    return body
 
+# Get the histogram for any cached data living on this server
+def get_histogram(request, org_name, dataset_name, key_data_name, variable_label, bins=settings.KEYDATA_DEFAULT_HISTOGRAM_BINS):
+    try:
+        kd = keydata_manager.open(org_name, dataset_name, key_data_name)
+        body = histogram_body(kd, variable_label, bins, request.GET.get('min'), request.GET.get('max'))
+    except FileNotFoundError:
+        return HttpResponse('No key data named {}'.format(key_data_name), status=404)
+    except (UnknownVariableError, ValueError) as e:
+        return HttpResponse(str(e), status=400)
+    return HttpResponse(body, content_type='application/json')
+
+# Get many histograms at once, e.g. for every variable of a dataset. The body
+# is a list of
+#
+#   {"keyData": "<org>/<dataset>/KeyData/<name>", "variable": "<label>",
+#    "bins": 540, "min": ..., "max": ...}
+#
+# (bins, min and max are optional), and the response is {"histograms": [...]}
+# with what /histogram/ would return for each, or {"error": ...} for the ones
+# that failed.
+@csrf_exempt
+def batch_histograms(request):
+    if request.method != 'POST':
+        return HttpResponse('Histograms must be requested with POST', status=405)
+    try:
+        items = json_codec.loads(request.body)
+        if not isinstance(items, list):
+            raise ValueError('expected a list of histograms')
+        for item in items:
+            if not isinstance(item.get('keyData'), str) or not isinstance(item.get('variable'), str):
+                raise ValueError('each histogram needs a keyData and a variable')
+            # Only <org>/<dataset>/KeyData/<name>, nothing that could point
+            # outside the media folder
+            parts = item['keyData'].split('/')
+            if len(parts) != 4 or parts[2] != 'KeyData' or \
+                    any(part in ('', '.', '..') or '\\' in part for part in parts):
+                raise ValueError('invalid key data path {}'.format(item['keyData']))
+            item['parts'] = parts
+            item['bins'] = int(item.get('bins', settings.KEYDATA_DEFAULT_HISTOGRAM_BINS))
+            if item['bins'] < 1 or item['bins'] > settings.KEYDATA_MAX_HISTOGRAM_BINS:
+                raise ValueError('bins must be between 1 and {}'.format(settings.KEYDATA_MAX_HISTOGRAM_BINS))
+            for bound in ('min', 'max'):
+                if item.get(bound) is not None:
+                    item[bound] = float(item[bound])
+    except (ValueError, TypeError, AttributeError) as e:
+        return HttpResponse('Invalid histogram request: {}'.format(e), status=400)
+
+    # Open each KeyData once, however many of its variables are asked for
+    keydata = {}
+    for item in items:
+        path = item['keyData']
+        if path in keydata:
+            continue
+        org_name, dataset_name, _, key_data_name = item['parts']
+        try:
+            keydata[path] = keydata_manager.open(org_name, dataset_name, key_data_name)
+        except FileNotFoundError:
+            keydata[path] = 'No key data named {}'.format(path)
+
+    def compute(item):
+        kd = keydata[item['keyData']]
+        if isinstance(kd, str):
+            return json_codec.dumps({'error': kd})
         try:
-            variable_index = kd['scalarArrayNames'].index(variable_label)
-        except ValueError:
-            return HttpResponse('No variable named {}'.format(variable_label), status=400)
-
-        binfile = open(binfile_path, 'rb')
-
-        offset = kd['num_points']*(3+variable_index)*4 + kd['num_cell_indices']*4
-        variable_float_data = np.fromfile(binfile, dtype='f4', count=kd['num_points'], offset=offset)
-
-        # variable_float_data = kd['scalarArrays'][variable_index]['array']
-        hist, bins_bounds = np.histogram(variable_float_data, bins=bins)
-        hist_list = hist.tolist()
-        bin_bound_list = bins_bounds.tolist()
-        bin_bound_list = bin_bound_list[1:]
-        assert len(hist_list) == len(bin_bound_list)
-        zipped = [{
-            'binMax': bin_bound_list[i],
-            'items': hist_list[i],
-        } for i in range(len(hist_list))]
-
-        binfile.close()
-
-        # Put two more bins in to allow the variable to go to its *actual*
-        # bounds, not just the bounds of this key data
-        #
-        # Need all four of these so that the line chart accurately reflects that
-        # there are ZERO items between the full min and the key_data min
-        variable_kd_min = kd['scalarMins'][variable_index]
-        variable_kd_max = kd['scalarMaxes'][variable_index]
-        variable_min = float(request.GET.get('min', variable_kd_min))
-        variable_max = float(request.GET.get('max', variable_kd_max))
-        zipped.insert(0, {
-            'binMax': variable_kd_min,
-            'items': 0,
-        })
-        zipped.insert(0, {
-            'binMax': variable_min,
-            'items': 0,
-        })
-        zipped.append({
-            'binMax': variable_kd_max,
-            'items': 0,
-        })
-        zipped.append({
-            'binMax': variable_max,
-            'items': 0,
-        })
-
-        return JsonResponse({'histogram': zipped, 'keyDataMin': variable_kd_min, 'keyDataMax': variable_kd_max})
\ No newline at end of file
+            return histogram_body(kd, item['variable'], item['bins'], item.get('min'), item.get('max'))
+        except (UnknownVariableError, ValueError) as e:
+            return json_codec.dumps({'error': str(e)})
+
+    # Each body is already encoded JSON, so just join them together
+    bodies = keydata_manager.pool.map(compute, items)
+    return HttpResponse(b'{"histograms":[' + b','.join(bodies) + b']}', content_type='application/json')
\ No newline at end of file
@@ -0,0 +1,145 @@
+# bench_json_codec.py
+#
+# Compare the JSON codecs available to the server on payloads shaped like the
+# ones it actually sends: a large composition state and a dataset catalog.
+#
+# Usage (from the repository root):
+#   python benchmarks/bench_json_codec.py [--impressions 500] [--repeat 20]
+#
+# Copyright (c) 2021, University of Minnesota
+# Author: Bridger Herman <herma582@umn.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import uuid
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'abr_server.settings')
+
+from abr_server import json_codec
+
+def make_state(n_impressions):
+    '''
+        A composition with `n_impressions` data impressions, each with a handful
+        of VisAsset and KeyData inputs
+    '''
+    impressions = {}
+    for i in range(n_impressions):
+        impression_uuid = str(uuid.uuid4())
+        impressions[impression_uuid] = {
+            'plateType': 'SimpleSurface',
+            'uuid': impression_uuid,
+            'name': 'Surface {}'.format(i),
+            'inputValues': {
+                'Key Data': {
+                    'inputType': 'IVLab.ABREngine.KeyDataInput',
+                    'inputValue': 'Organization/Dataset/KeyData/Surface{}'.format(i),
+                },
+                'Color Variable': {
+                    'inputType': 'IVLab.ABREngine.ScalarDataVariable',
+                    'inputValue': 'Organization/Dataset/ScalarVar/Temperature',
+                },
+                'Colormap': {
+                    'inputType': 'IVLab.ABREngine.ColormapVisAsset',
+                    'inputValue': str(uuid.uuid4()),
+                },
+                'Line Width': {
+                    'inputType': 'IVLab.ABREngine.LengthPrimitive',
+                    'inputValue': '{}m'.format(random.random()),
+                },
+            },
+            'renderHints': {'visible': True, 'changed': False},
+        }
+    return {
+        'version': '0.2.0',
+        'name': 'Benchmark composition',
+        'impressions': impressions,
+        'dataRanges': {
+            'scalarRanges': {
+                'Organization/Dataset/ScalarVar/Temperature': {'min': 0.0, 'max': 100.0},
+            },
+        },
+    }
+
+def make_catalog(n_datasets, n_keydata):
+    '''
+        Listing of KeyData metadata, like /api/datasets
+    '''
+    catalog = {}
+    for d in range(n_datasets):
+        keydata = {}
+        for k in range(n_keydata):
+            keydata['KeyData{}'.format(k)] = {
+                'meshTopology': 'Triangles',
+                'num_points': random.randint(1000, 1000000),
+                'num_cell_indices': random.randint(1000, 1000000),
+                'scalarArrayNames': ['Var{}'.format(v) for v in range(8)],
+                'scalarMins': [random.random() for _ in range(8)],
+                'scalarMaxes': [random.random() * 100 for _ in range(8)],
+                'bounds': {'min': [random.random()] * 3, 'max': [random.random()] * 3},
+            }
+        catalog['Dataset{}'.format(d)] = keydata
+    return {'Organization': catalog}
+
+def best_of(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the JSON codecs available to the server')
+    parser.add_argument('--impressions', type=int, default=500)
+    parser.add_argument('--datasets', type=int, default=50)
+    parser.add_argument('--keydata', type=int, default=40)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    random.seed(0)
+    payloads = {
+        'state': make_state(args.impressions),
+        'datasets': make_catalog(args.datasets, args.keydata),
+    }
+
+    codecs = [json_codec.get_codec('json')]
+    if json_codec.orjson is not None:
+        codecs.append(json_codec.get_codec('orjson'))
+    else:
+        print('orjson is not installed; only the standard library is measured')
+
+    print('{:<10} {:<8} {:>10} {:>12} {:>12}'.format('payload', 'codec', 'size (KB)', 'dumps (ms)', 'loads (ms)'))
+    for payload_name, payload in payloads.items():
+        baseline = None
+        for codec in codecs:
+            encoded = codec.dumps(payload)
+            assert codec.loads(encoded) == payload
+            dumps_time = best_of(lambda: codec.dumps(payload), args.repeat)
+            loads_time = best_of(lambda: codec.loads(encoded), args.repeat)
+            line = '{:<10} {:<8} {:>10.1f} {:>12.2f} {:>12.2f}'.format(
+                payload_name, codec.name, len(encoded) / 1024, dumps_time * 1000, loads_time * 1000)
+            if baseline is None:
+                baseline = (dumps_time, loads_time)
+            else:
+                line += '   ({:.1f}x / {:.1f}x faster)'.format(baseline[0] / dumps_time, baseline[1] / loads_time)
+            print(line)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+# bench_thumbnails.py
+#
+# Compare how many thumbnails per second the server can take from an engine
+# over the WebSocket, as base64 PNGs in JSON text frames and as binary frames
+# (see abr_server/binary_frames.py). Frames go through the real ASGI
+# application, and the clock stops once every thumbnail has been scaled down to
+# its smaller variants and the newest one written to latest-thumbnail.png.
+#
+# Usage (from the repository root):
+#   python benchmarks/bench_thumbnails.py [--size 2000000] [--count 50]
+#
+# Copyright (c) 2021, University of Minnesota
+# Author: Bridger Herman <herma582@umn.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import io
+import os
+import sys
+import math
+import time
+import base64
+import asyncio
+import argparse
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'abr_server.settings')
+
+import django
+django.setup()
+
+from channels.testing import WebsocketCommunicator
+from abr_server.routing import application
+from abr_server.binary_frames import encode_frame
+from abr_server.image_manager import image_manager
+from abr_server.notifier import notifier
+from abr_server import json_codec
+
+async def run(frames, binary):
+    '''
+        Send every frame in `frames` and wait until every thumbnail has been
+        scaled down and saved.
+        Returns the time taken in seconds.
+    '''
+    loop = asyncio.get_running_loop()
+    done = asyncio.Event()
+    handled = 0
+
+    def count():
+        nonlocal handled
+        handled += 1
+        if handled == len(frames):
+            done.set()
+
+    # Thumbnails are processed in the image manager's pool, after the
+    # `thumbnail` action has returned; count them once that's finished
+    process = image_manager._process
+    def counted_process(*args):
+        try:
+            process(*args)
+        finally:
+            loop.call_soon_threadsafe(count)
+    image_manager._process = counted_process
+
+    client = WebsocketCommunicator(application, '/ws/')
+    await client.connect()
+    start = time.perf_counter()
+    for frame in frames:
+        if binary:
+            await client.send_to(bytes_data=frame)
+        else:
+            await client.send_to(text_data=frame)
+    await done.wait()
+    elapsed = time.perf_counter() - start
+    await client.disconnect()
+    del image_manager._process
+    return elapsed
+
+def make_png(size):
+    '''
+        A 16:9 PNG of random noise (which barely compresses, like a busy
+        rendering) that's about `size` bytes
+    '''
+    height = max(1, int(math.sqrt(size / 3 * 9 / 16)))
+    width = max(1, round(height * 16 / 9))
+    pixels = np.random.randint(0, 256, (height, width, 3), dtype=np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(pixels).save(buf, 'PNG')
+    return (width, height), buf.getvalue()
+
+async def run_all(passes):
+    '''
+        Run each of `passes` ((name, frames, binary)) in turn, on the same
+        event loop (the notifier sticks with the first loop it sees). Returns
+        {name: elapsed}.
+    '''
+    results = {}
+    for name, frames, binary in passes:
+        results[name] = await run(frames, binary)
+    # Let the last coalesced notifications go out before the loop closes
+    await asyncio.sleep(2 * notifier.coalesce_window)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark thumbnail uploads over the WebSocket')
+    parser.add_argument('--size', type=int, default=2000000, help='Approximate size of each thumbnail PNG in bytes')
+    parser.add_argument('--count', type=int, default=50, help='Number of thumbnails to send')
+    args = parser.parse_args()
+
+    (width, height), png = make_png(args.size)
+    print('{}x{} PNG, {:.1f} KB; thumbnail widths {}'.format(
+        width, height, len(png) / 1024, ', '.join(str(w) for w in image_manager.widths)))
+    json_frames = [
+        json_codec.dumps_str({'target': 'thumbnail', 'content': base64.b64encode(png).decode('ascii')})
+        for _ in range(args.count)
+    ]
+    binary_frames = [encode_frame('thumbnail', png) for _ in range(args.count)]
+
+    passes = (('json', json_frames, False), ('binary', binary_frames, True))
+    results = asyncio.run(run_all(passes))
+    print('{:<8} {:>12} {:>14} {:>10}'.format('frames', 'size (KB)', 'thumbnails/s', 'MB/s'))
+    for name, frames, _binary in passes:
+        elapsed = results[name]
+        print('{:<8} {:>12.1f} {:>14.1f} {:>10.1f}'.format(
+            name, len(frames[0]) / 1024, args.count / elapsed, args.count * len(png) / elapsed / 1e6))
+    print('binary frames are {:.1f}x faster'.format(results['json'] / results['binary']))
+
+if __name__ == '__main__':
+    main()
@@ -20,11 +20,12 @@
  */
 
 import { globals } from "./globals.js";
-import { CACHE_UPDATE } from "./StateManager.js";
+import { CACHE_UPDATE, SESSION } from "./StateManager.js";
 
 export class Notifier {
     constructor() {
-        this.ws = new WebSocket(`ws://${window.location.host}/ws/`);
+        let sessionPath = SESSION ? `s/${encodeURIComponent(SESSION)}/` : '';
+        this.ws = new WebSocket(`ws://${window.location.host}/ws/${sessionPath}`);
         this.initialized = false;
 
         // Once the WS is open, tell the ABR Engine to send us the state since
@@ -38,9 +39,16 @@ export class Notifier {
 
         // When a message is received, update the state
         this.ws.onmessage = (evt) => {
-            let target = JSON.parse(evt.data)['target'];
+            let msg = JSON.parse(evt.data);
+            let target = msg['target'];
             if (target == 'state') {
-                globals.stateManager.refreshState();
+                if (msg.patch) {
+                    globals.stateManager.patchState(msg.patch, msg.revision, msg.baseRevision);
+                } else {
+                    globals.stateManager.refreshState();
+                }
+            } else if (target == 'thumbnail') {
+                globals.stateManager.updateLatestThumbnail(msg.revision);
             } else if (target != null && target.startsWith(CACHE_UPDATE)) {
                 let cacheName = target.replace(CACHE_UPDATE, '');
                 globals.stateManager.refreshCache(cacheName);
@@ -24,6 +24,15 @@ import { globals } from "./globals.js";
 export const STATE_UPDATE_EVENT = 'ABRStateUpdate';
 export const CACHE_UPDATE = 'CacheUpdate-';
 
+// Named state session to work on, e.g. /compose?session=wall (the server's
+// default session if none is given)
+export const SESSION = new URLSearchParams(window.location.search).get('session');
+export const SESSION_API = SESSION ? `/api/s/${encodeURIComponent(SESSION)}` : '/api';
+
+// Width of the engine thumbnail to fetch (the server picks the closest size
+// it has)
+const THUMBNAIL_WIDTH = 512;
+
 // Resolve schema consts to values, if there are any values contained within
 // consts
 // For example: {
@@ -60,23 +69,61 @@ export function resolveSchemaConsts(data) {
     return resolvedData;
 }
 
+// Apply a list of JSON Patch (RFC 6902) operations to a state object. Only
+// copies the objects along the path to each change, so the previous state is
+// left untouched.
+export function applyPatch(state, patch) {
+    for (const op of patch) {
+        let parts = op.path.split('/').slice(1).map((p) => p.replace(/~1/g, '/').replace(/~0/g, '~'));
+        if (parts.length == 0) {
+            state = op.op == 'remove' ? {} : op.value;
+            continue;
+        }
+        let root = Object.assign({}, state);
+        let parent = root;
+        for (const part of parts.slice(0, -1)) {
+            parent[part] = Object.assign({}, parent[part]);
+            parent = parent[part];
+        }
+        let last = parts[parts.length - 1];
+        if (op.op == 'remove') {
+            delete parent[last];
+        } else {
+            parent[last] = op.value;
+        }
+        state = root;
+    }
+    return state;
+}
+
 export class StateManager {
     constructor() {
         this._state = {};
         this._previousState = {};
+        this._revision = null;
         this._subscribers = [];
         this._cacheSubscribers = {};
         this._caches = {};
 
-        this._thumbnailPoll = null;
-        this._thumbPollAttempts = 0;
+        this._thumbnailVersion = null;
         this.latestThumbnail = null;
         this.updateLatestThumbnail();
     }
 
-    // Retrieve the latest thumbnail from the server
-    async updateLatestThumbnail() {
-        let b = await fetch('/media/thumbnails/latest-thumbnail.png?' + Date.now()).then((resp) => resp.blob());
+    // Retrieve the latest thumbnail from the server. The server sends a
+    // `thumbnail` notification with the new version whenever there is one; if
+    // we already have that version there's nothing to fetch.
+    async updateLatestThumbnail(version) {
+        if (version !== undefined && version === this._thumbnailVersion) {
+            return;
+        }
+        // The browser checks its cached copy against the server's ETag
+        let resp = await fetch('/api/thumbnails/latest?width=' + THUMBNAIL_WIDTH);
+        if (!resp.ok) {
+            return;
+        }
+        this._thumbnailVersion = Number(resp.headers.get('X-Thumbnail-Version'));
+        let b = await resp.blob();
         let updated = new Promise((resolve, reject) => {
             let reader = new FileReader();
             reader.readAsDataURL(b);
@@ -100,37 +147,44 @@ export class StateManager {
     }
 
     async refreshState() {
-        await fetch('/api/state')
+        let revision = null;
+        await fetch(SESSION_API + '/state')
             .then((resp) => resp.text())
             .then((newState) => {
                 let stateJson = JSON.parse(newState);
+                revision = stateJson.revision;
                 return globals.validator.validate(stateJson.state)
             })
             .then((stateJson) => {
                 this._previousState = this._state;
                 this._state = stateJson;
-                for (const sub of this._subscribers) {
-                    $(sub).trigger(STATE_UPDATE_EVENT);
-                }
+                this._revision = revision;
+                this._stateUpdated();
             });
+    }
 
-        // Poll for updates to the thumbnail, stop trying when there's a new thumbnail or if we've tried more than 10 times
-        if (!this._thumbnailPoll) {
-            this._thumbnailPoll = setInterval(async () => {
-                let prevThumbnail = `${this.latestThumbnail}`;
-                await this.updateLatestThumbnail();
-                if (this._thumbPollAttempts > 10 || this.latestThumbnail != prevThumbnail) {
-                    clearInterval(this._thumbnailPoll);
-                    this._thumbnailPoll = null;
-                    this._thumbPollAttempts = 0;
-                }
-                this._thumbPollAttempts += 1;
-            }, 500);
+    // Apply a state delta sent by the server. If we aren't at the revision the
+    // patch was made against (e.g. we missed a message), fetch the whole state
+    // instead.
+    async patchState(patch, revision, baseRevision) {
+        if (this._revision === null || this._revision !== baseRevision) {
+            await this.refreshState();
+            return;
+        }
+        this._previousState = this._state;
+        this._state = applyPatch(this._state, patch);
+        this._revision = revision;
+        this._stateUpdated();
+    }
+
+    _stateUpdated() {
+        for (const sub of this._subscribers) {
+            $(sub).trigger(STATE_UPDATE_EVENT);
         }
     }
 
     async updateState(newState) {
-        await fetch('/api/state', {
+        await fetch(SESSION_API + '/state', {
             method: 'PUT',
             headers: {
                 'Content-Type': 'application/json',
@@ -144,7 +198,7 @@ export class StateManager {
     // Send an update to a particular object in the state. updateValue MUST be
     // an object.
     async update(updatePath, updateValue) {
-        await fetch('/api/state/' + updatePath, {
+        await fetch(SESSION_API + '/state/' + updatePath, {
             method: 'PUT',
             headers: {
                 'Content-Type': 'application/json',
@@ -160,10 +214,30 @@ export class StateManager {
         });
     }
 
+    // Apply several updates to the state at once; either all of them are
+    // applied or none are. Each operation is one of {op: 'set', path, value},
+    // {op: 'remove', path}, or {op: 'remove-all', value}.
+    async batch(operations) {
+        await fetch(SESSION_API + '/state/batch', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                // 'X-CSRFToken': csrftoken,
+            },
+            mode: 'same-origin',
+            body: JSON.stringify(operations),
+        }).then(async (resp) => {
+            if (!resp.ok) {
+                let text = await resp.text();
+                throw new Error(text);
+            }
+        });
+    }
+
     // Remove all instances of a particular value from the state
     // Particularly useful when deleting data impressions
     async removeAll(value) {
-        await fetch('/api/remove/' + value, {
+        await fetch(SESSION_API + '/remove/' + value, {
             method: 'DELETE',
             headers: {
                 // 'X-CSRFToken': csrftoken,
@@ -175,7 +249,7 @@ export class StateManager {
     // Remove something at a particular path
     async removePath(path) {
         path = path ? path : '';
-        await fetch('/api/remove-path/' + path, {
+        await fetch(SESSION_API + '/remove-path/' + path, {
             method: 'DELETE',
             headers: {
                 // 'X-CSRFToken': csrftoken,
@@ -195,7 +269,7 @@ export class StateManager {
     }
 
     async undo() {
-        await fetch('/api/undo', {
+        await fetch(SESSION_API + '/undo', {
             method: 'POST',
             headers: {
                 // 'X-CSRFToken': csrftoken,
@@ -205,7 +279,7 @@ export class StateManager {
     }
 
     async redo() {
-        await fetch('/api/redo', {
+        await fetch(SESSION_API + '/redo', {
             method: 'POST',
             headers: {
                 // 'X-CSRFToken': csrftoken,
@@ -23,6 +23,7 @@
 
 import { globals } from '../../../../common/globals.js';
 import { uuid } from '../../../../common/UUID.js';
+import { SESSION_API } from '../../../../common/StateManager.js';
 import { ColorMap, floatToHex, hexToFloat } from './color.js';
 import { width, height } from './dialogConsts.js';
 import { ColorThumb } from './components.js';
@@ -200,7 +201,7 @@ async function saveColormap() {
 }
 
 async function saveColormapToLibrary(vaUuid) {
-    return fetch('/api/save-local-visasset/' + vaUuid, {
+    return fetch(SESSION_API + '/save-local-visasset/' + vaUuid, {
         method: 'POST',
         headers: {
             'Content-Type': 'application/json',
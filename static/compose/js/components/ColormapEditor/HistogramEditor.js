@@ -71,10 +71,22 @@ export async function HistogramEditor(variableInput, keyDataInput) {
     let keyDataName = DataPath.getName(currentKeyDataPath);
 
     // Fetch the histogram from the server
-    let url = new URL(`${window.location}api/histogram/${currentKeyDataPath}/${variableName}`);
-    url.search = new URLSearchParams(currentMinMax);
-
-    zippedHistogram = await fetch(url).then((resp) => resp.json());
+    let url = new URL('/api/histograms', window.location.origin);
+    let histograms = await fetch(url, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        mode: 'same-origin',
+        body: JSON.stringify([{
+            keyData: currentKeyDataPath,
+            variable: variableName,
+        }]),
+    }).then((resp) => resp.json());
+    zippedHistogram = histograms.histograms[0];
+    if (zippedHistogram.error) {
+        throw new Error(`Unable to get histogram: ${zippedHistogram.error}`);
+    }
 
     // Try to get the current min/max from state if it's been redefined
     if (globals.stateManager.state.dataRanges) {
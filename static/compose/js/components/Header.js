@@ -21,6 +21,7 @@
 
 import { globals } from "../../../common/globals.js";
 import { download } from "../../../common/helpers.js";
+import { SESSION } from "../../../common/StateManager.js";
 
 const STORAGE_STATE_PREFIX = '_state_';
 const STORAGE_THUMB_PREFIX = '_thumb_';
@@ -144,7 +145,8 @@ export function Header() {
         .append($('<span>', { class: 'material-icons', text: 'code'}))
         .append($('<span>', { text: 'Open JSON editor...' }))
         .on('click', (_evt) => {
-            window.open(window.location.href + 'raw-editor', '_blank');
+            let rawEditorUrl = SESSION ? `/raw-editor?session=${encodeURIComponent(SESSION)}` : '/raw-editor';
+            window.open(rawEditorUrl, '_blank');
     });
 
 